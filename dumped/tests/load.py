@@ -125,9 +125,7 @@ class PacketInLoad(base_tests.SimpleDataPlane):
                (simple_eth_packet(pktlen=40), "tiny Ethernet packet")]:
 
                logging.info("PKT IN test with %s, port %s" % (pt, of_port))
-               for count in range(100):
-                   out_count += 1
-                   self.dataplane.send(of_port, str(pkt))
+               out_count += self.dataplane.send_burst(of_port, [str(pkt)] * 100)
         while True:
             (response, raw) = self.controller.poll(ofp.OFPT_PACKET_IN)
             if not response:
@@ -144,7 +142,8 @@ class PacketOutLoad(base_tests.SimpleDataPlane):
     Test packet-out function by sending lots of packet-out msgs
     to the switch.  This test tracks the number of packets received in 
     the dataplane, but does not enforce any requirements about the 
-    number received.
+    number received.  The dataplane only counts received packets, so
+    the count is not limited by the dataplane queue length.
     """
     def runTest(self):
         # Construct packet to send to dataplane
@@ -159,6 +158,7 @@ class PacketOutLoad(base_tests.SimpleDataPlane):
         out_count = 0
         in_count = 0
         xid = 100
+        self.dataplane.start_counting()
         for dp_port in of_ports:
             for outpkt, opt in [
                (simple_tcp_packet(), "simple TCP packet"),
@@ -183,11 +183,9 @@ class PacketOutLoad(base_tests.SimpleDataPlane):
 
                exp_pkt_arg = None
                exp_port = None
-        while True:
-            (of_port, pkt, pkt_time) = self.dataplane.poll()
-            if pkt is None:
-                break
-            in_count += 1
+        self.dataplane.wait_count(out_count)
+        self.dataplane.stop_counting()
+        in_count = self.dataplane.counts()["packets"]
         logging.info("PacketOutLoad Sent %d. Got %d." % (out_count, in_count))
 
 class FlowModLoad(base_tests.SimpleProtocol):
@@ -231,9 +229,8 @@ class FlowModLoad(base_tests.SimpleProtocol):
 
             logging.info("Iteration %d: add %s flows" % (i, num_flows))
             random.shuffle(requests)
-            for request in requests:
-               self.assertNotEqual(self.controller.message_send(request), -1,
-                               "Error installing flow mod")
+            self.assertNotEqual(self.controller.message_send_many(requests), -1,
+                                "Error installing flow mods")
             self.checkBarrier()
 
 class FlowRemovedLoad(base_tests.SimpleDataPlane):
@@ -282,8 +279,7 @@ class FlowRemovedLoad(base_tests.SimpleDataPlane):
 
         logging.info("Adding %d flows", num_flows)
         random.shuffle(requests)
-        for request in requests:
-            self.controller.message_send(request)
+        self.controller.message_send_many(requests)
         self.checkBarrier()
 
         # Trigger a flood of flow-removed messages
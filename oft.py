@@ -68,10 +68,16 @@ CONFIG_DEFAULT = {
     "controller_host"    : "10.0.0.1",  # For passive bind
     "controller_port"    : 6633,
     "switch_ip"          : None,  # If not none, actively connect to switch
+    "handler_workers"    : 0,  # If not 0, run message handlers on a pool
+    "persistent_controller" : False,  # Keep the connection across tests
+    "persistent_reset"   : False,  # Delete flows and groups between tests
+    "echo_interval"      : 0,  # If not 0, measure latency with echo requests
      "platform"           : "eth",
     "platform_args"      : None,
     "platform_dir"       : os.path.join(ROOT_DIR, "platforms"),
     "interfaces"         : [],
+    "port_class"         : None,
+    "port_filter"        : None,
     "openflow_version"   : "1.3",
 
     # Logging options
@@ -82,6 +88,7 @@ CONFIG_DEFAULT = {
     "profile_file"       : "profile.out",
     "xunit"              : False,
     "xunit_dir"          : "xunit",
+    "control_pcap"       : False,
 
     # Test behavior options
     "relax"              : False,
@@ -167,11 +174,23 @@ prefixing them with the '^' character.
                       type="int", help="Port number to listen on (default %default)")
     group.add_option("-S", "--switch-ip", dest="switch_ip",
                       help="If set, actively connect to this switch by IP")
+    group.add_option("--handler-workers", type="int",
+                      help="Run controller message handlers on this many worker threads instead of the receive thread (default %default)")
+    group.add_option("--persistent-controller", action="store_true",
+                      help="Keep the switch connection and handshake across tests instead of reconnecting for each test")
+    group.add_option("--persistent-reset", action="store_true",
+                      help="With --persistent-controller, delete all flows and groups before each test")
+    group.add_option("--echo-interval", type=float,
+                      help="Send an echo request to the switch every this many seconds and log round trip times (default %default, off)")
     group.add_option("-P", "--platform", help="Platform module name (default %default)")
     group.add_option("-a", "--platform-args", help="Custom arguments for the platform")
     group.add_option("--platform-dir", type="string", help="Directory containing platform modules")
     group.add_option("--interface", "-i", type="interface", dest="interfaces", metavar="INTERFACE", action="append",
                      help="Specify a OpenFlow port number and the dataplane interface to use. May be given multiple times. Example: 1@eth1")
+    group.add_option("--port-class",
+                      help="Dataplane port class name, e.g. DataPlanePortLinuxMmap for a memory mapped receive ring")
+    group.add_option("--port-filter", metavar="SPEC",
+                      help="Drop dataplane frames in the kernel, e.g. 'drop lldp, drop ipv6 multicast'")
     group.add_option("--of-version", "-V", dest="openflow_version", choices=loxi.version_names.values(),
                      help="OpenFlow version to use")
     parser.add_option_group(group)
@@ -190,6 +209,8 @@ prefixing them with the '^' character.
     group.add_option("--profile-file", help="Output file for Python profiler")
     group.add_option("--xunit", action="store_true", help="Enable xUnit-formatted results")
     group.add_option("--xunit-dir", help="Output directory for xUnit-formatted results")
+    group.add_option("--control-pcap", action="store_true",
+                      help="Capture control channel messages of each test to a pcap file in the log directory")
     parser.add_option_group(group)
 
     group = optparse.OptionGroup(parser, "Test behavior options")
@@ -417,6 +438,7 @@ sys.modules["ofp"] = loxi.protocol(name_to_version[config["openflow_version"]])
 
 # HACK: testutils.py imports controller.py, which needs the ofp module
 import oftest.testutils
+import oftest.controller
 
 # Allow tests to import each other
 sys.path.append(config["test_dir"])
@@ -531,6 +553,11 @@ except:
     logging.warn("Could not run platform host configuration")
     raise
 
+if config["port_class"]:
+    config.setdefault("dataplane", {})["portclass"] = config["port_class"]
+if config["port_filter"]:
+    config.setdefault("dataplane", {})["filter"] = config["port_filter"]
+
 if not config["port_map"]:
     die("Interface port map was not defined by the platform. Exiting.")
 
@@ -585,8 +612,17 @@ if __name__ == "__main__":
     if oftest.testutils.skipped_test_count > 0:
         message = "Skipped %d test(s)" % oftest.testutils.skipped_test_count
         logging.info(message)
+    if oftest.controller.echo_run_stats.sent:
+        logging.info("Control channel %s",
+                     oftest.controller.echo_run_stats.report())
     logging.info("*** TEST RUN END  : %s", time.asctime())
 
+    # Shutdown the controller kept across tests, if any
+    if oftest.controller_instance:
+        oftest.controller_instance.shutdown()
+        oftest.controller_instance.join()
+        oftest.controller_instance = None
+
     # Shutdown the dataplane
     oftest.dataplane_instance.kill()
     oftest.dataplane_instance = None
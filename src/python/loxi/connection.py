@@ -17,10 +17,104 @@ import socket
 import errno
 import os
 import select
+import struct
 from threading import Condition, Lock, Thread
 
 DEFAULT_TIMEOUT = 1
 
+OFP_HEADER = struct.Struct("!BBHL")
+
+class MessageBuffer(object):
+    """
+    Reusable receive buffer that frames OpenFlow messages
+
+    Data is read from the socket directly into a preallocated bytearray,
+    so a message split over many reads is never rebuilt by string
+    concatenation.  When the header of a partial message has been
+    received the buffer makes room for the whole message before the next
+    read.  Complete messages are handed out as read-only buffer objects
+    pointing into the bytearray; they are only valid until the next call
+    to recv_into or write.
+    """
+
+    def __init__(self, size=65536, min_read=4096):
+        self.buf = bytearray(size)
+        self.min_read = min_read
+        self.start = 0 # First byte not yet consumed
+        self.end = 0 # End of received data
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        """
+        Discard any buffered data
+        """
+        self.start = self.end = 0
+
+    def recv_into(self, sock):
+        """
+        Read from the socket into the free space of the buffer
+
+        @returns The number of bytes read, 0 at end of file
+        """
+        self._reserve()
+        view = memoryview(self.buf)[self.end:]
+        n = sock.recv_into(view, len(view))
+        self.end += n
+        return n
+
+    def write(self, data):
+        """
+        Append data that was received by other means
+        """
+        self._reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def messages(self):
+        """
+        Yield each complete message in the buffer
+
+        Yields (version, type, length, xid, data) where data is a buffer
+        object covering the whole message.  Each message is consumed when
+        the next one is requested.
+        """
+        while self.end - self.start >= OFP_HEADER.size:
+            version, type, length, xid = OFP_HEADER.unpack_from(self.buf, self.start)
+            if length < OFP_HEADER.size:
+                raise loxi.ProtocolError("invalid message length %d" % length)
+            if self.end - self.start < length:
+                break
+            data = buffer(self.buf, self.start, length)
+            self.start += length
+            yield (version, type, length, xid, data)
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _reserve(self, extra=0):
+        """
+        Make sure the next read can complete the current partial message
+        """
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+
+        want = OFP_HEADER.size
+        if pending >= OFP_HEADER.size:
+            want = max(want, OFP_HEADER.unpack_from(self.buf, self.start)[2])
+        want = max(want, pending + extra, pending + self.min_read)
+
+        if self.start + want > len(self.buf):
+            if self.start > 0:
+                self.buf[0:pending] = self.buf[self.start:self.end]
+                self.start, self.end = 0, pending
+            if want > len(self.buf):
+                new_buf = bytearray(max(want, 2 * len(self.buf)))
+                new_buf[0:pending] = self.buf[0:pending]
+                self.buf = new_buf
+
 class TransactionError(Exception):
     def __str__(self):
         return self.args[0]
@@ -40,7 +134,7 @@ class Connection(Thread):
         self.next_xid = 1
         self.wakeup_rd, self.wakeup_wr = os.pipe()
         self.finished = False
-        self.read_buffer = None
+        self.read_buffer = MessageBuffer()
 
     def run(self):
         while not self.finished:
@@ -52,35 +146,16 @@ class Connection(Thread):
         self.logger.debug("Exited event loop")
 
     def process_read(self):
-        recvd = self.sock.recv(4096)
-
-        self.logger.debug("Received %d bytes", len(recvd))
+        recvd = self.read_buffer.recv_into(self.sock)
 
-        buf = self.read_buffer
-        if buf:
-            buf += recvd
-        else:
-            buf = recvd
-
-        offset = 0
-        while offset < len(buf):
-            if offset + 8 > len(buf):
-                # Not enough data for the OpenFlow header
-                break
-
-            # Parse the header to get type
-            hdr_version, hdr_type, hdr_msglen, hdr_xid = loxi.of14.message.parse_header(buf[offset:])
+        self.logger.debug("Received %d bytes", recvd)
 
+        for (hdr_version, hdr_type, hdr_msglen, hdr_xid, rawmsg) in \
+                self.read_buffer.messages():
             # Use loxi to resolve ofp of matching version
             ofp = loxi.protocol(hdr_version)
 
-            # Extract the raw message bytes
-            if (offset + hdr_msglen) > len(buf):
-                # Not enough data for the body
-                break
-            rawmsg = buf[offset : offset + hdr_msglen]
-            offset += hdr_msglen
-
+            # The parser reads directly from the receive buffer
             msg = ofp.message.parse_message(rawmsg)
             if not msg:
                 self.logger.warn("Could not parse message")
@@ -93,10 +168,7 @@ class Connection(Thread):
                 self.rx.append(msg)
                 self.rx_cv.notify_all()
 
-        if offset == len(buf):
-            self.read_buffer = None
-        else:
-            self.read_buffer = buf[offset:]
+        if len(self.read_buffer):
             self.logger.debug("%d bytes remaining", len(self.read_buffer))
 
     def recv(self, predicate, timeout=DEFAULT_TIMEOUT):
@@ -11,6 +11,10 @@ config = {}
 # Populated by oft.
 dataplane_instance = None
 
+# Controller kept across tests when config["persistent_controller"] is set.
+# Populated by base_tests.SimpleProtocol, shut down by oft.
+controller_instance = None
+
 def open_logfile(name):
     """
     (Re)open logfile
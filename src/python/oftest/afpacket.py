@@ -6,16 +6,60 @@ in the data returned by recv. Instead, it delivers the VLAN TCI in a control
 message. Python 2.x doesn't have built-in support for recvmsg, so we have to
 use ctypes to call it. The recv function exported by this module reconstructs
 the VLAN tag if it was offloaded.
+
+recv_batch receives many packets per system call with recvmmsg, reusing
+its buffers between calls, and also returns the kernel receive timestamps.
+send_batch likewise sends many packets per system call with sendmmsg.
+
+RxRing maps a TPACKET_V3 receive ring instead, where the kernel fills whole
+blocks of packets that are read without a system call per packet.
+
+attach_filter installs a classic BPF program (see the bpf module) so
+uninteresting frames are dropped in the kernel.
 """
 
 import socket
 import struct
+import mmap
+import errno
+import time
+import select
+import threading
 from ctypes import *
 
 ETH_P_8021Q = 0x8100
 SOL_PACKET = 263
 PACKET_AUXDATA = 8
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1 << 0
 TP_STATUS_VLAN_VALID = 1 << 4
+TP_STATUS_VLAN_TPID_VALID = 1 << 6
+SOL_SOCKET = 1
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+SO_TIMESTAMPNS = 35
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+SO_TIMESTAMPING = 37
+SCM_TIMESTAMPING = SO_TIMESTAMPING
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_OPT_ID = 1 << 7
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11
+PACKET_TX_TIMESTAMP = 16
+MSG_DONTWAIT = 0x40
+MSG_ERRQUEUE = 0x2000
+UIO_MAXIOV = 1024
+
+# struct tpacket_req3
+TPacketReq3 = struct.Struct("=IIIIIII")
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1
+# block_status, num_pkts, offset_to_first_pkt
+TPacketBlockDesc = struct.Struct("=IIIII")
+# struct tpacket3_hdr up to and including hv1
+TPacket3Hdr = struct.Struct("=IIIIIIHHIIHH")
 
 class struct_iovec(Structure):
     _fields_ = [
@@ -52,10 +96,82 @@ class struct_tpacket_auxdata(Structure):
         ("tp_padding", c_ushort),
     ]
 
-libc = CDLL("libc.so.6")
+class struct_sock_extended_err(Structure):
+    _fields_ = [
+        ("ee_errno", c_uint32),
+        ("ee_origin", c_uint8),
+        ("ee_type", c_uint8),
+        ("ee_code", c_uint8),
+        ("ee_pad", c_uint8),
+        ("ee_info", c_uint32),
+        ("ee_data", c_uint32),
+    ]
+
+class struct_mmsghdr(Structure):
+    _fields_ = [
+        ("msg_hdr", struct_msghdr),
+        ("msg_len", c_uint),
+    ]
+
+class struct_timespec(Structure):
+    _fields_ = [
+        ("tv_sec", c_long),
+        ("tv_nsec", c_long),
+    ]
+
+libc = CDLL("libc.so.6", use_errno=True)
 recvmsg = libc.recvmsg
 recvmsg.argtypes = [c_int, POINTER(struct_msghdr), c_int]
 recvmsg.retype = c_int
+recvmmsg = libc.recvmmsg
+recvmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int,
+                     POINTER(struct_timespec)]
+recvmmsg.restype = c_int
+sendmmsg = libc.sendmmsg
+sendmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int]
+sendmmsg.restype = c_int
+
+def cmsg_align(length):
+    return (length + sizeof(c_size_t) - 1) & ~(sizeof(c_size_t) - 1)
+
+# Room for the auxdata and timestamp control messages
+CTRL_BUFSIZE = 2 * cmsg_align(sizeof(struct_cmsghdr)) + \
+    cmsg_align(sizeof(struct_tpacket_auxdata)) + \
+    cmsg_align(sizeof(struct_timespec))
+
+def parse_cmsgs(addr, length):
+    """
+    Find the control messages this module asks for
+
+    @param addr Address of the control buffer
+    @param length Length of the control data returned by the kernel
+    @retval (struct_tpacket_auxdata or None, timestamp or None)
+    """
+    auxdata = timestamp = None
+    end = addr + length
+    hdrlen = cmsg_align(sizeof(struct_cmsghdr))
+    while addr + sizeof(struct_cmsghdr) <= end:
+        cmsghdr = struct_cmsghdr.from_address(addr)
+        if cmsghdr.cmsg_len < sizeof(struct_cmsghdr):
+            break
+        if cmsghdr.cmsg_level == SOL_PACKET and \
+                cmsghdr.cmsg_type == PACKET_AUXDATA:
+            auxdata = struct_tpacket_auxdata.from_address(addr + hdrlen)
+        elif cmsghdr.cmsg_level == SOL_SOCKET and \
+                cmsghdr.cmsg_type == SCM_TIMESTAMPNS:
+            ts = struct_timespec.from_address(addr + hdrlen)
+            timestamp = ts.tv_sec + ts.tv_nsec / 1e9
+        addr += cmsg_align(cmsghdr.cmsg_len)
+    return (auxdata, timestamp)
+
+def vlan_restore(data, auxdata):
+    """
+    Re-insert the VLAN tag reported in auxdata, if any
+    """
+    if auxdata and (auxdata.tp_vlan_tci != 0 or
+                    auxdata.tp_status & TP_STATUS_VLAN_VALID):
+        return vlan_insert(data, auxdata.tp_vlan_tci)
+    return data
 
 def enable_auxdata(sk):
     """
@@ -65,15 +181,115 @@ def enable_auxdata(sk):
     """
     sk.setsockopt(SOL_PACKET, PACKET_AUXDATA, 1)
 
+def enable_timestamps(sk):
+    """
+    Ask the kernel to return the receive time in a control message
+
+    Used by recv_batch.
+    """
+    sk.setsockopt(SOL_SOCKET, SO_TIMESTAMPNS, 1)
+
+def attach_filter(sk, insns):
+    """
+    Attach a classic BPF program to the socket
+
+    Frames the program drops are discarded by the kernel before they are
+    queued on the socket.
+    @param insns List of (code, jt, jf, k) instructions, see bpf.compile
+    """
+    prog = "".join(struct.pack("=HBBI", *insn) for insn in insns)
+    buf = create_string_buffer(prog, len(prog))
+    # struct sock_fprog holds a pointer, the kernel copies the program
+    fprog = struct.pack("HP", len(insns), addressof(buf))
+    sk.setsockopt(SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+def detach_filter(sk):
+    """
+    Remove the BPF program attached to the socket
+    """
+    sk.setsockopt(SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+def enable_tx_timestamps(sk):
+    """
+    Ask the kernel to report when each sent packet leaves for the device
+
+    The driver takes a software timestamp as it hands the packet to the
+    device; the timestamps are read with recv_tx_timestamps.  Packets
+    are numbered from 0 in the order they are sent, starting from this
+    call.  Drivers without software tx timestamps report nothing.
+    """
+    sk.setsockopt(SOL_SOCKET, SO_TIMESTAMPING,
+                  SOF_TIMESTAMPING_TX_SOFTWARE |
+                  SOF_TIMESTAMPING_SOFTWARE |
+                  SOF_TIMESTAMPING_OPT_ID |
+                  SOF_TIMESTAMPING_OPT_TSONLY)
+
+TX_CTRL_BUFSIZE = 256
+
+def recv_tx_timestamps(sk):
+    """
+    Read the tx timestamps queued on the socket error queue
+
+    The error queue makes the socket report an error condition to poll
+    until it is read.
+    @retval List of (packet number, timestamp)
+    """
+    buf = create_string_buffer(1)
+    ctrl_buf = create_string_buffer(TX_CTRL_BUFSIZE)
+    iov = struct_iovec(cast(buf, c_void_p), 1)
+    msghdr = struct_msghdr()
+    msghdr.msg_iov = pointer(iov)
+    msghdr.msg_iovlen = 1
+    msghdr.msg_control = cast(ctrl_buf, c_void_p)
+
+    hdrlen = cmsg_align(sizeof(struct_cmsghdr))
+    result = []
+    while True:
+        msghdr.msg_controllen = TX_CTRL_BUFSIZE
+        rv = recvmsg(sk.fileno(), byref(msghdr), MSG_ERRQUEUE | MSG_DONTWAIT)
+        if rv < 0:
+            break
+        timestamp = tx_id = None
+        addr = addressof(ctrl_buf)
+        end = addr + msghdr.msg_controllen
+        while addr + sizeof(struct_cmsghdr) <= end:
+            cmsghdr = struct_cmsghdr.from_address(addr)
+            if cmsghdr.cmsg_len < sizeof(struct_cmsghdr):
+                break
+            if cmsghdr.cmsg_level == SOL_SOCKET and \
+                    cmsghdr.cmsg_type == SCM_TIMESTAMPING:
+                # The software timestamp is the first of three
+                ts = struct_timespec.from_address(addr + hdrlen)
+                timestamp = ts.tv_sec + ts.tv_nsec / 1e9
+            elif cmsghdr.cmsg_level == SOL_PACKET and \
+                    cmsghdr.cmsg_type == PACKET_TX_TIMESTAMP:
+                serr = struct_sock_extended_err.from_address(addr + hdrlen)
+                tx_id = serr.ee_data
+            addr += cmsg_align(cmsghdr.cmsg_len)
+        if timestamp is not None and tx_id is not None:
+            result.append((tx_id, timestamp))
+    return result
+
 def recv(sk, bufsize):
     """
     Receive a packet from an AF_PACKET socket
     @sk Socket
     @bufsize Maximum packet size
     """
+    return recv_timestamped(sk, bufsize)[0]
+
+def recv_timestamped(sk, bufsize):
+    """
+    Receive a packet and its kernel receive timestamp
+
+    The timestamp is None unless enable_timestamps was called.
+    @sk Socket
+    @bufsize Maximum packet size
+    @retval (packet data, timestamp)
+    """
     buf = create_string_buffer(bufsize)
 
-    ctrl_bufsize = sizeof(struct_cmsghdr) + sizeof(struct_tpacket_auxdata) + sizeof(c_size_t)
+    ctrl_bufsize = CTRL_BUFSIZE
     ctrl_buf = create_string_buffer(ctrl_bufsize)
 
     iov = struct_iovec()
@@ -94,19 +310,221 @@ def recv(sk, bufsize):
         raise RuntimeError("recvmsg failed: rv=%d", rv)
 
     # The kernel only delivers control messages we ask for. We
-    # only enabled PACKET_AUXDATA, so we can assume it's the
-    # only control message.
-    assert msghdr.msg_controllen >= sizeof(struct_cmsghdr)
-
-    cmsghdr = struct_cmsghdr.from_buffer(ctrl_buf) # pylint: disable=E1101
-    assert cmsghdr.cmsg_level == SOL_PACKET
-    assert cmsghdr.cmsg_type == PACKET_AUXDATA
-
-    auxdata = struct_tpacket_auxdata.from_buffer(ctrl_buf, sizeof(struct_cmsghdr)) # pylint: disable=E1101
-
-    if auxdata.tp_vlan_tci != 0 or auxdata.tp_status & TP_STATUS_VLAN_VALID:
-        # Insert VLAN tag
-        tag = struct.pack("!HH", ETH_P_8021Q, auxdata.tp_vlan_tci)
-        return buf.raw[:12] + tag + buf.raw[12:rv]
-    else:
-        return buf.raw[:rv]
+    # always enable PACKET_AUXDATA; timestamps may also be there.
+    (auxdata, timestamp) = parse_cmsgs(addressof(ctrl_buf),
+                                       msghdr.msg_controllen)
+    assert auxdata is not None
+
+    return (vlan_restore(buf.raw[:rv], auxdata), timestamp)
+
+class RecvBatch(object):
+    """
+    Preallocated buffers for receiving up to n packets with recvmmsg
+    """
+
+    def __init__(self, n, bufsize):
+        self.n = n
+        self.bufsize = bufsize
+        self.bufs = create_string_buffer(n * bufsize)
+        self.ctrl_bufs = create_string_buffer(n * CTRL_BUFSIZE)
+        self.iovecs = (struct_iovec * n)()
+        self.msgs = (struct_mmsghdr * n)()
+
+        bufs_addr = addressof(self.bufs)
+        ctrl_addr = addressof(self.ctrl_bufs)
+        for i in xrange(n):
+            self.iovecs[i].iov_base = bufs_addr + i * bufsize
+            self.iovecs[i].iov_len = bufsize
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_iov = pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_control = ctrl_addr + i * CTRL_BUFSIZE
+
+    def recv(self, sk):
+        # The kernel overwrites the control lengths on return
+        for i in xrange(self.n):
+            self.msgs[i].msg_hdr.msg_controllen = CTRL_BUFSIZE
+            self.msgs[i].msg_hdr.msg_flags = 0
+
+        rv = recvmmsg(sk.fileno(), self.msgs, self.n, MSG_DONTWAIT, None)
+        if rv < 0:
+            err = get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, "recvmmsg failed")
+
+        now = time.time()
+        pkts = []
+        for i in xrange(rv):
+            msg = self.msgs[i]
+            (auxdata, timestamp) = parse_cmsgs(msg.msg_hdr.msg_control,
+                                               msg.msg_hdr.msg_controllen)
+            data = string_at(self.iovecs[i].iov_base,
+                             min(msg.msg_len, self.bufsize))
+            pkts.append((vlan_restore(data, auxdata), timestamp or now))
+        return pkts
+
+# RecvBatch objects by (n, bufsize), per thread
+_recv_batches = threading.local()
+
+def recv_batch(sk, n, bufsize=4096):
+    """
+    Receive up to n packets from an AF_PACKET socket with one system call
+
+    Does not block; returns an empty list if no packet is waiting.  The
+    buffers are allocated on the first call and reused by later calls
+    from the same thread with the same n and bufsize.  Call enable_auxdata
+    and enable_timestamps on the socket first.
+    @sk Socket
+    @n Maximum number of packets
+    @bufsize Maximum packet size
+    @retval List of (packet data, timestamp); the timestamp is the kernel
+    receive time if available
+    """
+    cache = _recv_batches.__dict__
+    batch = cache.get((n, bufsize))
+    if batch is None:
+        batch = cache[(n, bufsize)] = RecvBatch(n, bufsize)
+    return batch.recv(sk)
+
+def vlan_insert(data, tci, tpid=ETH_P_8021Q):
+    """
+    Re-insert a VLAN tag that was offloaded by the NIC
+    """
+    return data[:12] + struct.pack("!HH", tpid, tci) + data[12:]
+
+class RxRing(object):
+    """
+    TPACKET_V3 memory mapped receive ring on an AF_PACKET socket
+
+    Must be set up before the socket is bound.  The kernel hands over a
+    block of packets at a time, either when it is full or after
+    retire_tov milliseconds, and the socket polls readable while a block
+    is waiting to be read.
+    """
+
+    def __init__(self, sk, block_size=1 << 18, block_nr=64,
+                 frame_size=1 << 11, retire_tov=10):
+        self.sk = sk
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.block = 0
+
+        sk.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        sk.setsockopt(SOL_PACKET, PACKET_RX_RING, TPacketReq3.pack(
+            block_size, block_nr, frame_size,
+            block_size / frame_size * block_nr,
+            retire_tov, 0, 0))
+        self.ring = mmap.mmap(sk.fileno(), block_size * block_nr,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def recv_batch(self, max_pkts=None):
+        """
+        Read the packets in the blocks handed over by the kernel
+
+        Blocks are read whole; no further block is read once max_pkts
+        packets have been read, so a busy port cannot keep the caller
+        here forever.  VLAN tags offloaded by the NIC are put back into
+        the packet.
+        @max_pkts Limit on the number of packets, or None for no limit
+        @retval List of (packet data, kernel timestamp)
+        """
+        ring = self.ring
+        pkts = []
+        while max_pkts is None or len(pkts) < max_pkts:
+            base = self.block * self.block_size
+            (_, _, status, num_pkts, offset) = \
+                TPacketBlockDesc.unpack_from(ring, base)
+            if not status & TP_STATUS_USER:
+                break
+
+            offset += base
+            for i in xrange(num_pkts):
+                (next_offset, sec, nsec, snaplen, _, status, mac, _,
+                 _, vlan_tci, vlan_tpid, _) = \
+                    TPacket3Hdr.unpack_from(ring, offset)
+                start = offset + mac
+                data = ring[start:start+snaplen]
+                if vlan_tci != 0 or status & TP_STATUS_VLAN_VALID:
+                    if not status & TP_STATUS_VLAN_TPID_VALID:
+                        vlan_tpid = ETH_P_8021Q
+                    data = vlan_insert(data, vlan_tci & 0xffff, vlan_tpid)
+                pkts.append((data, sec + nsec / 1e9))
+                offset += next_offset
+
+            # Give the block back to the kernel
+            ring[base+8:base+12] = struct.pack("=I", TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.block_nr
+        return pkts
+
+    def close(self):
+        self.ring.close()
+
+class SendBatch(object):
+    """
+    Preallocated iovec and mmsghdr arrays for sending up to n packets
+
+    The mmsghdrs point at the iovecs once and for all; each send only
+    fills in the iovecs it uses, packed with one struct call for the whole
+    batch.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.iovecs = (struct_iovec * n)()
+        self.msgs = (struct_mmsghdr * n)()
+        for i in xrange(n):
+            self.msgs[i].msg_hdr.msg_iov = pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+        assert struct.calcsize("@PP") == sizeof(struct_iovec)
+
+    def send(self, sk, packets):
+        n = len(packets)
+        assert n <= self.n
+        data = c_char_p(''.join(packets))
+        addr = cast(data, c_void_p).value
+        lens = [len(pkt) for pkt in packets]
+        fields = []
+        for length in lens:
+            fields.append(addr)
+            fields.append(length)
+            addr += length
+        struct.pack_into("@%dP" % (2 * n), self.iovecs, 0, *fields)
+
+        rv = sendmmsg(sk.fileno(), self.msgs, n, MSG_DONTWAIT)
+        if rv < 0:
+            raise OSError(get_errno(), "sendmmsg failed")
+        return [self.msgs[i].msg_len for i in xrange(rv)]
+
+# SendBatch of UIO_MAXIOV packets, per thread
+_send_batches = threading.local()
+
+def send_batch(sk, packets, timeout=1):
+    """
+    Send packets on an AF_PACKET socket with as few system calls as possible
+
+    Uses sendmmsg with up to UIO_MAXIOV packets per call, reusing its
+    arrays between calls from the same thread.  Waits up to timeout
+    seconds for room in the socket send buffer whenever the kernel
+    accepts only part of the batch.
+    @sk Socket
+    @packets List of packet data strings
+    @retval List of the number of bytes sent for each packet that was sent
+    """
+    n = min(len(packets), UIO_MAXIOV)
+    batch = getattr(_send_batches, "batch", None)
+    if batch is None:
+        batch = _send_batches.batch = SendBatch(UIO_MAXIOV)
+
+    sent = []
+    while len(sent) < len(packets):
+        try:
+            sent.extend(batch.send(sk, packets[len(sent):len(sent) + n]))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                if not select.select([], [sk], [], timeout)[1]:
+                    break
+            elif e.errno != errno.EINTR:
+                raise
+    return sent
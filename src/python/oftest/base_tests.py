@@ -13,6 +13,7 @@ import oftest
 from oftest import config
 import oftest.controller as controller
 import oftest.dataplane as dataplane
+import oftest.testutils as testutils
 import ofp
 
 class BaseTest(unittest.TestCase):
@@ -29,42 +30,103 @@ class BaseTest(unittest.TestCase):
 class SimpleProtocol(BaseTest):
     """
     Root class for setting up the controller
+
+    With config["persistent_controller"] the controller, its connection
+    to the switch and the features_request handshake are kept across
+    tests in oftest.controller_instance.  Each test gets the controller
+    reset (see Controller.reset) and, with config["persistent_reset"],
+    the flow and group tables cleared.  If a test closes the connection
+    the next one connects again.
     """
 
     def setUp(self):
         BaseTest.setUp(self)
 
-        self.controller = controller.Controller(
+        self.controller = None
+        if config["persistent_controller"]:
+            self.controller = self._reuse_controller()
+        if self.controller is None:
+            self.controller = self._start_controller()
+
+        features = self.controller.features
+        if features.version == 1:
+            self.supported_actions = features.actions
+            logging.info("Supported actions: " + hex(self.supported_actions))
+
+        if config["control_pcap"] and config["log_dir"] != None:
+            filename = os.path.join(config["log_dir"], str(self)) + ".ofp.pcap"
+            self.controller.start_pcap(filename)
+
+        if config["persistent_controller"]:
+            oftest.controller_instance = self.controller
+            if config["persistent_reset"]:
+                testutils.delete_all_flows(self.controller)
+                if ofp.OFP_VERSION >= 2:
+                    testutils.delete_all_groups(self.controller)
+
+    def _start_controller(self):
+        """
+        Create a controller, connect to the switch and do the handshake
+        """
+        ctrl = controller.Controller(
             switch=config["switch_ip"],
             host=config["controller_host"],
-            port=config["controller_port"])
-        self.controller.start()
+            port=config["controller_port"],
+            handler_workers=config["handler_workers"])
+        ctrl.start()
 
         try:
             #@todo Add an option to wait for a pkt transaction to ensure version
             # compatibilty?
-            self.controller.connect(timeout=20)
+            ctrl.connect(timeout=20)
 
             # By default, respond to echo requests
-            self.controller.keep_alive = True
+            ctrl.keep_alive = True
 
-            if not self.controller.active:
+            if not ctrl.active:
                 raise Exception("Controller startup failed")
-            if self.controller.switch_addr is None:
+            if ctrl.switch_addr is None:
                 raise Exception("Controller startup failed (no switch addr)")
-            logging.info("Connected " + str(self.controller.switch_addr))
+            logging.info("Connected " + str(ctrl.switch_addr))
             request = ofp.message.features_request()
-            reply, pkt = self.controller.transact(request)
+            reply, pkt = ctrl.transact(request)
             self.assertTrue(reply is not None,
                             "Did not complete features_request for handshake")
-            if reply.version == 1:
-                self.supported_actions = reply.actions
-                logging.info("Supported actions: " + hex(self.supported_actions))
+            ctrl.features = reply
+            ctrl.datapath_id = getattr(reply, "datapath_id", None)
+            if config["echo_interval"]:
+                ctrl.start_echo_prober(interval=config["echo_interval"])
         except:
-            self.controller.kill()
-            del self.controller
+            ctrl.kill()
             raise
 
+        return ctrl
+
+    def _reuse_controller(self):
+        """
+        Take the controller kept by the previous test if still connected
+
+        @returns The reset controller, or None if there was none or its
+        connection did not survive
+        """
+        ctrl = oftest.controller_instance
+        oftest.controller_instance = None
+        if ctrl is None:
+            return None
+
+        if ctrl.active and ctrl.switch_socket and ctrl.is_alive():
+            ctrl.reset()
+            ctrl.keep_alive = True
+            reply, pkt = ctrl.transact(ofp.message.echo_request())
+            if reply is not None:
+                logging.info("Reusing connection to " + str(ctrl.switch_addr))
+                return ctrl
+
+        logging.info("Kept controller lost its connection, reconnecting")
+        ctrl.shutdown()
+        ctrl.join()
+        return None
+
     def inheritSetup(self, parent):
         """
         Inherit the setup of a parent
@@ -86,8 +148,16 @@ class SimpleProtocol(BaseTest):
         self.supported_actions = parent.supported_actions
         
     def tearDown(self):
-        self.controller.shutdown()
-        self.controller.join()
+        self.controller.stop_pcap()
+        logging.info(self.controller.stats_report())
+        kept = oftest.controller_instance is self.controller
+        if kept and not self.controller.switch_socket:
+            # The test closed the connection; the next test reconnects
+            oftest.controller_instance = None
+            kept = False
+        if not kept:
+            self.controller.shutdown()
+            self.controller.join()
         del self.controller
         BaseTest.tearDown(self)
 
@@ -0,0 +1,225 @@
+"""
+Classic BPF filters for dataplane ports
+
+A filter spec is a list of rules separated by commas, checked in order
+against each received frame; the first rule that matches decides whether
+the frame is accepted or dropped.  Frames matching no rule are accepted,
+unless an "only" rule is present.
+
+    drop lldp, drop ipv6 multicast
+    drop ethertype 0x88cc
+    only src 00:06:07:08:09:0a
+    accept ethertype 0x0800, only bytes 12 8100
+
+Each rule is an action followed by a match:
+
+    drop MATCH    drop matching frames
+    accept MATCH  accept matching frames
+    only MATCH    accept matching frames and drop all other frames
+
+A match is one or more of the terms below, all of which must hold:
+
+    ethertype N        outer ethertype (decimal or 0x hex)
+    arp, ipv4, ipv6, lldp, vlan
+                       shorthand for the common ethertypes
+    stp                destination MAC 01:80:c2:00:00:00
+    multicast          group bit of the destination MAC set
+    broadcast          destination MAC ff:ff:ff:ff:ff:ff
+    ipv6 multicast     destination MAC 33:33:xx:xx:xx:xx (includes ND)
+    src MAC, dst MAC   source or destination MAC address
+    bytes OFFSET HEX   the bytes at OFFSET in the frame equal HEX
+
+The program is compiled once and attached to the port socket with
+afpacket.attach_filter, so dropped frames never leave the kernel.
+Frames too short for a load in a rule are dropped by the kernel.  With
+VLAN offload the kernel runs the program on the frame without its VLAN
+tag, so offsets are those of the untagged frame.
+"""
+
+import struct
+
+# Instruction classes and fields from linux/filter.h
+BPF_LD = 0x00
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_AND = 0x50
+BPF_JEQ = 0x10
+BPF_K = 0x00
+
+# Return values
+ACCEPT = 0x40000
+DROP = 0
+
+ETHERTYPES = {
+    "arp": 0x0806,
+    "ipv4": 0x0800,
+    "ipv6": 0x86dd,
+    "lldp": 0x88cc,
+    "vlan": 0x8100,
+}
+
+class FilterError(Exception):
+    pass
+
+def stmt(code, k):
+    return (code, 0, 0, k)
+
+def jump(code, k, jt, jf):
+    return (code, jt, jf, k)
+
+def parse_mac(s):
+    try:
+        octets = [int(x, 16) for x in s.split(":")]
+    except ValueError:
+        raise FilterError("Invalid MAC address %r" % s)
+    if len(octets) != 6 or max(octets) > 0xff:
+        raise FilterError("Invalid MAC address %r" % s)
+    return "".join(chr(x) for x in octets)
+
+def parse_int(s):
+    try:
+        return int(s, 0)
+    except ValueError:
+        raise FilterError("Invalid number %r" % s)
+
+def bytes_tests(offset, data):
+    """
+    Return the tests for data at offset in the frame
+
+    A test is a tuple (size, offset, mask, value) comparing the word,
+    halfword or byte at offset, after masking, to value.
+    """
+    tests = []
+    while data:
+        for (size, fmt, n, mask) in ((BPF_W, "!L", 4, 0xffffffff),
+                                     (BPF_H, "!H", 2, 0xffff),
+                                     (BPF_B, "!B", 1, 0xff)):
+            if len(data) >= n:
+                break
+        tests.append((size, offset, mask, struct.unpack(fmt, data[:n])[0]))
+        (offset, data) = (offset + n, data[n:])
+    return tests
+
+def parse_match(words):
+    """
+    Parse the words of a match into a list of tests
+    """
+    tests = []
+    while words:
+        word = words.pop(0)
+        if word == "ethertype":
+            tests.append((BPF_H, 12, 0xffff, parse_int(words.pop(0))))
+        elif word == "ipv6" and words[:1] == ["multicast"]:
+            words.pop(0)
+            tests += bytes_tests(0, "\x33\x33")
+        elif word in ETHERTYPES:
+            tests.append((BPF_H, 12, 0xffff, ETHERTYPES[word]))
+        elif word == "stp":
+            tests += bytes_tests(0, parse_mac("01:80:c2:00:00:00"))
+        elif word == "multicast":
+            tests.append((BPF_B, 0, 0x01, 0x01))
+        elif word == "broadcast":
+            tests += bytes_tests(0, "\xff" * 6)
+        elif word in ("src", "dst"):
+            offset = 6 if word == "src" else 0
+            tests += bytes_tests(offset, parse_mac(words.pop(0)))
+        elif word == "bytes":
+            offset = parse_int(words.pop(0))
+            try:
+                data = words.pop(0).decode("hex")
+            except TypeError:
+                raise FilterError("Invalid hex string")
+            tests += bytes_tests(offset, data)
+        else:
+            raise FilterError("Unknown filter term %r" % word)
+    if not tests:
+        raise FilterError("Empty match")
+    return tests
+
+def parse(spec):
+    """
+    Parse a filter spec into a list of (action, tests) rules and the
+    action for frames matching no rule
+    """
+    rules = []
+    default = ACCEPT
+    for text in spec.split(","):
+        words = text.lower().split()
+        if not words:
+            continue
+        action = words.pop(0)
+        try:
+            tests = parse_match(words)
+        except IndexError:
+            raise FilterError("Incomplete filter rule %r" % text.strip())
+        if action == "drop":
+            rules.append((DROP, tests))
+        elif action == "accept":
+            rules.append((ACCEPT, tests))
+        elif action == "only":
+            rules.append((ACCEPT, tests))
+            default = DROP
+        else:
+            raise FilterError("Unknown filter action %r" % action)
+    return (rules, default)
+
+def compile(spec):
+    """
+    Compile a filter spec into a classic BPF program
+
+    @param spec Filter spec, see the module documentation
+    @returns List of (code, jt, jf, k) instructions
+    """
+    (rules, default) = parse(spec)
+    insns = []
+    for (action, tests) in rules:
+        block = []
+        for (size, offset, mask, value) in tests:
+            block.append(stmt(BPF_LD | size | BPF_ABS, offset))
+            if mask != {BPF_W: 0xffffffff, BPF_H: 0xffff, BPF_B: 0xff}[size]:
+                block.append(stmt(BPF_ALU | BPF_AND | BPF_K, mask))
+            block.append(jump(BPF_JMP | BPF_JEQ | BPF_K, value, 0, None))
+        block.append(stmt(BPF_RET | BPF_K, action))
+        # A failed compare skips to the first instruction of the next rule
+        for (i, (code, jt, jf, k)) in enumerate(block):
+            if jf is None:
+                jf = len(block) - i - 1
+                if jf > 255:
+                    raise FilterError("Filter rule too long")
+                block[i] = (code, jt, jf, k)
+        insns += block
+    insns.append(stmt(BPF_RET | BPF_K, default))
+    if len(insns) > 4096:
+        raise FilterError("Filter too long")
+    return insns
+
+def run(insns, pkt):
+    """
+    Run a program on a packet in Python and return the BPF result
+
+    Only the instructions generated by compile are supported.  Used to
+    check filters without a socket.
+    """
+    pc = 0
+    a = 0
+    while True:
+        (code, jt, jf, k) = insns[pc]
+        pc += 1
+        if code & 0x07 == BPF_LD:
+            n = {BPF_W: 4, BPF_H: 2, BPF_B: 1}[code & 0x18]
+            if k + n > len(pkt):
+                return DROP
+            a = struct.unpack({4: "!L", 2: "!H", 1: "!B"}[n], pkt[k:k+n])[0]
+        elif code == BPF_ALU | BPF_AND | BPF_K:
+            a &= k
+        elif code == BPF_JMP | BPF_JEQ | BPF_K:
+            pc += jt if a == k else jf
+        elif code == BPF_RET | BPF_K:
+            return k
+        else:
+            raise FilterError("Unsupported instruction 0x%x" % code)
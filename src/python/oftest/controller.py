@@ -13,16 +13,16 @@ The controller thread maintains a queue.  Incoming messages that
 are not handled by a callback function are placed in this queue for 
 poll calls.  
 
-Callbacks and polling support specifying the message type
+Callbacks and polling support specifying the message type.  Transactions
+are matched by xid, and any number of them may be outstanding at once.
 
-@todo Support transaction semantics via xid
 @todo Support select and listen on an administrative socket (or
 use a timeout to support clean shutdown).
 
-Currently only one connection is accepted during the life of
-the controller.   There seems
-to be no clean way to interrupt an accept call.  Using select that also listens
-on an administrative socket and can shut down the socket might work.
+A Controller accepts only one connection during its life.  To drive
+several switches from one process use ControllerServer, which accepts
+any number of connections and creates a Controller session for each
+switch, addressed by datapath id.
 
 """
 
@@ -31,14 +31,19 @@ import os
 import socket
 import time
 import struct
-import select
 import logging
+import contextlib
 from threading import Thread
 from threading import Lock
 from threading import Condition
+from threading import local
+from threading import Event
 
 import ofutils
+from pcap_writer import TcpPcapWriter
+from pcap_writer import AsyncPcapWriter
 import loxi
+import loxi.connection
 
 # Configured openflow version
 import ofp as cfg_ofp
@@ -65,6 +70,530 @@ def hex_dump_buffer(src, length=16):
 ##@todo Find a better home for these identifiers (controller)
 RCV_SIZE_DEFAULT = 32768
 LISTEN_QUEUE_SIZE = 1
+SERVER_LISTEN_QUEUE_SIZE = 64
+
+def listen_socket(host, port, backlog=LISTEN_QUEUE_SIZE):
+    """
+    Create a TCP socket listening on host:port
+    """
+    ai = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                            socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
+    # Use first returned addrinfo
+    (family, socktype, proto, name, sockaddr) = ai[0]
+    soc = socket.socket(family, socktype)
+    soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    soc.bind(sockaddr)
+    soc.listen(backlog)
+    return soc
+
+class ReceivedMessage(object):
+    """
+    A message received from the switch, parsed on first use
+
+    Only the header is decoded by the controller thread.  The loxi object
+    is built when a poller, transaction waiter or handler asks for it and
+    is cached, so messages that are dropped or never looked at cost no
+    parsing.
+
+    @var version OpenFlow version from the header
+    @var type Message type from the header
+    @var xid Transaction id from the header
+    @var raw The raw message bytes
+    """
+    __slots__ = ('version', 'type', 'xid', 'raw', '_msg')
+
+    def __init__(self, version, type, xid, raw):
+        self.version = version
+        self.type = type
+        self.xid = xid
+        self.raw = raw
+        self._msg = None
+
+    def parse(self):
+        """
+        Return the parsed message object, or None if parsing failed
+        """
+        if self._msg is None:
+            try:
+                msg = loxi.protocol(self.version).message.parse_message(self.raw)
+            except (loxi.ProtocolError, ValueError, struct.error):
+                msg = None
+            self._msg = msg or False
+        return self._msg or None
+
+    def class_name(self):
+        """
+        Return the name of the message class without parsing the body
+        """
+        try:
+            ofp = loxi.protocol(self.version)
+        except ValueError:
+            return "unknown"
+        klass = ofp.message.message.subtypes.get(self.type)
+        return klass.__name__ if klass else "unknown"
+
+    def more(self):
+        """
+        Return True if this is a stats reply with OFPSF_REPLY_MORE set
+        """
+        ofp = loxi.protocol(self.version)
+        if self.type != ofp.OFPT_STATS_REPLY or len(self.raw) < 12:
+            return False
+        flags, = struct.unpack_from("!H", self.raw, 10)
+        return (flags & ofp.OFPSF_REPLY_MORE) != 0
+
+# Offset of the match in packet-in messages from OpenFlow 1.2 on
+PACKET_IN_MATCH_OFFSET = {3: 16}
+PACKET_IN_MATCH_OFFSET_DEFAULT = 24
+OXM_IN_PORT = 0x80000004
+
+def packet_in_port(version, data):
+    """
+    Return the in_port of a raw packet-in message without parsing it
+
+    @param version OpenFlow version from the header
+    @param data The raw message, a string or buffer
+    @returns The port number, or None if not found
+    """
+    try:
+        if version == 1:
+            return struct.unpack_from("!H", data, 14)[0]
+        if version == 2:
+            return struct.unpack_from("!L", data, 12)[0]
+
+        # OXM match; in_port is normally the first field
+        offset = PACKET_IN_MATCH_OFFSET.get(version,
+                                            PACKET_IN_MATCH_OFFSET_DEFAULT)
+        match_type, match_len = struct.unpack_from("!HH", data, offset)
+        end = offset + match_len
+        offset += 4
+        while offset + 4 <= end:
+            oxm, = struct.unpack_from("!L", data, offset)
+            if oxm == OXM_IN_PORT:
+                return struct.unpack_from("!L", data, offset + 4)[0]
+            offset += 4 + (oxm & 0xff)
+    except struct.error:
+        pass
+    return None
+
+class TokenBucket(object):
+    """
+    Allows rate events per second on average, and bursts of up to burst
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def take(self, now):
+        """
+        @returns True if an event is allowed at time now
+        """
+        # now may be a little older than a bucket created after it was read
+        if now > self.last:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class PacketInFilter(object):
+    """
+    Drops packet-in messages before they are parsed or queued
+
+    Each check is off unless configured.  A packet-in is kept only if it
+    passes all of them, in this order:
+
+      sample: Keep one in every sample packet-ins
+      port_rate: Token bucket per in_port, port_rate per second with
+      bursts of port_burst
+      rate: Token bucket for all packet-ins, rate per second with bursts
+      of burst
+
+    The Controller attributes filter_packet_in and pkt_in_filter_limit
+    additionally keep only the first packet-ins of each run.
+
+    @var passed Number of packet-ins kept
+    @var dropped Dict from reason ("sample", "port", "rate") to count
+    @var port_dropped Dict from in_port to count dropped by port_rate
+    """
+
+    def __init__(self, rate=None, burst=None, sample=None,
+                 port_rate=None, port_burst=None):
+        self.bucket = rate and TokenBucket(rate, burst)
+        self.sample = sample or 1
+        self.port_rate = port_rate
+        self.port_burst = port_burst
+        self.port_buckets = {}
+        self.seen = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.passed = 0
+        self.dropped = {}
+        self.port_dropped = {}
+
+    def enabled(self):
+        return bool(self.bucket or self.sample > 1 or self.port_rate)
+
+    def check(self, version, data, now):
+        """
+        @returns None to keep the packet-in, or the reason to drop it
+        """
+        self.seen += 1
+        reason = None
+        if (self.seen - 1) % self.sample:
+            reason = "sample"
+        elif self.port_rate:
+            port = packet_in_port(version, data)
+            bucket = self.port_buckets.get(port)
+            if bucket is None:
+                bucket = self.port_buckets[port] = \
+                    TokenBucket(self.port_rate, self.port_burst)
+            if not bucket.take(now):
+                reason = "port"
+                self.port_dropped[port] = self.port_dropped.get(port, 0) + 1
+        if reason is None and self.bucket and not self.bucket.take(now):
+            reason = "rate"
+
+        if reason is None:
+            self.passed += 1
+        else:
+            self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        return reason
+
+class MessageQueue(ofutils.IndexedQueue):
+    """
+    Queue of ReceivedMessage objects indexed by message type and xid
+
+    The oldest message overall, the oldest message of a given type and
+    the oldest message with a given xid can all be found in constant time.
+    """
+
+    TYPE = 0
+    XID = 1
+
+    def __init__(self):
+        ofutils.IndexedQueue.__init__(self, nindexes=2)
+
+    def pop(self, i=0):
+        """
+        Remove and return the oldest (msg, pkt) pair
+
+        For compatibility with code that used the queue as a list.
+        Messages that cannot be parsed are discarded, as in poll.
+        """
+        if i != 0:
+            raise IndexError("can only pop the oldest message")
+        while self.count:
+            rmsg = self.popleft()
+            msg = rmsg.parse()
+            if msg:
+                return (msg, rmsg.raw)
+            logging.getLogger("controller").warn("Could not parse message")
+        raise IndexError("pop from empty queue")
+
+class Transaction(ofutils.Future):
+    """
+    A request sent to the switch that is waiting for its reply
+
+    Transactions are indexed by xid in the controller so any number of
+    them may be outstanding at once.  Each one is a Future with its own
+    condition variable, so completing one transaction only wakes up its
+    waiter, and transactions can be waited on together with other futures
+    using ofutils.wait_all.
+
+    If multipart is set, stats replies with the OFPSF_REPLY_MORE flag are
+    accumulated and the transaction completes on the last part.  Otherwise
+    the first message with a matching xid completes it.
+
+    @var xid The transaction id of the request
+    @var multipart If true, collect all parts of a multipart reply
+    @var msg_type The message type of the request
+    @var start_time When the request was sent
+    @var received List of ReceivedMessage objects for this xid
+    """
+
+    def __init__(self, xid, multipart=False, msg_type=None):
+        ofutils.Future.__init__(self)
+        self.xid = xid
+        self.multipart = multipart
+        self.msg_type = msg_type
+        self.start_time = None
+        self.received = []
+
+    def deliver(self, rmsg):
+        """
+        Add a reply message to the transaction
+
+        Called from the controller thread.
+        @param rmsg A ReceivedMessage
+        @returns True if the transaction is now complete
+        """
+        with self.cv:
+            self.received.append(rmsg)
+            self.cv.notify_all()
+        if not (self.multipart and rmsg.more()):
+            self.set_result(None)
+        return self.done()
+
+    def abort(self):
+        """
+        Complete the transaction without (further) replies
+        """
+        self.cancel()
+
+    def result(self, timeout=-1):
+        """
+        Wait for the transaction and return the first reply
+
+        @returns A (msg, pkt) pair, or (None, None) on timeout
+        """
+        self.wait(timeout=timeout)
+        return self.reply()
+
+    def parts(self, timeout=-1):
+        """
+        Yield each reply as a (msg, pkt) pair as soon as it arrives
+
+        Replies are removed from received once yielded, so a long multipart
+        reply is not held in memory.  The generator ends when the
+        transaction completes or the timeout expires; check done() and
+        cancelled() to tell which.
+
+        @param timeout The timeout in seconds for the whole transaction;
+        if -1 use default.
+        """
+        if timeout == -1:
+            timeout = ofutils.default_timeout
+        end_time = time.time() + timeout
+
+        while True:
+            with self.cv:
+                ofutils.timed_wait(self.cv,
+                                   lambda: (self.received or self._done) or None,
+                                   timeout=max(end_time - time.time(), 0))
+                if not self.received:
+                    return
+                rmsg = self.received.pop(0)
+            yield (rmsg.parse(), rmsg.raw)
+
+    @property
+    def replies(self):
+        """
+        List of (msg, pkt) pairs received for this xid
+        """
+        return [(rmsg.parse(), rmsg.raw) for rmsg in self.received]
+
+    def reply(self):
+        """
+        Return the first reply as a (msg, pkt) pair, or (None, None)
+        """
+        if self.received:
+            rmsg = self.received[0]
+            return (rmsg.parse(), rmsg.raw)
+        return (None, None)
+
+class Expectation(ofutils.Future):
+    """
+    A message a test is waiting for, see Controller.expect
+
+    Completed by the controller thread with a (msg, pkt) pair when a
+    matching message arrives, instead of queueing the message.
+    """
+
+    def __init__(self, msg_type, klass=None, fn=None):
+        ofutils.Future.__init__(self)
+        self.msg_type = msg_type
+        self.klass = klass
+        self.fn = fn
+
+    def match(self, rmsg):
+        if self.klass is None and self.fn is None:
+            return True
+        msg = rmsg.parse()
+        if not msg:
+            return False
+        if self.klass is not None and not isinstance(msg, self.klass):
+            return False
+        return self.fn is None or self.fn(msg)
+
+class Handler(object):
+    """
+    A registered message handler and its latency counters
+
+    The handler may be called from several handler workers at once, so the
+    counters are updated under a lock.
+
+    @var calls Number of times the handler was called
+    @var errors Number of calls that raised an exception
+    @var total_time Total time spent in the handler, in seconds
+    @var max_time Longest single call, in seconds
+    """
+
+    def __init__(self, msg_type, fn):
+        self.msg_type = msg_type
+        self.fn = fn
+        self.lock = Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __call__(self, controller, msg, rawmsg):
+        start = time.time()
+        error = False
+        try:
+            return self.fn(controller, msg, rawmsg)
+        except:
+            error = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.calls += 1
+                self.errors += error
+                self.total_time += elapsed
+                if elapsed > self.max_time:
+                    self.max_time = elapsed
+
+    def name(self):
+        return getattr(self.fn, "__name__", str(self.fn))
+
+    def stats(self):
+        """
+        Return a dict snapshot of the counters
+        """
+        with self.lock:
+            avg = self.calls and self.total_time / self.calls
+            return dict(msg_type=self.msg_type, name=self.name(),
+                        calls=self.calls, errors=self.errors,
+                        avg_time=avg, max_time=self.max_time)
+
+class EchoStats(object):
+    """
+    Counters kept by EchoProber
+
+    @var sent Number of echo requests sent
+    @var received Number of echo replies received in time
+    @var missed Number of echo requests without a reply in time
+    @var rtt Histogram of the round trip times
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sent = 0
+        self.received = 0
+        self.missed = 0
+        self.rtt = ofutils.Histogram()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(sent=self.sent, received=self.received,
+                        missed=self.missed, rtt=self.rtt.snapshot())
+
+    def report(self):
+        stats = self.snapshot()
+        rtt = stats["rtt"]
+        string = "echo sent %d received %d missed %d" % \
+            (stats["sent"], stats["received"], stats["missed"])
+        if rtt["count"]:
+            string += " rtt (ms) avg %.3f p50 %.3f p90 %.3f p99 %.3f max %.3f" % \
+                (rtt["avg"] * 1000, rtt["p50"] * 1000, rtt["p90"] * 1000,
+                 rtt["p99"] * 1000, rtt["max"] * 1000)
+        return string
+
+# Echo statistics of every prober in this run, for the end of run summary
+echo_run_stats = EchoStats()
+
+class EchoProber(Thread):
+    """
+    Measures control channel latency with periodic echo requests
+
+    Every interval seconds an echo request carrying the send time is
+    sent to the switch.  The round trip time is computed from the time
+    echoed back.  A request without a reply within timeout seconds is
+    counted as missed.  Results are recorded both in stats and in the
+    module level echo_run_stats.
+
+    Keep alive echo requests from the switch are answered by the
+    controller thread as before; the prober only adds requests of its own.
+
+    @var stats EchoStats for this prober
+    """
+
+    PAYLOAD = struct.Struct("!d")
+
+    def __init__(self, controller, interval=1.0, timeout=-1):
+        Thread.__init__(self)
+        self.daemon = True
+        self.controller = controller
+        self.interval = interval
+        self.timeout = timeout
+        self.stats = EchoStats()
+        self.stopped = Event()
+        self.logger = controller.logger
+
+    def run(self):
+        timeout = self.timeout
+        if timeout == -1:
+            timeout = ofutils.default_timeout or self.interval
+        outstanding = []
+
+        while not self.stopped.is_set() and self.controller.active:
+            now = time.time()
+            for (trans, deadline) in list(outstanding):
+                if trans.done():
+                    outstanding.remove((trans, deadline))
+                elif now > deadline:
+                    outstanding.remove((trans, deadline))
+                    self.controller.transact_cancel(trans)
+                    self._count("missed")
+
+            if self.controller.switch_socket:
+                msg = cfg_ofp.message.echo_request(
+                    data=self.PAYLOAD.pack(time.time()))
+                try:
+                    trans = self.controller.transact_begin(msg)
+                except Exception, e:
+                    self.logger.debug("Echo prober send failed: %s", e)
+                else:
+                    self._count("sent")
+                    outstanding.append((trans, now + timeout))
+                    trans.add_done_callback(self._reply)
+
+            self.stopped.wait(self.interval)
+
+        for (trans, deadline) in outstanding:
+            self.controller.transact_cancel(trans)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _count(self, name):
+        for stats in (self.stats, echo_run_stats):
+            with stats.lock:
+                setattr(stats, name, getattr(stats, name) + 1)
+
+    def _reply(self, trans):
+        # Runs in the controller thread
+        if trans.cancelled():
+            return
+        msg, _ = trans.reply()
+        try:
+            (sent,) = self.PAYLOAD.unpack(msg.data)
+        except (AttributeError, TypeError, struct.error):
+            self.logger.debug("Echo reply without a timestamp")
+            return
+        rtt = time.time() - sent
+        for stats in (self.stats, echo_run_stats):
+            with stats.lock:
+                stats.received += 1
+                stats.rtt.add(rtt)
 
 class Controller(Thread):
     """
@@ -89,53 +618,95 @@ class Controller(Thread):
     @var initial_hello If true, will send a hello message immediately
     upon connecting to the switch
     @var switch If not None, do an active connection to the switch
+    @var sock If not None, an already accepted connection to the switch
     @var host The host to use for connect
     @var port The port to connect on 
     @var packets_total Total number of packets received
     @var packets_expired Number of packets popped from queue as queue full
     @var packets_handled Number of packets handled by something
+    @var datapath_id Datapath id of the switch, if known
+    @var handler_executor If not None, the OrderedExecutor running handlers
+    @var handlers_dropped Messages queued for pollers without running their
+    handlers because the handler executor was full
+    @var features The features_reply from the handshake, if done
+    @var echo_prober The EchoProber, if started
+    @var pcap_writer The AsyncPcapWriter capturing messages, if started
+    @var default_settings Dict from name to the value at construction of
+    the RESET_SETTINGS attributes
     @var dbg_state Debug indication of state
     """
 
-    def __init__(self, switch=None, host='127.0.0.1', port=6653, max_pkts=1024):
+    # Settings tests may change, restored by reset
+    RESET_SETTINGS = ("keep_alive", "max_pkts", "transact_to",
+                      "filter_packet_in", "pkt_in_filter_limit")
+
+    def __init__(self, switch=None, host='127.0.0.1', port=6653, max_pkts=1024,
+                 sock=None, handler_workers=0):
         Thread.__init__(self)
         # Socket related
         self.rcv_size = RCV_SIZE_DEFAULT
         self.listen_socket = None
         self.switch_socket = None
         self.switch_addr = None
+        self.datapath_id = None
+        self.features = None
+        self.echo_prober = None
+        self.pcap_writer = None
         self.connect_cv = Condition()
         self.message_cv = Condition()
         self.tx_lock = Lock()
+        # Per-thread buffer of packed messages while corked
+        self.tx_local = local()
 
         # Used to wake up the event loop from another thread
         self.waker = ofutils.EventDescriptor()
 
+        # Sockets are registered with the poller when they are created
+        self.poller = ofutils.Poller()
+        self.poller.register(self.waker, edge=True)
+
         # Counters
         self.socket_errors = 0
         self.parse_errors = 0
         self.packets_total = 0
         self.packets_expired = 0
         self.packets_handled = 0
+        self.handlers_dropped = 0
         self.poll_discards = 0
 
+        # Per message type counters, see stats()
+        #   rx_stats, tx_stats: Dict from message type to [count, bytes]
+        #   rtt: Dict from request message type to Histogram of the time
+        #   from sending a transaction to its (last) reply
+        # Set up by reset_stats below
+        self.stats_lock = Lock()
+
         # State
         self.sync = Lock()
+        # Dict from message type to list of Handler; the lists are replaced,
+        # not modified, so the receive thread can walk them without a lock
         self.handlers = {}
+        self.handlers_lock = Lock()
+        self.handler_executor = None
+        if handler_workers:
+            self.handler_executor = ofutils.OrderedExecutor(
+                workers=handler_workers, max_pending=max_pkts,
+                name="controller-handlers")
         self.keep_alive = False
         self.active = True
         self.initial_hello = True
 
-        # OpenFlow message/packet queue
+        # OpenFlow message/packet queue and futures waiting for messages
         # Protected by the packets_cv lock / condition variable
-        self.packets = []
+        self.packets = MessageQueue()
+        self.expectations = {}
         self.packets_cv = Condition()
         self.packet_in_count = 0
 
         # Settings
         self.max_pkts = max_pkts
         self.switch = switch
-        self.passive = not self.switch
+        self.passive = not self.switch and not sock
         self.host = host
         self.port = port
         self.dbg_state = "init"
@@ -144,59 +715,87 @@ class Controller(Thread):
         self.pkt_in_run = 0 # Count on run of packet ins
         self.pkt_in_filter_limit = 50 # Count on run of packet ins
         self.pkt_in_dropped = 0 # Total dropped packet ins
+        self.pkt_in_run_dropped = 0 # Dropped by filter_packet_in
+        self.pkt_in_filter = PacketInFilter() # Rate limits and sampling
+        self.reset_stats()
         self.transact_to = 15 # Transact timeout default value; add to config
 
-        # Transaction and message type waiting variables 
-        #   xid_cv: Condition variable (semaphore) for packet waiters
-        #   xid: Transaction ID being waited on
-        #   xid_response: Transaction response message
+        # Per test settings restored by reset
+        self.default_settings = dict(
+            (name, getattr(self, name)) for name in self.RESET_SETTINGS)
+
+        # Outstanding transactions
+        #   xid_cv: Lock protecting the transaction table
+        #   transactions: Dict from xid to Transaction
         self.xid_cv = Condition()
-        self.xid = None
-        self.xid_response = None
+        self.transactions = {}
 
-        self.buffered_input = ""
+        # Receive buffer holding partial messages between reads
+        self.rx_buffer = loxi.connection.MessageBuffer(self.rcv_size)
 
         # Create listen socket
         if self.passive:
             self.logger.info("Create/listen at " + self.host + ":" +
                              str(self.port))
-            ai = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC,
-                                    socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
-            # Use first returned addrinfo
-            (family, socktype, proto, name, sockaddr) = ai[0]
-            self.listen_socket = socket.socket(family, socktype)
-            self.listen_socket.setsockopt(socket.SOL_SOCKET,
-                                          socket.SO_REUSEADDR, 1)
-            self.listen_socket.bind(sockaddr)
-            self.listen_socket.listen(LISTEN_QUEUE_SIZE)
+            self.listen_socket = listen_socket(self.host, self.port)
+            self.poller.register(self.listen_socket)
+        elif sock:
+            self.switch_socket = sock
+            self.switch_addr = sock.getpeername()
+            self.switch_socket.setsockopt(socket.IPPROTO_TCP,
+                                          socket.TCP_NODELAY, True)
+            self.poller.register(self.switch_socket)
+            if self.initial_hello:
+                self.message_send(cfg_ofp.message.hello())
 
     def filter_packet(self, rawmsg, hdr):
         """
         Check if packet should be filtered
 
-        Currently filters packet in messages
+        Currently filters packet in messages.  A run of packet ins ends at
+        the next message of another type.  With filter_packet_in set, only
+        the first pkt_in_filter_limit packet ins of a run are kept; the
+        remaining ones are subject to pkt_in_filter.  Packet ins are not
+        dropped while an expect() future is waiting for one.
+
+        @param rawmsg The raw message, a string or buffer
+        @param hdr Tuple of (version, type) from the message header
         @return Boolean, True if packet should be dropped
         """
-        # XXX didn't actually check for packet-in...
-        return False
-        # Add check for packet in and rate limit
-        if self.filter_packet_in:
+        (hdr_version, hdr_type) = hdr
+        if hdr_type != loxi.protocol(hdr_version).OFPT_PACKET_IN:
             # If we were dropping packets, report number dropped
-            # TODO dont drop expected packet ins
-            if self.pkt_in_run > self.pkt_in_filter_limit:
+            if self.filter_packet_in and \
+                    self.pkt_in_run > self.pkt_in_filter_limit:
                 self.logger.debug("Dropped %d packet ins (%d total)"
                             % ((self.pkt_in_run - 
                                 self.pkt_in_filter_limit),
                                 self.pkt_in_dropped))
             self.pkt_in_run = 0
+            return False
+
+        self.pkt_in_run += 1
+        if not (self.filter_packet_in or self.pkt_in_filter.enabled()):
+            return False
+        if self.expectations.get(hdr_type):
+            return False
+
+        if self.filter_packet_in and \
+                self.pkt_in_run > self.pkt_in_filter_limit:
+            self.pkt_in_run_dropped += 1
+            drop = True
+        else:
+            drop = self.pkt_in_filter.check(hdr_version, rawmsg,
+                                            time.time()) is not None
+        if drop:
+            self.pkt_in_dropped += 1
+        return drop
 
-        return False
-
-    def _pkt_handle(self, pkt):
+    def _pkt_handle(self, pkt=None):
         """
         Check for all packet handling conditions
 
-        Parse and verify message 
+        Frame messages using only the header; the body is parsed lazily
         Check if XID matches something waiting
         Check if message is being expected for a poll operation
         Check if keep alive is on and message is an echo request
@@ -205,51 +804,49 @@ class Controller(Thread):
 
         an echo request in case keep_alive is true, followed by
         registered message handlers.
-        @param pkt The raw packet (string) which may contain multiple OF msgs
+        @param pkt Optional raw data (string) to append to the receive buffer
+        before processing it.  Usually the data has already been read into
+        the buffer by _socket_ready_handle.
         """
 
-        # snag any left over data from last read()
-        pkt = self.buffered_input + pkt
-        self.buffered_input = ""
-
-        # Process each of the OF msgs inside the pkt
-        offset = 0
-        while offset < len(pkt):
-            if offset + 8 > len(pkt):
-                break
-
-            # Parse the header to get type
-            hdr_version, hdr_type, hdr_length, hdr_xid = cfg_ofp.message.parse_header(pkt[offset:])
+        if pkt:
+            self.rx_buffer.write(pkt)
 
+        # Process each of the complete OF msgs in the receive buffer
+        for (hdr_version, hdr_type, hdr_length, hdr_xid, data) in \
+                self.rx_buffer.messages():
             # Use loxi to resolve to ofp of matching version
             ofp = loxi.protocol(hdr_version)
 
-            # Extract the raw message bytes
-            if (offset + hdr_length) > len(pkt):
-                break
-            rawmsg = pkt[offset : offset + hdr_length]
-            offset += hdr_length
+            with self.stats_lock:
+                counts = self.rx_stats.setdefault(hdr_type, [0, 0])
+                counts[0] += 1
+                counts[1] += hdr_length
 
-            #if self.filter_packet(rawmsg, hdr):
-            #    continue
+            pcap_writer = self.pcap_writer
+            if pcap_writer:
+                pcap_writer.write(data[:], time.time(), False)
 
-            msg = ofp.message.parse_message(rawmsg)
-            if not msg:
-                self.parse_errors += 1
-                self.logger.warn("Could not parse message")
+            if self.filter_packet(data, (hdr_version, hdr_type)):
                 continue
 
+            # Copy the raw message bytes out of the receive buffer
+            rawmsg = data[:]
+
+            rmsg = ReceivedMessage(hdr_version, hdr_type, hdr_xid, rawmsg)
+
             self.logger.debug("Msg in: version %d class %s len %d xid %d",
-                              hdr_version, type(msg).__name__, hdr_length, hdr_xid)
+                              hdr_version, rmsg.class_name(), hdr_length, hdr_xid)
 
             with self.sync:
                 # Check if transaction is waiting
                 with self.xid_cv:
-                    if self.xid and hdr_xid == self.xid:
+                    trans = self.transactions.get(hdr_xid)
+                    if trans:
                         self.logger.debug("Matched expected XID " + str(hdr_xid))
-                        self.xid_response = (msg, rawmsg)
-                        self.xid = None
-                        self.xid_cv.notify()
+                        if trans.deliver(rmsg):
+                            del self.transactions[hdr_xid]
+                            self._rtt_add(trans)
                         continue
 
                 # Check if keep alive is set; if so, respond to echo requests
@@ -263,63 +860,126 @@ class Controller(Thread):
                         continue
 
                 # Generalize to counters for all packet types?
-                if msg.type == ofp.OFPT_PACKET_IN:
+                if hdr_type == ofp.OFPT_PACKET_IN:
                     self.packet_in_count += 1
 
                 # Log error messages
-                if isinstance(msg, ofp.message.error_msg):
-                    #pylint: disable=E1103
-                    if msg.err_type in ofp.ofp_error_type_map:
-                        type_str = ofp.ofp_error_type_map[msg.err_type]
-                        if msg.err_type == ofp.OFPET_HELLO_FAILED:
-                            code_map = ofp.ofp_hello_failed_code_map
-                        elif msg.err_type == ofp.OFPET_BAD_REQUEST:
-                            code_map = ofp.ofp_bad_request_code_map
-                        elif msg.err_type == ofp.OFPET_BAD_ACTION:
-                            code_map = ofp.ofp_bad_action_code_map
-                        elif msg.err_type == ofp.OFPET_FLOW_MOD_FAILED:
-                            code_map = ofp.ofp_flow_mod_failed_code_map
-                        elif msg.err_type == ofp.OFPET_PORT_MOD_FAILED:
-                            code_map = ofp.ofp_port_mod_failed_code_map
-                        elif msg.err_type == ofp.OFPET_QUEUE_OP_FAILED:
-                            code_map = ofp.ofp_queue_op_failed_code_map
-                        else:
-                            code_map = None
-
-                        if code_map and msg.code in code_map:
-                            code_str = code_map[msg.code]
-                        else:
-                            code_str = "unknown"
-                    else:
-                        type_str = "unknown"
-                        code_str = "unknown"
-                    self.logger.warn("Received error message: xid=%d type=%s (%d) code=%s (%d)",
-                                     hdr_xid, type_str, msg.err_type, code_str, msg.code)
+                if hdr_type == ofp.OFPT_ERROR:
+                    self._log_error(rmsg)
 
                 # Now check for message handlers; preference is given to
                 # handlers for a specific packet
                 handled = False
-                if hdr_type in self.handlers.keys():
-                    handled = self.handlers[hdr_type](self, msg, rawmsg)
-                if not handled and ("all" in self.handlers.keys()):
-                    handled = self.handlers["all"](self, msg, rawmsg)
-
-                if not handled: # Not handled, enqueue
-                    with self.packets_cv:
-                        if len(self.packets) >= self.max_pkts:
-                            self.packets.pop(0)
-                            self.packets_expired += 1
-                        self.packets.append((msg, rawmsg))
-                        self.packets_cv.notify_all()
-                    self.packets_total += 1
-                else:
-                    self.packets_handled += 1
-                    self.logger.debug("Message handled by callback")
+                if hdr_type in self.handlers or "all" in self.handlers:
+                    msg = rmsg.parse()
+                    if not msg:
+                        self.parse_errors += 1
+                        self.logger.warn("Could not parse message")
+                        continue
+                    if self.handler_executor:
+                        # The receive thread must never block on the
+                        # workers, since a handler may be waiting for a
+                        # reply that only this thread can deliver
+                        if self.handler_executor.submit(
+                                hdr_type, self._handle_deferred, rmsg, msg,
+                                block=False):
+                            continue
+                        self.handlers_dropped += 1
+                        self.logger.warn("Handler queue full, queueing message for pollers")
+                    else:
+                        handled = self._handle(hdr_type, msg, rawmsg)
+
+                self._queue_message(rmsg, handled)
+
+    def _handle(self, msg_type, msg, rawmsg):
+        """
+        Call the handlers for msg_type, then the "all" handlers if none of
+        them handled the message
+
+        @returns True if a handler handled the message
+        """
+        return self._dispatch(msg_type, msg, rawmsg) or \
+            self._dispatch("all", msg, rawmsg)
+
+    def _handle_deferred(self, rmsg, msg):
+        """
+        Run the handlers for a message on a handler worker
+
+        Same as the inline path, including queueing the message for
+        pollers if no handler handled it.  Messages of one type are
+        handled in order, but may be queued for pollers after later
+        messages of other types.
+        """
+        handled = self._handle(rmsg.type, msg, rmsg.raw)
+        self._queue_message(rmsg, handled)
+
+    def _queue_message(self, rmsg, handled):
+        """
+        Queue a message for pollers unless it was handled
+        """
+        with self.packets_cv:
+            if not handled:
+                handled = self._expectation_handle(rmsg)
+            if not handled:
+                if len(self.packets) >= self.max_pkts:
+                    self.packets.popleft()
+                    self.packets_expired += 1
+                self.packets.append(rmsg, rmsg.type, rmsg.xid)
+                if len(self.packets) > self.packets_high_water:
+                    self.packets_high_water = len(self.packets)
+                self.packets_cv.notify_all()
+                self.packets_total += 1
+            else:
+                self.packets_handled += 1
+                self.logger.debug("Message handled by callback")
+
+    def _dispatch(self, msg_type, msg, rawmsg):
+        """
+        Call the handlers registered for msg_type
+
+        @returns True if a handler handled the message
+        """
+        handled = False
+        for handler in self.handlers.get(msg_type, []):
+            if handler(self, msg, rawmsg):
+                handled = True
+        return handled
+
+    def _log_error(self, rmsg):
+        """
+        Log an error message received from the switch
+        """
+        msg = rmsg.parse()
+        if not msg:
+            return
+        ofp = loxi.protocol(rmsg.version)
+        #pylint: disable=E1103
+        if msg.err_type in ofp.ofp_error_type_map:
+            type_str = ofp.ofp_error_type_map[msg.err_type]
+            if msg.err_type == ofp.OFPET_HELLO_FAILED:
+                code_map = ofp.ofp_hello_failed_code_map
+            elif msg.err_type == ofp.OFPET_BAD_REQUEST:
+                code_map = ofp.ofp_bad_request_code_map
+            elif msg.err_type == ofp.OFPET_BAD_ACTION:
+                code_map = ofp.ofp_bad_action_code_map
+            elif msg.err_type == ofp.OFPET_FLOW_MOD_FAILED:
+                code_map = ofp.ofp_flow_mod_failed_code_map
+            elif msg.err_type == ofp.OFPET_PORT_MOD_FAILED:
+                code_map = ofp.ofp_port_mod_failed_code_map
+            elif msg.err_type == ofp.OFPET_QUEUE_OP_FAILED:
+                code_map = ofp.ofp_queue_op_failed_code_map
+            else:
+                code_map = None
 
-        # end of 'while offset < len(pkt)'
-        #   note that if offset = len(pkt), this is
-        #   appends a harmless empty string
-        self.buffered_input += pkt[offset:]
+            if code_map and msg.code in code_map:
+                code_str = code_map[msg.code]
+            else:
+                code_str = "unknown"
+        else:
+            type_str = "unknown"
+            code_str = "unknown"
+        self.logger.warn("Received error message: xid=%d type=%s (%d) code=%s (%d)",
+                         rmsg.xid, type_str, msg.err_type, code_str, msg.code)
 
     def _socket_ready_handle(self, s):
         """
@@ -347,17 +1007,19 @@ class Controller(Thread):
                 (self.switch_socket, self.switch_addr) = (sock, addr)
                 self.switch_socket.setsockopt(socket.IPPROTO_TCP,
                                               socket.TCP_NODELAY, True)
+                self.poller.register(self.switch_socket)
                 if self.initial_hello:
                     self.message_send(cfg_ofp.message.hello())
                 self.connect_cv.notify() # Notify anyone waiting
 
             # Prevent further connections
+            self.poller.unregister(self.listen_socket)
             self.listen_socket.close()
             self.listen_socket = None
         elif s and s == self.switch_socket:
             for idx in range(3): # debug: try a couple of times
                 try:
-                    pkt = self.switch_socket.recv(self.rcv_size)
+                    count = self.rx_buffer.recv_into(self.switch_socket)
                 except:
                     self.logger.warning("Error on switch read")
                     return -1
@@ -365,17 +1027,21 @@ class Controller(Thread):
                 if not self.active:
                     return 0
       
-                if len(pkt) == 0:
+                if count == 0:
                     self.logger.warning("Zero-length switch read, %d" % idx)
                 else:
                     break
 
-            if len(pkt) == 0: # Still no packet
+            if count == 0: # Still no packet
                 self.logger.warning("Zero-length switch read; closing cxn")
                 self.logger.info(str(self))
                 return -1
 
-            self._pkt_handle(pkt)
+            try:
+                self._pkt_handle()
+            except loxi.ProtocolError, e:
+                self.logger.error("Framing error on switch connection: %s", e)
+                return -1
         elif s and s == self.waker:
             self.waker.wait()
         else:
@@ -410,7 +1076,7 @@ class Controller(Thread):
 
     def sockets(self):
         """
-        Return list of sockets to select on.
+        Return list of sockets the event loop is watching.
         """
         socs = [self.listen_socket, self.switch_socket, self.waker]
         return [x for x in socs if x]
@@ -434,12 +1100,12 @@ class Controller(Thread):
 
         while self.active:
             try:
-                sel_in, sel_out, sel_err = \
-                    select.select(self.sockets(), [], self.sockets(), 1)
+                sel_in, sel_err = self.poller.poll(1)
             except:
                 print sys.exc_info()
                 self.logger.error("Select error, disconnecting")
                 self.disconnect()
+                continue
 
             for s in sel_err:
                 self.logger.error("Got socket error on: " + str(s) + ", disconnecting")
@@ -453,6 +1119,7 @@ class Controller(Thread):
         self.dbg_state = "closing"
         self.logger.info("Exiting controller thread")
         self.shutdown()
+        self.poller.close()
 
     def connect(self, timeout=-1):
         """
@@ -462,7 +1129,7 @@ class Controller(Thread):
         @return Boolean, True if connected
         """
 
-        if not self.passive:  # Do active connection now
+        if self.switch:  # Do active connection now
             self.logger.info("Attempting to connect to %s on port %s" %
                              (self.switch, str(self.port)))
             soc = self.active_connect()
@@ -470,6 +1137,7 @@ class Controller(Thread):
                 self.logger.info("Connected to %s", self.switch)
                 self.dbg_state = "running"
                 self.switch_socket = soc
+                self.poller.register(soc)
                 self.wakeup()
                 with self.connect_cv:
                     if self.initial_hello:
@@ -491,11 +1159,13 @@ class Controller(Thread):
         If connected to a switch, disconnect.
         """
         if self.switch_socket:
+            self.poller.unregister(self.switch_socket)
             self.switch_socket.close()
             self.switch_socket = None
             self.switch_addr = None
+            self.rx_buffer.clear()
             with self.packets_cv:
-                self.packets = []
+                self.packets.clear()
             with self.connect_cv:
                 self.connect_cv.notifyAll()
 
@@ -516,8 +1186,12 @@ class Controller(Thread):
         Force the controller thread to quit
         """
         self.active = False
+        if self.echo_prober:
+            self.echo_prober.stop()
         self.wakeup()
         self.join()
+        if self.echo_prober:
+            self.echo_prober.join()
 
     def shutdown(self):
         """
@@ -527,6 +1201,10 @@ class Controller(Thread):
         """
 
         self.active = False
+        if self.echo_prober:
+            self.echo_prober.stop()
+        self.poller.unregister(self.switch_socket)
+        self.poller.unregister(self.listen_socket)
         try:
             self.switch_socket.shutdown(socket.SHUT_RDWR)
         except:
@@ -541,11 +1219,20 @@ class Controller(Thread):
 
         # Wakeup condition variables on which controller may be wait
         with self.xid_cv:
+            for trans in self.transactions.values():
+                trans.abort()
+            self.transactions = {}
             self.xid_cv.notifyAll()
 
         with self.connect_cv:
             self.connect_cv.notifyAll()
 
+        # Handlers already queued still run
+        if self.handler_executor:
+            self.handler_executor.shutdown()
+
+        self.stop_pcap()
+
         self.wakeup()
         self.dbg_state = "down"
 
@@ -553,24 +1240,97 @@ class Controller(Thread):
         """
         Register a callback to receive a specific message type.
 
-        Only one handler may be registered for a given message type.
+        Replaces any handlers already registered for the message type;
+        use add_handler to register more than one.
 
-        WARNING:  A lock is held during the handler call back, so 
-        the handler should not make any blocking calls
+        WARNING:  Unless the controller was created with handler_workers,
+        a lock is held during the handler call back on the receive thread,
+        so the handler should not make any blocking calls
 
         @param msg_type The type of message to receive.  May be DEFAULT 
         for all non-handled packets.  The special type, the string "all"
         will send all packets to the handler.
         @param handler The function to call when a message of the given 
-        type is received.
+        type is received.  If None, remove the handlers for the type.
         """
         # Should check type is valid
-        if not handler and msg_type in self.handlers.keys():
-            del self.handlers[msg_type]
-            return
-        self.handlers[msg_type] = handler
+        with self.handlers_lock:
+            if not handler:
+                self.handlers.pop(msg_type, None)
+                return
+            self.handlers[msg_type] = [Handler(msg_type, handler)]
 
-    def poll(self, exp_msg=None, timeout=-1):
+    def add_handler(self, msg_type, handler):
+        """
+        Register a callback in addition to those already registered
+
+        Handlers for a type are called in registration order.  When run
+        inline, the message counts as handled if any of them returns True.
+        """
+        with self.handlers_lock:
+            handlers = self.handlers.get(msg_type, [])
+            self.handlers[msg_type] = handlers + [Handler(msg_type, handler)]
+
+    def remove_handler(self, msg_type, handler):
+        """
+        Remove a callback added with register or add_handler
+        """
+        with self.handlers_lock:
+            handlers = [h for h in self.handlers.get(msg_type, [])
+                        if h.fn != handler]
+            if handlers:
+                self.handlers[msg_type] = handlers
+            else:
+                self.handlers.pop(msg_type, None)
+
+    def clear_handlers(self):
+        """
+        Remove all registered callbacks
+        """
+        with self.handlers_lock:
+            self.handlers = {}
+
+    def wait_handlers(self, timeout=-1):
+        """
+        Wait until handler calls queued on the handler executor finish
+
+        @returns True if no handler calls are outstanding
+        """
+        if not self.handler_executor:
+            return True
+        return self.handler_executor.drain(timeout=timeout)
+
+    def handler_stats(self):
+        """
+        Return the latency counters of the registered handlers
+
+        @returns List of dicts as returned by Handler.stats, slowest
+        total time first
+        """
+        handlers = [h for hs in self.handlers.values() for h in hs]
+        handlers.sort(key=lambda h: h.total_time, reverse=True)
+        return [h.stats() for h in handlers]
+
+    def _exp_msg_class(self, exp_msg):
+        """
+        Resolve an exp_msg argument to (class, message type, exact)
+
+        exact is True if every message of the type is an instance of the
+        class, so the class does not need to be checked.
+        """
+        if exp_msg is None:
+            return (None, None, True)
+        elif isinstance(exp_msg, int):
+            return (cfg_ofp.message.message.subtypes[exp_msg], exp_msg, True)
+        elif issubclass(exp_msg, loxi.OFObject):
+            msg_type = getattr(exp_msg, "type", None)
+            exact = msg_type is not None and \
+                exp_msg is cfg_ofp.message.message.subtypes.get(msg_type)
+            return (exp_msg, msg_type, exact)
+        else:
+            raise ValueError("Unexpected exp_msg argument %r" % exp_msg)
+
+    def poll(self, exp_msg=None, timeout=-1, xid=None):
         """
         Wait for the next OF message received from the switch.
 
@@ -580,6 +1340,8 @@ class Controller(Thread):
         @param timeout Maximum number of seconds to wait for the message.
         Pass -1 for the default timeout.
 
+        @param xid If set, return only a message with this transaction id.
+
         @retval A pair (msg, pkt) where msg is a message object and pkt
         the string representing the packet as received from the socket.
         This allows additional parsing by the receiver if necessary.
@@ -588,28 +1350,46 @@ class Controller(Thread):
         If an error occurs, (None, None) is returned
         """
 
-        if exp_msg is None:
+        if exp_msg is None and xid is None:
             self.logger.warn("DEPRECATED polling for any message class")
-            klass = None
-        elif isinstance(exp_msg, int):
-            klass = cfg_ofp.message.message.subtypes[exp_msg]
-        elif issubclass(exp_msg, loxi.OFObject):
-            klass = exp_msg
-        else:
-            raise ValueError("Unexpected exp_msg argument %r" % exp_msg)
+
+        (klass, msg_type, exact) = self._exp_msg_class(exp_msg)
 
         if klass is not None:
             self.logger.debug("Polling for %s", klass.__name__)
 
+        # Only check the class if the type does not determine it
+        if exact:
+            match = None
+            if msg_type is not None and xid is not None:
+                match = lambda rmsg: rmsg.type == msg_type
+        else:
+            match = lambda rmsg: isinstance(rmsg.parse(), klass)
+
+        if xid is not None:
+            (index, key) = (MessageQueue.XID, xid)
+        elif msg_type is not None:
+            (index, key) = (MessageQueue.TYPE, msg_type)
+        else:
+            (index, key) = (None, None)
+
         # Take the packet from the queue
         def grab():
-            for i, (msg, pkt) in enumerate(self.packets):
-                if klass is None or isinstance(msg, klass):
-                    self.logger.debug("Got %s message", msg.__class__.__name__)
-                    return self.packets.pop(i)
-            # Not found
-            self.logger.debug("%s message not in queue", klass.__name__)
-            return None
+            while True:
+                entry = self.packets.find(match, index, key)
+                if entry is None:
+                    self.logger.debug("%s message not in queue",
+                                      klass.__name__ if klass else "Any")
+                    return None
+                self.packets.remove(entry)
+                rmsg = entry.value
+                msg = rmsg.parse()
+                if not msg:
+                    self.parse_errors += 1
+                    self.logger.warn("Could not parse message")
+                    continue
+                self.logger.debug("Got %s message", msg.__class__.__name__)
+                return (msg, rmsg.raw)
 
         with self.packets_cv:
             ret = ofutils.timed_wait(self.packets_cv, grab, timeout=timeout)
@@ -620,49 +1400,209 @@ class Controller(Thread):
         else:
             return (None, None)
 
-    def transact(self, msg, timeout=-1):
+    def expect(self, exp_msg, fn=None):
         """
-        Run a message transaction with the switch
+        Return a Future for the next message of the given type
+
+        Unlike poll this does not block.  The future completes with a
+        (msg, pkt) pair when a matching message is received (or at once if
+        one is already queued), and the message is then not queued.  Use
+        ofutils.wait_all to wait for many expectations, from the controller
+        and the dataplane, with a single deadline.  Cancel the future to
+        stop waiting.
+
+        @param exp_msg Message type or class to wait for
+        @param fn If not None, only messages for which fn(msg) is true match
+        @returns An Expectation
+        """
+        (klass, msg_type, exact) = self._exp_msg_class(exp_msg)
+        if msg_type is None:
+            raise ValueError("Unexpected exp_msg argument %r" % exp_msg)
 
-        Send the message in msg and wait for a reply with a matching
-        transaction id.  Transactions have the highest priority in
-        received message handling.
+        exp = Expectation(msg_type, None if exact else klass, fn)
+
+        with self.packets_cv:
+            entry = self.packets.find(exp.match, MessageQueue.TYPE, msg_type)
+            if entry is not None:
+                self.packets.remove(entry)
+                exp.set_result((entry.value.parse(), entry.value.raw))
+            else:
+                self.expectations.setdefault(msg_type, []).append(exp)
+
+        return exp
+
+    def _expectation_handle(self, rmsg):
+        """
+        Complete the oldest expectation matching a received message
+
+        Called with packets_cv held.
+        @returns True if the message was consumed
+        """
+        exps = self.expectations.get(rmsg.type)
+        if not exps:
+            return False
+
+        consumed = False
+        for exp in list(exps):
+            if exp.done():
+                exps.remove(exp) # Cancelled
+            elif exp.match(rmsg):
+                exps.remove(exp)
+                consumed = exp.set_result((rmsg.parse(), rmsg.raw))
+                if consumed:
+                    break
+
+        if not exps:
+            del self.expectations[rmsg.type]
+        return consumed
+
+    def stream(self, exp_msg, timeout=-1):
+        """
+        Yield messages of the given type as they arrive
+
+        The timeout covers the whole stream rather than each message:
+
+            for (msg, pkt) in ctrl.stream(ofp.OFPT_PACKET_IN, timeout=5):
+                ...
+
+        @param exp_msg Message type or class to wait for
+        @param timeout Seconds until the stream ends; -1 for the default
+        """
+        if timeout == -1:
+            timeout = ofutils.default_timeout
+        end_time = time.time() + timeout
+
+        while True:
+            (msg, pkt) = self.poll(exp_msg, timeout=max(end_time - time.time(), 0))
+            if msg is None:
+                return
+            yield (msg, pkt)
+
+    def transact_begin(self, msg, multipart=False):
+        """
+        Send a request and register it as an outstanding transaction
+
+        Does not wait for the reply, so many transactions may be in flight
+        at once.  Use Transaction.wait (or transact_end) to collect the
+        reply.
 
         @param msg The message object to send; must not be a string
-        @param timeout The timeout in seconds; if -1 use default.
+        @param multipart If true, collect every part of a multipart reply
+        @returns The Transaction object
         """
 
         if msg.xid == None:
             msg.xid = ofutils.gen_xid()
 
-        self.logger.debug("Running transaction %d" % msg.xid)
+        trans = Transaction(msg.xid, multipart=multipart, msg_type=msg.type)
 
         with self.xid_cv:
-            if self.xid:
-                self.logger.error("Can only run one transaction at a time")
-                return (None, None)
+            if msg.xid in self.transactions:
+                raise ValueError("Transaction %d already outstanding" % msg.xid)
+            self.transactions[msg.xid] = trans
+            if len(self.transactions) > self.transactions_high_water:
+                self.transactions_high_water = len(self.transactions)
 
-            self.xid = msg.xid
-            self.xid_response = None
+        self.logger.debug("Running transaction %d" % msg.xid)
+        trans.start_time = time.time()
+        try:
             self.message_send(msg)
+        except:
+            self.transact_cancel(trans)
+            raise
 
-            self.logger.debug("Waiting for transaction %d" % msg.xid)
-            ofutils.timed_wait(self.xid_cv, lambda: self.xid_response, timeout=timeout)
+        return trans
 
-            if self.xid_response:
-                (resp, pkt) = self.xid_response
-                self.xid_response = None
-            else:
-                (resp, pkt) = (None, None)
+    def transact_cancel(self, trans):
+        """
+        Stop waiting for a transaction
+
+        Any reply that arrives later is queued like an unsolicited message.
+        """
+        with self.xid_cv:
+            if self.transactions.get(trans.xid) is trans:
+                del self.transactions[trans.xid]
+        trans.abort()
+
+    def transact_end(self, trans, timeout=-1):
+        """
+        Wait for an outstanding transaction to complete
+
+        @param trans A Transaction returned by transact_begin
+        @param timeout The timeout in seconds; if -1 use default.
+        @returns The first reply as a (msg, pkt) pair, or (None, None)
+        """
+        self.flush()
+        self.logger.debug("Waiting for transaction %d" % trans.xid)
+        if not trans.wait(timeout=timeout):
+            self.transact_cancel(trans)
 
+        (resp, pkt) = trans.reply()
         if resp is None:
-            self.logger.warning("No response for xid " + str(self.xid))
+            self.logger.warning("No response for xid " + str(trans.xid))
         return (resp, pkt)
 
+    def transact(self, msg, timeout=-1):
+        """
+        Run a message transaction with the switch
+
+        Send the message in msg and wait for a reply with a matching
+        transaction id.  Transactions have the highest priority in
+        received message handling.  Other threads may run transactions
+        concurrently.
+
+        @param msg The message object to send; must not be a string
+        @param timeout The timeout in seconds; if -1 use default.
+        """
+
+        trans = self.transact_begin(msg)
+        return self.transact_end(trans, timeout=timeout)
+
+    def transact_many(self, msgs, timeout=-1, multipart=False):
+        """
+        Run several transactions with the switch in parallel
+
+        All requests are sent in a single write before waiting for any
+        reply, so the total time is about one round trip rather than one
+        per request.
+
+        @param msgs List of message objects to send
+        @param timeout The timeout in seconds for all replies; if -1 use
+        default.
+        @param multipart If true, collect every part of multipart replies
+        @returns List of Transaction objects in the same order as msgs
+        """
+
+        if timeout == -1:
+            timeout = ofutils.default_timeout
+        end_time = time.time() + timeout
+
+        transactions = []
+        try:
+            with self.corked():
+                for msg in msgs:
+                    transactions.append(
+                        self.transact_begin(msg, multipart=multipart))
+        except:
+            # Don't leave the transactions that did start in the table
+            for trans in transactions:
+                self.transact_cancel(trans)
+            raise
+
+        for trans in transactions:
+            remaining = max(end_time - time.time(), 0)
+            if not trans.wait(timeout=remaining):
+                self.transact_cancel(trans)
+                self.logger.warning("No response for xid " + str(trans.xid))
+
+        return transactions
+
     def message_send(self, msg):
         """
         Send the message to the switch
 
+        If the calling thread is corked the message is only buffered.
+
         @param msg A string or OpenFlow message object to be forwarded to
         the switch.
         """
@@ -671,30 +1611,276 @@ class Controller(Thread):
             # Sending a string indicates the message is ready to go
             raise Exception("no socket")
 
+        self._send_data(self._pack(msg))
+
+        return 0 # for backwards compatibility
+
+    def message_send_many(self, msgs):
+        """
+        Send a list of messages to the switch with a single write
+
+        Assigns an xid to any message that does not have one.
+
+        @param msgs List of OpenFlow message objects
+        """
+
+        if not self.switch_socket:
+            raise Exception("no socket")
+
+        self._send_data(''.join([self._pack(msg) for msg in msgs]))
+
+        return 0 # for backwards compatibility
+
+    @contextlib.contextmanager
+    def corked(self):
+        """
+        Coalesce messages sent by this thread into one write
+
+        Within the with block, message_send and message_send_many from the
+        calling thread only buffer the packed messages.  They are written
+        to the switch together when the block exits.  Other threads (such
+        as the echo reply in the controller thread) are not affected.
+
+        transact_end flushes the buffer before waiting, so a transaction
+        may be started and waited on inside the block.
+        """
+        if getattr(self.tx_local, "cork", None) is not None:
+            # Nested, the outermost block flushes
+            yield
+            return
+
+        self.tx_local.cork = []
+        try:
+            yield
+        finally:
+            try:
+                self.flush()
+            finally:
+                self.tx_local.cork = None
+
+    def flush(self):
+        """
+        Write out any messages buffered by this thread while corked
+        """
+        cork = getattr(self.tx_local, "cork", None)
+        if cork:
+            data = ''.join(cork)
+            del cork[:]
+            self._send_raw(data)
+
+    def _pack(self, msg):
         if msg.xid == None:
             msg.xid = ofutils.gen_xid()
 
         outpkt = msg.pack()
 
+        with self.stats_lock:
+            counts = self.tx_stats.setdefault(msg.type, [0, 0])
+            counts[0] += 1
+            counts[1] += len(outpkt)
+
         self.logger.debug("Msg out: version %d class %s len %d xid %d",
                           msg.version, type(msg).__name__, len(outpkt), msg.xid)
+        return outpkt
+
+    def _send_data(self, data):
+        cork = getattr(self.tx_local, "cork", None)
+        if cork is not None:
+            cork.append(data)
+        else:
+            self._send_raw(data)
+
+    def _send_raw(self, data):
+        if not self.switch_socket:
+            raise Exception("no socket")
 
         with self.tx_lock:
-            if self.switch_socket.sendall(outpkt) is not None:
+            if self.switch_socket.sendall(data) is not None:
                 raise AssertionError("failed to send message to switch")
+            pcap_writer = self.pcap_writer
+            if pcap_writer:
+                pcap_writer.write(data, time.time(), True)
 
-        return 0 # for backwards compatibility
+    def start_pcap(self, filename, max_queue=10000):
+        """
+        Capture control channel messages to a pcap file
+
+        Messages are written as a synthetic TCP stream between the
+        controller and switch addresses, which Wireshark decodes as
+        OpenFlow.  The file is written by a background thread; if more
+        than max_queue messages are pending the excess is dropped and
+        counted in pcap_writer.dropped.
+        """
+        assert(self.pcap_writer == None)
+        local_addr = (self.host, self.port)
+        if self.switch_socket:
+            try:
+                local_addr = self.switch_socket.getsockname()
+            except socket.error:
+                pass
+        self.pcap_writer = AsyncPcapWriter(
+            TcpPcapWriter(filename, local_addr, self.switch_addr),
+            max_queue=max_queue)
+
+    def stop_pcap(self):
+        """
+        Finish writing the control channel capture
+        """
+        pcap_writer = self.pcap_writer
+        if pcap_writer:
+            self.pcap_writer = None
+            pcap_writer.close()
 
     def clear_queue(self):
         """
         Clear the input queue and report the number of messages
         that were in it
         """
-        enqueued_pkt_count = len(self.packets)
         with self.packets_cv:
-            self.packets = []
+            enqueued_pkt_count = len(self.packets)
+            self.packets.clear()
         return enqueued_pkt_count
 
+    def reset(self):
+        """
+        Restore the per test state of a controller kept across tests
+
+        Aborts outstanding transactions, cancels expect() futures, removes
+        the handlers, empties the receive queue, restores the settings in
+        RESET_SETTINGS to their values at construction, resets the packet-in
+        filter and the current run of packet-ins, and resets the per type
+        counters.  The connection to the
+        switch is left alone.
+        """
+        with self.xid_cv:
+            for trans in self.transactions.values():
+                trans.abort()
+            self.transactions = {}
+
+        self.clear_handlers()
+        self.wait_handlers()
+
+        with self.packets_cv:
+            for exps in self.expectations.values():
+                for exp in exps:
+                    exp.cancel()
+            self.expectations = {}
+            self.packets.clear()
+
+        for (name, value) in self.default_settings.items():
+            setattr(self, name, value)
+        self.pkt_in_run = 0
+        self.pkt_in_run_dropped = 0
+        self.pkt_in_filter = PacketInFilter()
+        self.reset_stats()
+
+    def start_echo_prober(self, interval=1.0, timeout=-1):
+        """
+        Start measuring control channel latency, see EchoProber
+
+        @param interval Seconds between echo requests
+        @param timeout Seconds before an echo request counts as missed;
+        if -1 use default.
+        @returns The EchoProber
+        """
+        if self.echo_prober:
+            self.echo_prober.stop()
+        self.echo_prober = EchoProber(self, interval=interval, timeout=timeout)
+        self.echo_prober.start()
+        return self.echo_prober
+
+    def reset_stats(self):
+        """
+        Reset the counters reported by stats()
+        """
+        if self.echo_prober:
+            self.echo_prober.stats = EchoStats()
+        with self.stats_lock:
+            self.rx_stats = {}
+            self.tx_stats = {}
+            self.rtt = {}
+            self.packets_high_water = 0
+            self.transactions_high_water = 0
+            self.pkt_in_dropped = 0
+            self.pkt_in_run_dropped = 0
+            self.pkt_in_filter.reset_counters()
+
+    def _rtt_add(self, trans):
+        if trans.start_time is None:
+            return
+        rtt = time.time() - trans.start_time
+        with self.stats_lock:
+            hist = self.rtt.get(trans.msg_type)
+            if hist is None:
+                hist = self.rtt[trans.msg_type] = ofutils.Histogram()
+            hist.add(rtt)
+
+    def stats(self):
+        """
+        Return a snapshot of the per message type counters
+
+        Message types are given by name, e.g. "OFPT_PACKET_IN".
+
+        @returns A dict with:
+          rx, tx: Dict from type to dict(count, bytes)
+          rtt: Dict from request type to a Histogram snapshot of the
+          round trip times of completed transactions, in seconds
+          packets_high_water: Largest receive queue depth seen
+          transactions_high_water: Most transactions outstanding at once
+          pkt_in_dropped: Dict from reason to packet ins dropped by
+          filter_packet; "run" for filter_packet_in
+          echo: EchoStats snapshot, if the echo prober is running
+        """
+        type_map = cfg_ofp.const.ofp_type_map
+        name = lambda t: type_map.get(t, str(t))
+        counts = lambda d: dict((name(t), dict(count=c[0], bytes=c[1]))
+                                for (t, c) in d.items())
+        with self.stats_lock:
+            return dict(rx=counts(self.rx_stats),
+                        tx=counts(self.tx_stats),
+                        rtt=dict((name(t), h.snapshot())
+                                 for (t, h) in self.rtt.items()),
+                        packets_high_water=self.packets_high_water,
+                        transactions_high_water=self.transactions_high_water,
+                        pkt_in_dropped=self._pkt_in_dropped_reasons(),
+                        echo=self.echo_prober and
+                             self.echo_prober.stats.snapshot())
+
+    def _pkt_in_dropped_reasons(self):
+        reasons = dict(self.pkt_in_filter.dropped)
+        if self.pkt_in_run_dropped:
+            reasons["run"] = self.pkt_in_run_dropped
+        return reasons
+
+    def stats_report(self):
+        """
+        Format stats() as a table for the log
+        """
+        stats = self.stats()
+        string = "Controller stats:\n"
+        string += "  %-28s %8s %10s %8s %10s\n" % \
+            ("type", "rx", "rx bytes", "tx", "tx bytes")
+        for t in sorted(set(stats["rx"]) | set(stats["tx"])):
+            rx = stats["rx"].get(t, dict(count=0, bytes=0))
+            tx = stats["tx"].get(t, dict(count=0, bytes=0))
+            string += "  %-28s %8d %10d %8d %10d\n" % \
+                (t, rx["count"], rx["bytes"], tx["count"], tx["bytes"])
+        if stats["rtt"]:
+            string += "  %-28s %8s %10s %10s %10s %10s\n" % \
+                ("rtt (ms)", "count", "avg", "p50", "p99", "max")
+        for t, rtt in sorted(stats["rtt"].items()):
+            string += "  %-28s %8d %10.3f %10.3f %10.3f %10.3f\n" % \
+                (t, rtt["count"], rtt["avg"] * 1000, rtt["p50"] * 1000,
+                 rtt["p99"] * 1000, rtt["max"] * 1000)
+        string += "  packets high water      %d\n" % stats["packets_high_water"]
+        string += "  transactions high water %d\n" % \
+            stats["transactions_high_water"]
+        for reason, count in sorted(stats["pkt_in_dropped"].items()):
+            string += "  packet ins dropped (%s) %d\n" % (reason, count)
+        if self.echo_prober:
+            string += "  " + self.echo_prober.stats.report() + "\n"
+        return string
+
     def __str__(self):
         string = "Controller:\n"
         string += "  state           " + self.dbg_state + "\n"
@@ -703,6 +1889,7 @@ class Controller(Thread):
         string += "  total pkts      " + str(self.packets_total) + "\n"
         string += "  expired pkts    " + str(self.packets_expired) + "\n"
         string += "  handled pkts    " + str(self.packets_handled) + "\n"
+        string += "  handler drops   " + str(self.handlers_dropped) + "\n"
         string += "  poll discards   " + str(self.poll_discards) + "\n"
         string += "  parse errors    " + str(self.parse_errors) + "\n"
         string += "  sock errrors    " + str(self.socket_errors) + "\n"
@@ -713,11 +1900,192 @@ class Controller(Thread):
         string += "  keep_alive      " + str(self.keep_alive) + "\n"
         string += "  pkt_in_run      " + str(self.pkt_in_run) + "\n"
         string += "  pkt_in_dropped  " + str(self.pkt_in_dropped) + "\n"
+        for stats in self.handler_stats():
+            string += "  handler %-16s %s calls %d avg %.6f max %.6f\n" % \
+                (stats["name"], str(stats["msg_type"]), stats["calls"],
+                 stats["avg_time"], stats["max_time"])
         return string
 
     def show(self):
         print str(self)
 
+class ControllerServer(Thread):
+    """
+    Passive controller accepting connections from many switches
+
+    Every accepted connection gets its own Controller session, with its
+    own message queue, transaction table and counters.  The server does a
+    features_request handshake on each new connection and files the
+    session under the datapath id of the switch.  If a switch reconnects
+    the old session is killed and replaced.
+
+    @var sessions Dict from datapath id to Controller
+    @var pending Set of sessions still doing the handshake
+    @var keep_alive Value of keep_alive for new sessions
+    @var max_pkts Value of max_pkts for new sessions
+    @var handler_workers Value of handler_workers for new sessions
+    """
+
+    def __init__(self, host='0.0.0.0', port=6653, max_pkts=1024,
+                 handshake_timeout=-1, handler_workers=0):
+        Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.max_pkts = max_pkts
+        self.handler_workers = handler_workers
+        self.handshake_timeout = handshake_timeout
+        self.keep_alive = True
+        self.active = True
+        self.logger = logging.getLogger("controller")
+
+        self.sessions = {}
+        self.pending = set()
+        self.sessions_cv = Condition()
+
+        self.waker = ofutils.EventDescriptor()
+        self.poller = ofutils.Poller()
+        self.poller.register(self.waker, edge=True)
+
+        self.logger.info("Create/listen at %s:%d for multiple switches",
+                         self.host, self.port)
+        self.listen_socket = listen_socket(self.host, self.port,
+                                           SERVER_LISTEN_QUEUE_SIZE)
+        self.poller.register(self.listen_socket)
+
+    def run(self):
+        """
+        Accept connections until killed
+        """
+        while self.active:
+            try:
+                sel_in, sel_err = self.poller.poll(1)
+            except:
+                self.logger.error("Select error on listen socket")
+                continue
+
+            for s in sel_in:
+                if s == self.waker:
+                    self.waker.wait()
+                elif s == self.listen_socket:
+                    self._accept()
+
+        self.logger.info("Exiting controller server thread")
+        self.poller.close()
+        self.listen_socket.close()
+
+    def _accept(self):
+        try:
+            (sock, addr) = self.listen_socket.accept()
+        except socket.error, e:
+            self.logger.warning("Error on listen socket accept: %s", e)
+            return
+        self.logger.info("%s:%d: Incoming connection from %s",
+                         self.host, self.port, str(addr))
+
+        session = Controller(max_pkts=self.max_pkts, sock=sock,
+                             handler_workers=self.handler_workers)
+        session.keep_alive = self.keep_alive
+        session.start()
+
+        with self.sessions_cv:
+            if not self.active:
+                session.kill()
+                return
+            self.pending.add(session)
+
+        # Don't hold up other connections while the switch answers
+        handshake = Thread(target=self._handshake, args=(session,))
+        handshake.daemon = True
+        handshake.start()
+
+    def _handshake(self, session):
+        request = cfg_ofp.message.features_request()
+        reply, _ = session.transact(request, timeout=self.handshake_timeout)
+        if reply is None or not hasattr(reply, "datapath_id"):
+            self.logger.error("No features_reply from %s, closing",
+                              str(session.switch_addr))
+            with self.sessions_cv:
+                self.pending.discard(session)
+            session.kill()
+            return
+
+        dpid = reply.datapath_id
+        session.datapath_id = dpid
+        session.features = reply
+        self.logger.info("Switch %s connected with datapath id %#x",
+                         str(session.switch_addr), dpid)
+
+        with self.sessions_cv:
+            self.pending.discard(session)
+            if self.active:
+                old = self.sessions.get(dpid)
+                self.sessions[dpid] = session
+                self.sessions_cv.notify_all()
+            else:
+                # Killed during the handshake
+                old = session
+
+        if old is session:
+            session.kill()
+        elif old:
+            self.logger.info("Replacing previous session for %#x", dpid)
+            old.kill()
+
+    def session(self, dpid, timeout=-1):
+        """
+        Return the session for a datapath id
+
+        @param dpid Datapath id of the switch
+        @param timeout Wait up to this many seconds for the switch to
+        connect; -1 for the default
+        @returns A Controller, or None on timeout
+        """
+        with self.sessions_cv:
+            return ofutils.timed_wait(self.sessions_cv,
+                                      lambda: self.sessions.get(dpid),
+                                      timeout=timeout)
+
+    def wait_sessions(self, count, timeout=-1):
+        """
+        Wait until at least count switches have connected
+
+        @returns Dict from datapath id to Controller, or None on timeout
+        """
+        with self.sessions_cv:
+            return ofutils.timed_wait(self.sessions_cv,
+                lambda: dict(self.sessions) if len(self.sessions) >= count else None,
+                timeout=timeout)
+
+    def kill(self):
+        """
+        Stop accepting connections and kill all sessions, including
+        those still doing the handshake
+        """
+        with self.sessions_cv:
+            self.active = False
+        self.waker.notify()
+        self.join()
+        with self.sessions_cv:
+            sessions = self.sessions.values() + list(self.pending)
+            self.sessions = {}
+            self.pending = set()
+        for session in sessions:
+            session.kill()
+
+    def __str__(self):
+        string = "ControllerServer:\n"
+        string += "  host            " + str(self.host) + "\n"
+        string += "  port            " + str(self.port) + "\n"
+        with self.sessions_cv:
+            sessions = sorted(self.sessions.items())
+            pending = len(self.pending)
+        for (dpid, session) in sessions:
+            string += "  %#018x %s\n" % (dpid, str(session.switch_addr))
+        if pending:
+            string += "  handshaking     " + str(pending) + "\n"
+        return string
+
 def sample_handler(controller, msg, pkt):
     """
     Sample message handler
@@ -18,13 +18,16 @@ import sys
 import os
 import socket
 import time
-import select
 import logging
 from threading import Thread
 from threading import Lock
 from threading import Condition
+from threading import Event
+from collections import deque
+from collections import OrderedDict
 import ofutils
 import netutils
+import bpf
 from pcap_writer import PcapWriter
 
 if "linux" in sys.platform:
@@ -46,6 +49,228 @@ def match_exp_pkt(exp_pkt, pkt):
     return e == p
 
 
+# Flow keys for count-only mode, as lists of (offset, length) byte ranges.
+# The offsets assume untagged Ethernet and IPv4 without options.
+FLOW_KEYS = {
+    "mac": [(0, 12)],
+    "eth": [(0, 14)],
+    "ipv4": [(26, 8)],
+    "ipv4_5tuple": [(23, 1), (26, 12)],
+}
+
+def flow_key_function(key):
+    """
+    Return a function computing the flow key of a packet
+
+    @param key None for no flow key, a function of the packet data, a
+    name from FLOW_KEYS, or a list of (offset, length) byte ranges
+    """
+    if key is None or callable(key):
+        return key
+    ranges = FLOW_KEYS.get(key, key)
+    if len(ranges) == 1:
+        ((offset, length),) = ranges
+        return lambda pkt: pkt[offset:offset+length]
+    return lambda pkt: "".join([pkt[offset:offset+length]
+                                for (offset, length) in ranges])
+
+class RxCounters(object):
+    """
+    Receive counters for a port in count-only mode
+
+    @var packets Packets received
+    @var bytes Bytes received
+    @var flows dict from flow key to packets received
+    """
+
+    def __init__(self, key=None):
+        self.packets = 0
+        self.bytes = 0
+        self.flows = {}
+        self.key = flow_key_function(key)
+
+    def add(self, pkts):
+        """
+        Count a list of (packet, timestamp) pairs
+        """
+        self.packets += len(pkts)
+        for (pkt, timestamp) in pkts:
+            self.bytes += len(pkt)
+        if self.key:
+            flows = self.flows
+            key = self.key
+            for (pkt, timestamp) in pkts:
+                k = key(pkt)
+                flows[k] = flows.get(k, 0) + 1
+
+    def snapshot(self):
+        return dict(packets=self.packets, bytes=self.bytes,
+                    flows=dict(self.flows))
+
+class PacketExpectation(ofutils.Future):
+    """
+    A packet a test is waiting for, see DataPlane.expect
+
+    Completed by the dataplane thread with a (port number, packet, time)
+    triple when a matching packet arrives.
+    """
+
+    def __init__(self, port_number, exp_pkt):
+        ofutils.Future.__init__(self)
+        self.port_number = port_number
+        self.exp_pkt = str(exp_pkt)
+
+    def match(self, pkt):
+        return match_exp_pkt(self.exp_pkt, pkt)
+
+class Verification(object):
+    """
+    Outcome of checking many ports at once, see DataPlane.verify
+
+    @var positive List of (port number, packet) that must be received
+    @var negative List of (port number, packet) that must not be received
+    @var no_other If true, no other packets may be received
+    @var received List of (port number, packet, time) for each positive
+    expectation, or None if it was not received
+    @var unexpected List of (port number, packet, time) received that
+    matched a negative expectation
+    @var other List of (port number, packet, time) still queued at the end
+    of the window, if no_other is set; they are removed from the queue
+    """
+
+    def __init__(self, positive, negative, no_other):
+        self.positive = [(port_number, str(pkt)) for (port_number, pkt) in positive]
+        self.negative = [(port_number, str(pkt)) for (port_number, pkt) in negative]
+        self.no_other = no_other
+        self.received = [None] * len(self.positive)
+        self.unexpected = []
+        self.other = []
+
+    def missing(self):
+        """
+        Return the (port number, packet) positive expectations not received
+        """
+        return [exp for (exp, ret) in zip(self.positive, self.received)
+                if ret is None]
+
+    def ok(self):
+        return not self.missing() and not self.unexpected and not self.other
+
+class PacketQueue(ofutils.IndexedQueue):
+    """
+    Queue of received (port number, packet, time) triples indexed by port
+    and by packet contents
+
+    The oldest packet on any port and the oldest packet on a given port
+    can both be found in constant time, and so can the oldest packet
+    matching an expected packet (see match_exp_pkt).
+
+    Packets are indexed by their first MIN_LEN bytes, which finds the
+    packets equal to an expected packet of at least that length.  Shorter
+    expected packets match any packet they are a prefix of, so an index
+    on the first L bytes is built the first time an expected packet of
+    length L is looked up, and kept up to date from then on.
+    """
+
+    PORT = 0
+    PREFIX = 1
+
+    # Minimum Ethernet frame size, see match_exp_pkt
+    MIN_LEN = 60
+
+    def __init__(self):
+        ofutils.IndexedQueue.__init__(self, nindexes=2)
+
+    def clear(self):
+        ofutils.IndexedQueue.clear(self)
+        # dict from prefix length to dict from prefix to [deque, live count]
+        self.short_indexes = {}
+
+    def add(self, port_number, pkt, timestamp):
+        entry = self.append((port_number, pkt, timestamp),
+                            port_number, pkt[:self.MIN_LEN])
+        for (length, index) in self.short_indexes.items():
+            self._short_add(index, pkt[:length], entry)
+        return entry
+
+    def remove(self, entry):
+        if not entry.live:
+            return
+        ofutils.IndexedQueue.remove(self, entry)
+        pkt = entry.value[1]
+        for (length, index) in self.short_indexes.items():
+            key = pkt[:length]
+            bucket = index[key]
+            bucket[1] -= 1
+            if bucket[1] == 0:
+                del index[key]
+            else:
+                self._compact(bucket[0], bucket[1])
+
+    def port_count(self, port_number):
+        return self.key_count(self.PORT, port_number)
+
+    def port_entries(self, port_number=None):
+        """
+        Iterate over the queued entries for a port, or all ports if None
+        """
+        if port_number is None:
+            return self.entries()
+        return self.entries(self.PORT, port_number)
+
+    def port_popleft(self, port_number=None):
+        """
+        Remove and return the oldest triple for a port, or any port if None
+        """
+        if port_number is None:
+            return self.popleft()
+        return self.popleft(self.PORT, port_number)
+
+    def find_packet(self, exp_pkt, port_number=None):
+        """
+        Return the oldest entry matching an expected packet
+
+        @param exp_pkt The expected packet, compared as in match_exp_pkt
+        @param port_number If not None, only consider this port
+        @returns A QueueEntry or None
+        """
+        e = str(exp_pkt)
+        if len(e) >= self.MIN_LEN:
+            candidates = self.entries(self.PREFIX, e[:self.MIN_LEN])
+        else:
+            candidates = self._short_entries(e)
+        for entry in candidates:
+            (rcv_port_number, pkt, time) = entry.value
+            if port_number is not None and rcv_port_number != port_number:
+                continue
+            if len(e) < self.MIN_LEN or pkt == e:
+                return entry
+        return None
+
+    def _short_entries(self, prefix):
+        index = self.short_indexes.get(len(prefix))
+        if index is None:
+            index = self.short_indexes[len(prefix)] = {}
+            for entry in self.entries():
+                self._short_add(index, entry.value[1][:len(prefix)], entry)
+        bucket = index.get(prefix)
+        if bucket is None:
+            return
+        dq = bucket[0]
+        while dq and not dq[0].live:
+            dq.popleft()
+        for entry in dq:
+            if entry.live:
+                yield entry
+
+    @staticmethod
+    def _short_add(index, key, entry):
+        bucket = index.get(key)
+        if bucket is None:
+            bucket = index[key] = [deque(), 0]
+        bucket[0].append(entry)
+        bucket[1] += 1
+
 class DataPlanePortLinux:
     """
     Uses raw sockets to capture and send packets on a network interface.
@@ -54,6 +279,8 @@ class DataPlanePortLinux:
     RCV_SIZE_DEFAULT = 4096
     ETH_P_ALL = 0x03
     RCV_TIMEOUT = 10000
+    RCV_BATCH = 64
+    RCV_BATCH_MAX = 1024
 
     def __init__(self, interface_name, port_number):
         """
@@ -61,10 +288,18 @@ class DataPlanePortLinux:
         """
         self.interface_name = interface_name
         self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
-        afpacket.enable_auxdata(self.socket)
+        self.setup_socket()
         self.socket.bind((interface_name, self.ETH_P_ALL))
         netutils.set_promisc(self.socket, interface_name)
         self.socket.settimeout(self.RCV_TIMEOUT)
+        self.tx_next_id = 0
+
+    def setup_socket(self):
+        """
+        Set up the receive side of the socket before it is bound.
+        """
+        afpacket.enable_auxdata(self.socket)
+        afpacket.enable_timestamps(self.socket)
 
     def __del__(self):
         if self.socket:
@@ -79,10 +314,27 @@ class DataPlanePortLinux:
     def recv(self):
         """
         Receive a packet from this port.
-        @retval (packet data, timestamp)
+        @retval (packet data, kernel timestamp)
         """
-        pkt = afpacket.recv(self.socket, self.RCV_SIZE_DEFAULT)
-        return (pkt, time.time())
+        (pkt, timestamp) = afpacket.recv_timestamped(self.socket,
+                                                     self.RCV_SIZE_DEFAULT)
+        return (pkt, timestamp or time.time())
+
+    def recv_batch(self):
+        """
+        Receive the packets waiting on this port, RCV_BATCH per system call
+
+        Stops after RCV_BATCH_MAX packets so other ports get their turn.
+        @retval List of (packet data, kernel timestamp)
+        """
+        pkts = []
+        while len(pkts) < self.RCV_BATCH_MAX:
+            batch = afpacket.recv_batch(self.socket, self.RCV_BATCH,
+                                        self.RCV_SIZE_DEFAULT)
+            pkts.extend(batch)
+            if len(batch) < self.RCV_BATCH:
+                break
+        return pkts
 
     def send(self, packet):
         """
@@ -90,7 +342,52 @@ class DataPlanePortLinux:
         @param packet The packet data to send to the port
         @retval The number of bytes sent
         """
-        return self.socket.send(packet)
+        bytes = self.socket.send(packet)
+        self.tx_next_id += 1
+        return bytes
+
+    def send_batch(self, packets):
+        """
+        Send many packets out this port with few system calls.
+        @param packets List of packet data to send to the port
+        @retval List of the number of bytes sent for each packet sent
+        """
+        sent = afpacket.send_batch(self.socket, packets)
+        self.tx_next_id += len(sent)
+        return sent
+
+    def enable_tx_timestamps(self):
+        """
+        Have the kernel timestamp sent packets.
+
+        Sent packets are numbered from tx_next_id, which restarts at 0.
+        """
+        afpacket.enable_tx_timestamps(self.socket)
+        self.tx_next_id = 0
+
+    def recv_tx_timestamps(self):
+        """
+        Read the kernel tx timestamps.
+        @retval List of (packet number, timestamp)
+        """
+        return afpacket.recv_tx_timestamps(self.socket)
+
+    def clear_error(self):
+        """
+        Read and clear the pending socket error.
+        @retval The errno value, or 0 if there was none
+        """
+        return self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+    def set_filter(self, insns):
+        """
+        Filter received frames in the kernel.
+        @param insns BPF program from bpf.compile, or None to remove it
+        """
+        if insns is None:
+            afpacket.detach_filter(self.socket)
+        else:
+            afpacket.attach_filter(self.socket, insns)
 
     def down(self):
         """
@@ -105,6 +402,55 @@ class DataPlanePortLinux:
         os.system("ifconfig up %s" % self.interface_name)
 
 
+class DataPlanePortLinuxMmap(DataPlanePortLinux):
+    """
+    Linux port receiving through a TPACKET_V3 memory mapped ring
+
+    The kernel fills blocks of packets in a ring shared with this process,
+    so a whole block is read per wakeup without copying each packet
+    through a system call.  Timestamps are the kernel receive times.
+    Sending is the same as DataPlanePortLinux.
+
+    Select it with config["dataplane"]["portclass"].
+    """
+
+    def setup_socket(self):
+        """
+        Set up the receive ring, which must be done before binding.
+        """
+        self.ring = None
+        self.pending = []
+        self.ring = afpacket.RxRing(self.socket)
+
+    def __del__(self):
+        if self.ring:
+            self.ring.close()
+        if self.socket:
+            self.socket.close()
+
+    def recv_batch(self):
+        """
+        Receive the packets waiting in the ring
+
+        Stops after the block that reaches RCV_BATCH_MAX packets so other
+        ports get their turn.
+        @retval List of (packet data, timestamp)
+        """
+        pkts = self.pending + self.ring.recv_batch(self.RCV_BATCH_MAX)
+        self.pending = []
+        return pkts
+
+    def recv(self):
+        """
+        Receive a packet from this port.
+        @retval (packet data, timestamp), or (None, None) if there is none
+        """
+        if not self.pending:
+            self.pending = self.ring.recv_batch(self.RCV_BATCH_MAX)
+        if not self.pending:
+            return (None, None)
+        return self.pending.pop(0)
+
 class DataPlanePortPcap:
     """
     Alternate port implementation using libpcap. This is used by non-Linux
@@ -134,6 +480,165 @@ class DataPlanePortPcap:
     def up(self):
         pass
 
+class TrafficGenerator(Thread):
+    """
+    Sends packets on a dataplane port at a target rate
+
+    Pacing uses a token bucket refilled at the target rate.  While the
+    bucket is short of the next packet the thread sleeps until SPIN
+    seconds before it is due and then busy-waits, since sleeps overshoot
+    by much more than that.  When the bucket allows several packets (after
+    a late wakeup, or at rates above one packet per wakeup) they are sent
+    as one burst with DataPlane.send_burst, up to MAX_BURST packets.
+
+    Each packet is due when the bucket first held enough tokens for it;
+    the error between the actual send time and the due time is recorded
+    for the jitter and lateness figures in stats.
+
+    @var sent Packets sent so far
+    @var bytes Bytes sent so far
+    """
+
+    SPIN = 0.0002
+    MAX_BURST = 64
+
+    def __init__(self, dataplane, port_number, packets, pps=None, mbps=None,
+                 duration=None, count=None, burst=None):
+        """
+        @param dataplane The DataPlane to send on
+        @param port_number The port to send on
+        @param packets A packet, or a list of packets sent in rotation
+        @param pps Target rate in packets per second
+        @param mbps Target rate in megabits per second (Ethernet frame
+        bytes without preamble, FCS or interframe gap); give exactly one
+        of pps and mbps
+        @param duration If not None, stop after this many seconds
+        @param count If not None, stop after sending this many packets
+        @param burst Bucket depth in packets, how far the generator may
+        catch up after falling behind.  By default a millisecond's worth,
+        and at least 8 packets.
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        if (pps is None) == (mbps is None):
+            raise ValueError("Exactly one of pps and mbps must be given")
+        if not isinstance(packets, (list, tuple)):
+            packets = [packets]
+        self.dataplane = dataplane
+        self.port_number = port_number
+        self.packets = [str(packet) for packet in packets]
+        if pps is not None:
+            self.rate = float(pps)
+            self.costs = [1] * len(self.packets)
+        else:
+            self.rate = mbps * 1e6
+            self.costs = [len(packet) * 8 for packet in self.packets]
+        if burst is None:
+            self.depth = max(8 * max(self.costs), self.rate * 0.001)
+        else:
+            self.depth = burst * max(self.costs)
+        self.target_pps = pps
+        self.target_mbps = mbps
+        self.duration = duration
+        self.count = count
+        self.stopped = Event()
+
+        self.sent = 0
+        self.bytes = 0
+        self.start_time = None
+        self.end_time = None
+        self.lateness = ofutils.Histogram()
+        self.error_sum = 0.0
+        self.error_sumsq = 0.0
+
+    def run(self):
+        n = len(self.packets)
+        now = last = self.start_time = time.time()
+        # The first packet is due at once
+        tokens = self.costs[0]
+        i = 0
+        while not self.stopped.is_set():
+            if self.count is not None and self.sent >= self.count:
+                break
+            if self.duration is not None and now - self.start_time >= self.duration:
+                break
+
+            tokens = min(self.depth, tokens + (now - last) * self.rate)
+            last = now
+
+            batch = []
+            dues = []
+            while len(batch) < self.MAX_BURST and \
+                    (self.count is None or self.sent + len(batch) < self.count):
+                cost = self.costs[i % n]
+                if tokens < cost:
+                    break
+                tokens -= cost
+                batch.append(self.packets[i % n])
+                # The bucket held enough for this packet tokens / rate ago
+                dues.append(now - tokens / self.rate)
+                i += 1
+
+            if not batch:
+                wait = (self.costs[i % n] - tokens) / self.rate
+                if wait > self.SPIN:
+                    time.sleep(wait - self.SPIN)
+                now = time.time()
+                continue
+
+            sent = self.dataplane._port_send_burst(self.port_number, batch)
+            now = time.time()
+            for (packet, due) in zip(batch[:sent], dues):
+                error = now - due
+                self.lateness.add(error)
+                self.error_sum += error
+                self.error_sumsq += error * error
+                self.bytes += len(packet)
+            self.sent += sent
+
+        self.end_time = time.time()
+
+    def stop(self):
+        self.stopped.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the generator to finish
+        @returns The stats
+        """
+        self.join(timeout)
+        return self.stats()
+
+    def stats(self):
+        """
+        Return a dict of the rate achieved so far
+
+        jitter is the standard deviation of the send time error, and
+        lateness a Histogram snapshot of how late packets were sent.
+        """
+        elapsed = (self.end_time or time.time()) - (self.start_time or time.time())
+        if self.sent:
+            mean = self.error_sum / self.sent
+            jitter = max(self.error_sumsq / self.sent - mean * mean, 0) ** 0.5
+        else:
+            jitter = None
+        return dict(sent=self.sent, bytes=self.bytes, elapsed=elapsed,
+                    pps=elapsed and self.sent / elapsed or 0.0,
+                    mbps=elapsed and self.bytes * 8 / elapsed / 1e6 or 0.0,
+                    target_pps=self.target_pps, target_mbps=self.target_mbps,
+                    jitter=jitter, lateness=self.lateness.snapshot())
+
+    def report(self):
+        """
+        Return the stats as a one line string
+        """
+        stats = self.stats()
+        return "port %d: %d packets in %.3fs, %.0f pps, %.2f Mbps, jitter %s, p99 lateness %s" % (
+            self.port_number, stats["sent"], stats["elapsed"], stats["pps"],
+            stats["mbps"],
+            "%.1fus" % (stats["jitter"] * 1e6) if stats["jitter"] is not None else "-",
+            "%.1fus" % (stats["lateness"]["p99"] * 1e6) if stats["sent"] else "-")
+
 class DataPlane(Thread):
     """
     This class provides methods to send and receive packets on the dataplane.
@@ -144,6 +649,7 @@ class DataPlane(Thread):
     """
 
     MAX_QUEUE_LEN = 100
+    MAX_TX_TIMESTAMPS = 1024
 
     def __init__(self, config=None):
         Thread.__init__(self)
@@ -151,8 +657,28 @@ class DataPlane(Thread):
         # dict from port number to port object
         self.ports = {}
 
-        # dict from port number to list of (timestamp, packet)
-        self.packet_queues = {}
+        # Received packets from all ports in arrival order
+        self.packet_queue = PacketQueue()
+
+        # dicts from port number to packets and bytes sent
+        self.tx_packets = {}
+        self.tx_bytes = {}
+
+        # Running TrafficGenerators
+        self.generators = []
+
+        # Ports in count-only mode, and dict from port number to the
+        # RxCounters of its last count-only period
+        self.counting = set()
+        self.rx_counters = {}
+
+        # dict from port number to an ordered dict from packet number to
+        # kernel tx timestamp, for ports with tx timestamps enabled
+        self.tx_timestamps = {}
+
+        # dict from port number (or None for any port) to list of
+        # PacketExpectation
+        self.expectations = {}
 
         # cvar serves double duty as a regular top level lock and
         # as a condition variable
@@ -162,6 +688,10 @@ class DataPlane(Thread):
         self.waker = ofutils.EventDescriptor()
         self.killed = False
 
+        # Ports are registered with the poller as they are added
+        self.poller = ofutils.Poller()
+        self.poller.register(self.waker, edge=True)
+
         self.logger = logging.getLogger("dataplane")
         self.pcap_writer = None
 
@@ -180,8 +710,17 @@ class DataPlane(Thread):
         # where MyDataPlanePortClass has the same interface as the class
         # DataPlanePort defined here. 
         #
+        # The port class may also be given by name, e.g. from the
+        # --port-class option, as "DataPlanePortLinuxMmap".
+        #
+        # config.dataplane.filter is a receive filter spec (see the bpf
+        # module) attached to every port, and config.dataplane.port_filters
+        # a dict from port number to a filter spec for that port.
+        #
         if "dataplane" in self.config and "portclass" in self.config["dataplane"]:
             self.dppclass = self.config["dataplane"]["portclass"]
+            if isinstance(self.dppclass, str):
+                self.dppclass = globals()[self.dppclass]
         elif "linux" in sys.platform:
             self.dppclass = DataPlanePortLinux
         else:
@@ -194,37 +733,101 @@ class DataPlane(Thread):
         Activity function for class
         """
         while not self.killed:
-            sockets = [self.waker] + self.ports.values()
             try:
-                sel_in, sel_out, sel_err = select.select(sockets, [], [], 1)
+                sel_in, sel_err = self.poller.poll(1)
             except:
                 print sys.exc_info()
                 self.logger.error("Select error, exiting")
                 break
 
             with self.cvar:
+                for port in sel_err:
+                    # Queued tx timestamps are reported as an error
+                    if port._port_number in self.tx_timestamps:
+                        self._tx_timestamps_handle(port)
+                    # A pending socket error, e.g. ENETDOWN after a link
+                    # flap, keeps the port polling until it is read, and
+                    # hides any input
+                    if hasattr(port, "clear_error"):
+                        err = port.clear_error()
+                        if err:
+                            self.logger.warning("Error on port %d: %s",
+                                                port._port_number,
+                                                os.strerror(err))
+                    sel_in.append(port)
                 for port in sel_in:
                     if port == self.waker:
                         self.waker.wait()
                         continue
-                    else:
-                        # Enqueue packet
-                        pkt, timestamp = port.recv()
-                        port_number = port._port_number
-                        self.logger.debug("Pkt len %d in on port %d",
-                                          len(pkt), port_number)
-                        if self.pcap_writer:
-                            self.pcap_writer.write(pkt, timestamp, port_number)
-                        queue = self.packet_queues[port_number]
-                        if len(queue) >= self.MAX_QUEUE_LEN:
-                            # Queue full, throw away oldest
-                            queue.pop(0)
-                            self.logger.debug("Discarding oldest packet to make room")
-                        queue.append((pkt, timestamp))
+                    # Ports that can read many packets at once drain all
+                    # of them per wakeup
+                    try:
+                        if hasattr(port, "recv_batch"):
+                            pkts = port.recv_batch()
+                        else:
+                            pkts = [port.recv()]
+                    except (socket.error, OSError), e:
+                        self.logger.warning("Receive error on port %d: %s",
+                                            port._port_number, e)
+                        continue
+                    if port._port_number in self.counting:
+                        self.rx_counters[port._port_number].add(pkts)
+                        continue
+                    for pkt, timestamp in pkts:
+                        self._enqueue(port._port_number, pkt, timestamp)
                 self.cvar.notify_all()
 
         self.logger.info("Thread exit")
 
+    def _tx_timestamps_handle(self, port):
+        """
+        Store the tx timestamps queued on a port
+
+        Called with cvar held.
+        @returns True if there were any
+        """
+        timestamps = self.tx_timestamps[port._port_number]
+        tx_timestamps = port.recv_tx_timestamps()
+        for (tx_id, timestamp) in tx_timestamps:
+            timestamps[tx_id] = timestamp
+        while len(timestamps) > self.MAX_TX_TIMESTAMPS:
+            timestamps.popitem(last=False)
+        return bool(tx_timestamps)
+
+    def _enqueue(self, port_number, pkt, timestamp):
+        """
+        Hand a received packet to a waiting expectation or queue it
+
+        Called with cvar held.
+        """
+        self.logger.debug("Pkt len %d in on port %d",
+                          len(pkt), port_number)
+        if self.pcap_writer:
+            self.pcap_writer.write(pkt, timestamp, port_number)
+        if self.expectations and \
+                self._expectation_handle(port_number, pkt, timestamp):
+            return
+        if self.packet_queue.port_count(port_number) >= self.MAX_QUEUE_LEN:
+            # Queue full, throw away oldest
+            self.packet_queue.port_popleft(port_number)
+            self.logger.debug("Discarding oldest packet to make room")
+        self.packet_queue.add(port_number, pkt, timestamp)
+
+    @property
+    def packet_queues(self):
+        """
+        Snapshot of the queued packets as a dict from port number to a list
+        of (packet, time)
+
+        For compatibility with code that read the old per-port lists.
+        Changing the lists does not change the queue.
+        """
+        with self.cvar:
+            queues = dict((port_number, []) for port_number in self.ports)
+            for (port_number, pkt, time) in self.packet_queue:
+                queues.setdefault(port_number, []).append((pkt, time))
+        return queues
+
     def port_add(self, interface_name, port_number):
         """
         Add a port to the dataplane
@@ -234,10 +837,38 @@ class DataPlane(Thread):
         """
         self.ports[port_number] = self.dppclass(interface_name, port_number)
         self.ports[port_number]._port_number = port_number
-        self.packet_queues[port_number] = []
-        # Need to wake up event loop to change the sockets being selected on.
+        self.tx_packets[port_number] = 0
+        self.tx_bytes[port_number] = 0
+        dp_config = self.config.get("dataplane", {})
+        spec = dp_config.get("port_filters", {}).get(port_number,
+                                                     dp_config.get("filter"))
+        if spec:
+            self.set_filter(port_number, spec)
+        self.poller.register(self.ports[port_number])
+        # Wake up the event loop in case it is using select.
         self.waker.notify()
 
+    def set_filter(self, port_number, spec):
+        """
+        Attach a receive filter to a port
+
+        Frames the filter drops are discarded by the kernel, so they are
+        never queued or compared by poll.  Ports without set_filter (the
+        pcap port) keep receiving everything.
+        @param port_number The port to filter
+        @param spec Filter spec, see the bpf module, or None to remove
+        the filter
+        """
+        port = self.ports[port_number]
+        if not hasattr(port, "set_filter"):
+            self.logger.warn("Port %d does not support filters", port_number)
+            return
+        if spec is None:
+            port.set_filter(None)
+        else:
+            self.logger.debug("Filter on port %d: %s", port_number, spec)
+            port.set_filter(bpf.compile(spec))
+
     def send(self, port_number, packet):
         """
         Send a packet to the given port
@@ -248,44 +879,298 @@ class DataPlane(Thread):
                           (len(packet), port_number))
         if self.pcap_writer:
             self.pcap_writer.write(packet, time.time(), port_number)
+        return self._port_send(port_number, packet)
+
+    def _port_send(self, port_number, packet):
         bytes = self.ports[port_number].send(packet)
         if bytes != len(packet):
             self.logger.error("Unhandled send error, length mismatch %d != %d" %
                      (bytes, len(packet)))
+        self.tx_packets[port_number] += 1
+        self.tx_bytes[port_number] += bytes
         return bytes
 
+    def send_timestamped(self, port_number, packet, timeout=0.1):
+        """
+        Send a packet to the given port and return when it was sent
+
+        The time is the kernel timestamp taken as the driver hands the
+        packet to the device, so it does not include the time spent in
+        Python; compare it with the receive times from poll, which are
+        kernel timestamps too.  If the port or driver does not support tx
+        timestamps the time is taken when the send returns.
+
+        Other threads must not send on the port at the same time, since
+        the timestamp is found by counting the packets sent.
+        @param port_number The port to send the data to
+        @param packet Raw packet data to send to port
+        @param timeout Seconds to wait for the kernel timestamp
+        @returns A pair (bytes sent, tx time)
+        """
+        packet = str(packet)
+        port = self.ports[port_number]
+        self.logger.debug("Sending %d bytes to port %d with timestamp" %
+                          (len(packet), port_number))
+        if not hasattr(port, "enable_tx_timestamps"):
+            bytes = self._port_send(port_number, packet)
+            timestamp = time.time()
+        else:
+            with self.cvar:
+                if port_number not in self.tx_timestamps:
+                    port.enable_tx_timestamps()
+                    self.tx_timestamps[port_number] = OrderedDict()
+                tx_id = port.tx_next_id
+            bytes = self._port_send(port_number, packet)
+            after = time.time()
+
+            def grab():
+                timestamps = self.tx_timestamps[port_number]
+                # Read the error queue here too in case the poller does
+                # not report it
+                if tx_id not in timestamps:
+                    self._tx_timestamps_handle(port)
+                return timestamps.pop(tx_id, None)
+
+            with self.cvar:
+                timestamp = ofutils.timed_wait(self.cvar, grab, timeout=timeout)
+            if timestamp is None:
+                self.logger.debug("No tx timestamp on port %d", port_number)
+                timestamp = after
+        if self.pcap_writer:
+            self.pcap_writer.write(packet, timestamp, port_number)
+        return (bytes, timestamp)
+
+    def send_burst(self, port_number, packets):
+        """
+        Send many packets to the given port
+
+        Ports that implement send_batch (DataPlanePortLinux does, with
+        sendmmsg) send the whole burst with a few system calls.  Only the
+        burst as a whole is logged.
+        @param port_number The port to send the data to
+        @param packets List of raw packet data to send to port
+        @returns The number of packets sent
+        """
+        packets = [str(packet) for packet in packets]
+        self.logger.debug("Sending burst of %d packets to port %d" %
+                          (len(packets), port_number))
+        return self._port_send_burst(port_number, packets)
+
+    def _port_send_burst(self, port_number, packets):
+        if self.pcap_writer:
+            timestamp = time.time()
+            for packet in packets:
+                self.pcap_writer.write(packet, timestamp, port_number)
+
+        port = self.ports[port_number]
+        if hasattr(port, "send_batch"):
+            sent = port.send_batch(packets)
+        else:
+            sent = [port.send(packet) for packet in packets]
+
+        mismatches = len([1 for (bytes, packet) in zip(sent, packets)
+                          if bytes != len(packet)])
+        if len(sent) != len(packets) or mismatches:
+            self.logger.error("Burst send error on port %d: sent %d of %d packets, %d length mismatches" %
+                              (port_number, len(sent), len(packets), mismatches))
+        self.tx_packets[port_number] += len(sent)
+        self.tx_bytes[port_number] += sum(sent)
+        return len(sent)
+
+    def generate(self, port_number, packets, pps=None, mbps=None,
+                 duration=None, count=None, burst=None):
+        """
+        Start sending packets on a port at a fixed rate
+
+        See TrafficGenerator for the arguments.  The generator is stopped
+        by kill if it is still running.
+        @returns The started TrafficGenerator
+        """
+        gen = TrafficGenerator(self, port_number, packets, pps=pps, mbps=mbps,
+                               duration=duration, count=count, burst=burst)
+        self.generators = [g for g in self.generators if g.is_alive()]
+        self.generators.append(gen)
+        gen.start()
+        return gen
+
+    def send_multi(self, packets):
+        """
+        Send packets to several ports
+
+        The packets for each port are sent as one burst, in the order
+        given; there is no ordering between ports.
+        @param packets List of (port number, raw packet data)
+        @returns The number of packets sent
+        """
+        bursts = {}
+        for (port_number, packet) in packets:
+            bursts.setdefault(port_number, []).append(packet)
+        return sum(self.send_burst(port_number, burst)
+                   for (port_number, burst) in bursts.items())
+
+    def expect(self, port_number, exp_pkt):
+        """
+        Return a Future for a packet on a port
+
+        Unlike poll this does not block, and it does not discard other
+        packets.  The future completes with a (port number, packet, time)
+        triple when the packet is received (or at once if it is already
+        queued), and the packet is then not queued.  Use ofutils.wait_all
+        to wait for many expectations with a single deadline.  Cancel the
+        future to stop waiting.
+
+        @param port_number The port to expect the packet on, or None for
+        any port
+        @param exp_pkt The expected packet, compared with match_exp_pkt
+        @returns A PacketExpectation
+        """
+        exp = PacketExpectation(port_number, exp_pkt)
+
+        with self.cvar:
+            entry = self.packet_queue.find_packet(exp.exp_pkt, port_number)
+            if entry is not None:
+                self.packet_queue.remove(entry)
+                exp.set_result(entry.value)
+                return exp
+            self.expectations.setdefault(port_number, []).append(exp)
+
+        return exp
+
+    def verify(self, positive=[], negative=[], no_other=False,
+               timeout=-1, negative_timeout=None):
+        """
+        Check many ports in one shared wait
+
+        Packets are matched as they arrive.  The positive expectations
+        have until timeout to be received, and the negative expectations
+        and the no_other check are watched for negative_timeout; all of
+        them run at the same time, so the whole check takes the longer of
+        the two windows instead of one window per port.  It returns early
+        once every positive expectation has been received and the
+        negative window has passed, or as soon as a negative expectation
+        is received.
+
+        As with poll(exp_pkt=...), packets on a positive port received
+        before the expected packet are discarded, and packets not matching
+        a negative expectation on its port are discarded.
+
+        @param positive List of (port number, packet) that must be received
+        @param negative List of (port number, packet) that must not be
+        received
+        @param no_other If true, fail if any other packet is left queued,
+        and remove those packets
+        @param timeout Seconds to wait for the positive expectations, -1
+        for the default timeout
+        @param negative_timeout Seconds to watch for negative packets,
+        None for the default negative timeout
+        @returns A Verification
+        """
+        v = Verification(positive, negative, no_other)
+        if timeout == -1:
+            timeout = ofutils.default_timeout
+        if negative_timeout is None:
+            negative_timeout = ofutils.default_negative_timeout
+        if not v.negative and not no_other:
+            negative_timeout = 0
+        start = time.time()
+        negative_end = start + negative_timeout
+        end = start + max(timeout, negative_timeout)
+
+        with self.cvar:
+            while True:
+                self._verify_step(v)
+                now = time.time()
+                if v.unexpected or now >= end:
+                    break
+                if v.missing():
+                    self.cvar.wait(end - now)
+                elif now < negative_end:
+                    self.cvar.wait(negative_end - now)
+                else:
+                    break
+            if no_other:
+                # Consumed, as poll did in verify_no_other_packets, so a
+                # stray packet is only reported once
+                v.other = list(self.packet_queue)
+                self.packet_queue.clear()
+
+        self.logger.debug("Verify: %d of %d received, %d unexpected, %d other",
+                          len(v.received) - len(v.missing()), len(v.received),
+                          len(v.unexpected), len(v.other))
+        return v
+
+    def _verify_step(self, v):
+        """
+        Resolve a Verification against the queued packets
+
+        Called with cvar held.
+        """
+        for (i, (port_number, exp_pkt)) in enumerate(v.positive):
+            if v.received[i] is not None:
+                continue
+            entry = self.packet_queue.find_packet(exp_pkt, port_number)
+            if entry is None:
+                continue
+            while self.packet_queue.port_popleft(port_number) is not entry.value:
+                pass
+            v.received[i] = entry.value
+        for (port_number, exp_pkt) in v.negative:
+            entry = self.packet_queue.find_packet(exp_pkt, port_number)
+            if entry is not None:
+                self.packet_queue.remove(entry)
+                v.unexpected.append(entry.value)
+            while self.packet_queue.port_popleft(port_number) is not None:
+                pass
+
+    def _expectation_handle(self, port_number, pkt, timestamp):
+        """
+        Complete the oldest expectation matching a received packet
+
+        Called with cvar held.
+        @returns True if the packet was consumed
+        """
+        for key in (port_number, None):
+            exps = self.expectations.get(key)
+            if not exps:
+                continue
+            consumed = False
+            for exp in list(exps):
+                if exp.done():
+                    exps.remove(exp) # Cancelled
+                elif exp.match(pkt):
+                    exps.remove(exp)
+                    consumed = exp.set_result((port_number, pkt, timestamp))
+                    if consumed:
+                        break
+            if not exps:
+                del self.expectations[key]
+            if consumed:
+                return True
+        return False
+
     def oldest_port_number(self):
         """
         Returns the port number with the oldest packet, or
         None if no packets are queued.
         """
-        min_port_number = None
-        min_time = float('inf')
-        for (port_number, queue) in self.packet_queues.items():
-            if queue and queue[0][1] < min_time:
-                min_time = queue[0][1]
-                min_port_number = port_number
-        return min_port_number
+        entry = self.packet_queue.oldest()
+        if entry is None:
+            return None
+        return entry.value[0]
 
     # Dequeues and yields packets in the order they were received.
     # Yields (port number, packet, received time).
     # If port_number is not specified yields packets from all ports.
     def packets(self, port_number=None):
         while True:
-            rcv_port_number = port_number or self.oldest_port_number()
-
-            if rcv_port_number == None:
-                self.logger.debug("Out of packets on all ports")
-                break
-
-            queue = self.packet_queues[rcv_port_number]
-
-            if len(queue) == 0:
-                self.logger.debug("Out of packets on port %d", rcv_port_number)
+            ret = self.packet_queue.port_popleft(port_number)
+            if ret is None:
+                if port_number is None:
+                    self.logger.debug("Out of packets on all ports")
+                else:
+                    self.logger.debug("Out of packets on port %d", port_number)
                 break
-
-            pkt, time = queue.pop(0)
-            yield (rcv_port_number, pkt, time)
+            yield ret
 
     def poll(self, port_number=None, timeout=-1, exp_pkt=None):
         """
@@ -314,10 +1199,14 @@ class DataPlane(Thread):
         # Retrieve the packet. Returns (port number, packet, time).
         def grab():
             self.logger.debug("Grabbing packet")
-            for (rcv_port_number, pkt, time) in self.packets(port_number):
-                self.logger.debug("Checking packet from port %d", rcv_port_number)
-                if not exp_pkt or match_exp_pkt(exp_pkt, pkt):
-                    return (rcv_port_number, pkt, time)
+            if exp_pkt:
+                # Look the packet up in the index, then discard the
+                # packets received before it as a scan would
+                entry = self.packet_queue.find_packet(exp_pkt, port_number)
+                target = entry and entry.value
+            for ret in self.packets(port_number):
+                if not exp_pkt or ret is target:
+                    return ret
             self.logger.debug("Did not find packet")
             return None
 
@@ -330,13 +1219,60 @@ class DataPlane(Thread):
             self.logger.debug("Poll time out, no packet from " + str(port_number))
             return (None, None, None)
 
+    def poll_many(self, expectations, timeout=-1):
+        """
+        Wait for many expected packets at once
+
+        Each expected packet is looked up in the packet index and removed
+        from the queue when it is found.  Unlike poll with exp_pkt, other
+        packets are left queued.  A received packet satisfies at most one
+        expectation, the earliest in the list.
+
+        @param expectations List of (port number, expected packet) pairs.
+        The port number may be None for any port.
+        @param timeout If positive, block until all the packets are
+        received or for this many seconds
+        @return List with, for each expectation, the triple port_number,
+        packet, pkt_time of the matching packet, or None if it was not
+        received
+        """
+        exps = [(port_number, str(exp_pkt))
+                for (port_number, exp_pkt) in expectations]
+        results = [None] * len(exps)
+
+        def grab():
+            missing = False
+            for (i, (port_number, exp_pkt)) in enumerate(exps):
+                if results[i] is not None:
+                    continue
+                entry = self.packet_queue.find_packet(exp_pkt, port_number)
+                if entry is None:
+                    missing = True
+                else:
+                    self.packet_queue.remove(entry)
+                    results[i] = entry.value
+            if missing:
+                return None
+            return results
+
+        with self.cvar:
+            ofutils.timed_wait(self.cvar, grab, timeout=timeout)
+
+        self.logger.debug("Poll many found %d of %d packets",
+                          len(results) - results.count(None), len(results))
+        return results
+
     def kill(self):
         """
         Stop the dataplane thread.
         """
+        for gen in self.generators:
+            gen.stop()
+            gen.join()
         self.killed = True
         self.waker.notify()
         self.join()
+        self.poller.close()
         # Explicitly release ports to ensure we don't run out of sockets
         # even if someone keeps holding a reference to the dataplane.
         del self.ports
@@ -353,8 +1289,83 @@ class DataPlane(Thread):
         """
         Drop any queued packets.
         """
-        for port_number in self.packet_queues.keys():
-            self.packet_queues[port_number] = []
+        with self.cvar:
+            self.packet_queue.clear()
+
+    def start_counting(self, port_number=None, key=None):
+        """
+        Count received packets on a port instead of queueing them
+
+        The receive thread only updates the port's RxCounters: packets
+        are not queued, do not complete expectations and are not written
+        to the pcap file.  This keeps up with loads far above
+        MAX_QUEUE_LEN packets.  The counters are reset.
+        @param port_number The port, or None for all ports
+        @param key Flow key for per-flow counts, see flow_key_function
+        """
+        if port_number is None:
+            port_numbers = self.ports.keys()
+        else:
+            port_numbers = [port_number]
+        with self.cvar:
+            for port_number in port_numbers:
+                self.rx_counters[port_number] = RxCounters(key)
+                self.counting.add(port_number)
+
+    def stop_counting(self, port_number=None):
+        """
+        Return a port to queueing received packets
+
+        The counters stay available from counts.
+        @param port_number The port, or None for all ports
+        """
+        with self.cvar:
+            if port_number is None:
+                self.counting.clear()
+            else:
+                self.counting.discard(port_number)
+
+    def counts(self, port_number=None):
+        """
+        Return the counters of a port as a dict
+
+        The dict has the packets, bytes and flows counts of the port's
+        last count-only period.
+        @param port_number The port, or None for the sum over all ports
+        """
+        with self.cvar:
+            if port_number is not None:
+                counters = [self.rx_counters.get(port_number, RxCounters())]
+            else:
+                counters = self.rx_counters.values()
+            total = dict(packets=0, bytes=0, flows={})
+            for counter in counters:
+                snap = counter.snapshot()
+                total["packets"] += snap["packets"]
+                total["bytes"] += snap["bytes"]
+                for (k, n) in snap["flows"].items():
+                    total["flows"][k] = total["flows"].get(k, 0) + n
+        return total
+
+    def wait_count(self, packets, port_number=None, timeout=-1):
+        """
+        Wait until the counters reach a number of packets
+
+        @param packets The number of packets to wait for
+        @param port_number The port, or None for the sum over all ports
+        @param timeout Seconds to wait, -1 for the default timeout
+        @returns True if the count was reached
+        """
+        def grab():
+            if port_number is None:
+                counters = self.rx_counters.values()
+            else:
+                counters = [self.rx_counters.get(port_number, RxCounters())]
+            if sum(counter.packets for counter in counters) >= packets:
+                return True
+            return None
+        with self.cvar:
+            return ofutils.timed_wait(self.cvar, grab, timeout=timeout) is not None
 
     def start_pcap(self, filename):
         assert(self.pcap_writer == None)
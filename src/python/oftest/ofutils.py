@@ -7,7 +7,15 @@ import random
 import time
 import os
 import fcntl
+import errno
+import select
+import struct
 import logging
+import ctypes
+from collections import deque
+from threading import Lock
+from threading import Condition
+from threading import Thread
 
 default_timeout = None # set by oft
 default_negative_timeout = None # set by oft
@@ -37,28 +45,614 @@ def timed_wait(cv, fn, timeout=-1):
         if time.time() > end_time:
             return None
 
+class Future(object):
+    """
+    Result of an operation that is completed by another thread
+
+    Futures from the controller and the dataplane can be waited on
+    together with wait_all or wait_any, using one deadline for all of
+    them instead of a timeout per operation.
+    """
+
+    def __init__(self):
+        self.cv = Condition()
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def set_result(self, result):
+        """
+        Complete the future
+
+        @returns False if the future was already complete
+        """
+        return self._complete(result, False)
+
+    def _complete(self, result, cancelled):
+        with self.cv:
+            if self._done:
+                return False
+            self._result = result
+            # Set together with _done so nobody sees a cancelled future
+            # as completed normally
+            self._cancelled = cancelled
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+            self.cv.notify_all()
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    def cancel(self):
+        """
+        Complete the future without a result
+
+        Whoever would have completed it will skip it.
+        """
+        return self._complete(None, True)
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) when the future completes
+
+        fn is called immediately if the future is already complete,
+        otherwise from the thread that completes it.
+        """
+        with self.cv:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def remove_done_callback(self, fn):
+        """
+        Remove a callback added with add_done_callback, if still pending
+        """
+        with self.cv:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    def wait(self, timeout=-1):
+        """
+        Wait for the future to complete
+
+        @param timeout The timeout in seconds; if -1 use default.
+        @returns True if the future completed
+        """
+        with self.cv:
+            timed_wait(self.cv, lambda: self._done or None, timeout=timeout)
+            return self._done
+
+    def result(self, timeout=-1):
+        """
+        Wait for the future and return its result, or None on timeout
+        """
+        self.wait(timeout=timeout)
+        return self._result
+
+def wait_all(futures, timeout=-1):
+    """
+    Wait until all futures complete or the timeout expires
+
+    @param futures List of Future objects
+    @param timeout The timeout in seconds for all of them; if -1 use default.
+    @returns List of the futures that did not complete
+    """
+    return _wait_futures(futures, len(futures), timeout)
+
+def wait_any(futures, timeout=-1):
+    """
+    Wait until at least one future completes or the timeout expires
+
+    @returns List of the futures that completed
+    """
+    pending = _wait_futures(futures, min(1, len(futures)), timeout)
+    return [f for f in futures if f not in pending]
+
+def _wait_futures(futures, count, timeout):
+    cv = Condition()
+
+    def notify(future):
+        with cv:
+            cv.notify_all()
+
+    def check():
+        if len([f for f in futures if f.done()]) >= count:
+            return True
+        return None
+
+    for future in futures:
+        future.add_done_callback(notify)
+
+    try:
+        with cv:
+            timed_wait(cv, check, timeout=timeout)
+    finally:
+        # Long lived futures would otherwise collect dead callbacks
+        for future in futures:
+            future.remove_done_callback(notify)
+
+    return [f for f in futures if not f.done()]
+
+class Histogram(object):
+    """
+    Histogram of durations in seconds with power of two buckets
+
+    Bucket i counts values from 2**(i-1) up to 2**i microseconds.  The
+    percentiles reported are bucket upper bounds, so they are accurate
+    to within a factor of two; count, min, max and average are exact.
+    """
+
+    NBUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.NBUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        usec = max(int(value * 1e6), 0)
+        self.buckets[min(usec.bit_length(), self.NBUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Return an upper bound for the p'th percentile, or None if empty
+
+        @param p Percentile between 0 and 100
+        """
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Return a dict with count, min, max, avg and p50/p90/p99
+        """
+        return dict(count=self.count, min=self.min, max=self.max,
+                    avg=self.count and self.total / self.count or None,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+class OrderedExecutor(object):
+    """
+    Bounded pool of worker threads
+
+    Calls submitted with the same key run one at a time, in submission
+    order, on the same worker; calls with different keys may run
+    concurrently.  submit blocks while max_pending calls are already
+    queued on the chosen worker, unless told not to.  Exceptions raised
+    by a call are logged and do not stop the worker.
+    """
+
+    def __init__(self, workers=4, max_pending=1024, name="executor"):
+        self.logger = logging.getLogger(name)
+        self.max_pending = max_pending
+        self.cv = Condition()
+        self.active = True
+        self.queues = [deque() for i in range(workers)]
+        self.running = 0
+        self.dropped = 0
+        self.threads = []
+        for i, queue in enumerate(self.queues):
+            thread = Thread(target=self._run, args=(queue,),
+                            name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Queue fn(*args) on the worker owning key
+
+        @param block If False, do not wait for room on a full worker
+        queue; the call is not queued and counted in dropped instead
+        @returns False if the call was not queued because the executor
+        has been shut down or the queue was full
+        """
+        block = kwargs.pop("block", True)
+        assert not kwargs
+        queue = self.queues[hash(key) % len(self.queues)]
+        with self.cv:
+            while block and self.active and len(queue) >= self.max_pending:
+                self.cv.wait()
+            if not self.active:
+                return False
+            if len(queue) >= self.max_pending:
+                self.dropped += 1
+                return False
+            queue.append((fn, args))
+            self.cv.notify_all()
+        return True
+
+    def pending(self):
+        """
+        Number of calls queued or running
+        """
+        with self.cv:
+            return sum(len(q) for q in self.queues) + self.running
+
+    def drain(self, timeout=-1):
+        """
+        Wait until all submitted calls have finished
+
+        @returns True if the executor is idle
+        """
+        with self.cv:
+            return timed_wait(self.cv,
+                              lambda: self._idle() or None,
+                              timeout=timeout) is not None
+
+    def shutdown(self, wait=False):
+        """
+        Stop accepting calls; workers exit once their queues are empty
+        """
+        with self.cv:
+            self.active = False
+            self.cv.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _idle(self):
+        return self.running == 0 and not any(self.queues)
+
+    def _run(self, queue):
+        while True:
+            with self.cv:
+                while self.active and not queue:
+                    self.cv.wait()
+                if not queue:
+                    return
+                fn, args = queue.popleft()
+                self.running += 1
+                self.cv.notify_all()
+            try:
+                fn(*args)
+            except:
+                self.logger.exception("Error in %s", getattr(fn, "__name__", fn))
+            with self.cv:
+                self.running -= 1
+                self.cv.notify_all()
+
+# eventfd(2) is not exposed by the os module in Python 2
+EFD_CLOEXEC = 0o2000000
+EFD_NONBLOCK = 0o4000
+try:
+    _eventfd = ctypes.CDLL(None, use_errno=True).eventfd
+    _eventfd.argtypes = [ctypes.c_uint, ctypes.c_int]
+    _eventfd.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _eventfd = None
+
 class EventDescriptor():
     """
     Similar to a condition variable, but can be passed to select().
     Only supports one waiter.
+
+    Uses an eventfd where available, otherwise a pipe.  wait() consumes
+    all pending notifications, so the descriptor may be registered
+    edge-triggered.
     """
 
     def __init__(self):
-        self.pipe_rd, self.pipe_wr = os.pipe()
-        fcntl.fcntl(self.pipe_wr, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.pipe_rd = self.pipe_wr = None
+        if _eventfd:
+            fd = _eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC)
+            if fd >= 0:
+                self.pipe_rd = self.pipe_wr = fd
+        if self.pipe_rd is None:
+            self.pipe_rd, self.pipe_wr = os.pipe()
+            fcntl.fcntl(self.pipe_rd, fcntl.F_SETFL, os.O_NONBLOCK)
+            fcntl.fcntl(self.pipe_wr, fcntl.F_SETFL, os.O_NONBLOCK)
 
     def __del__(self):
         os.close(self.pipe_rd)
-        os.close(self.pipe_wr)
+        if self.pipe_wr != self.pipe_rd:
+            os.close(self.pipe_wr)
 
     def notify(self):
         try:
-            os.write(self.pipe_wr, "x")
+            if self.pipe_wr == self.pipe_rd:
+                os.write(self.pipe_wr, struct.pack("=Q", 1))
+            else:
+                os.write(self.pipe_wr, "x")
         except OSError as e:
-            logging.warn("Failed to notify EventDescriptor: %s", e)
+            if e.errno != errno.EAGAIN:
+                logging.warn("Failed to notify EventDescriptor: %s", e)
 
     def wait(self):
-        os.read(self.pipe_rd, 1)
+        try:
+            if self.pipe_wr == self.pipe_rd:
+                os.read(self.pipe_rd, 8)
+            else:
+                while os.read(self.pipe_rd, 4096):
+                    pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
 
     def fileno(self):
         return self.pipe_rd
+
+class Poller(object):
+    """
+    Wait for input on a set of file objects
+
+    Objects are registered once rather than passed in on every call.  On
+    Linux this uses epoll, which has no limit on descriptor numbers and
+    does not rebuild the interest set on each wakeup.  Elsewhere it falls
+    back to select.
+
+    Objects may be registered and unregistered from any thread.  Objects
+    registered edge-triggered must be drained completely when ready.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.objects = {} # fd -> object
+        if hasattr(select, "epoll"):
+            self.epoll = select.epoll()
+        else:
+            self.epoll = None
+
+    def register(self, obj, edge=False):
+        """
+        Start watching obj for input
+
+        @param obj An object with a fileno() method
+        @param edge If True, only report new input (epoll only)
+        """
+        fd = obj.fileno()
+        with self.lock:
+            if self.epoll:
+                mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+                if edge:
+                    mask |= select.EPOLLET
+                try:
+                    self.epoll.register(fd, mask)
+                except IOError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    self.epoll.modify(fd, mask)
+            self.objects[fd] = obj
+
+    def unregister(self, obj):
+        """
+        Stop watching obj
+
+        May be called after obj has been closed.
+        """
+        with self.lock:
+            for (fd, other) in self.objects.items():
+                if other is obj:
+                    del self.objects[fd]
+                    if self.epoll:
+                        try:
+                            self.epoll.unregister(fd)
+                        except (IOError, OSError):
+                            pass # Already closed
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for input
+
+        Returns early with nothing ready if interrupted by a signal.
+        @returns A pair (readable objects, objects with errors)
+        """
+        try:
+            if not self.epoll:
+                with self.lock:
+                    objs = self.objects.values()
+                sel_in, sel_out, sel_err = select.select(objs, [], objs,
+                                                         timeout)
+                return (sel_in, sel_err)
+            ready = self.epoll.poll(timeout)
+        except (select.error, IOError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return ([], [])
+
+        sel_in = []
+        sel_err = []
+        for (fd, events) in ready:
+            obj = self.objects.get(fd)
+            if obj is None:
+                continue # Unregistered by another thread
+            if events & select.EPOLLERR:
+                sel_err.append(obj)
+            else:
+                sel_in.append(obj)
+        return (sel_in, sel_err)
+
+    def close(self):
+        with self.lock:
+            self.objects = {}
+            if self.epoll:
+                self.epoll.close()
+
+class QueueEntry(object):
+    """
+    An element of an IndexedQueue
+
+    @var value The queued object
+    @var keys Tuple with one key per index of the queue
+    @var live False once the entry has been removed from the queue
+    """
+    __slots__ = ('value', 'keys', 'live')
+
+    def __init__(self, value, keys):
+        self.value = value
+        self.keys = keys
+        self.live = True
+
+class IndexedQueue(object):
+    """
+    FIFO queue with constant time access by key.
+
+    Every entry is linked into a deque holding all entries in arrival order
+    and, for each index, into a deque holding the entries with the same key.
+    Removing an entry only marks it dead; the other deques skip dead entries
+    lazily and are compacted once they are mostly dead.  This gives O(1)
+    amortized access to the oldest entry overall and to the oldest entry
+    with a given key.
+
+    Not thread safe, callers must provide locking.
+    """
+
+    def __init__(self, nindexes=1):
+        self.nindexes = nindexes
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        self.order = deque()
+        self.count = 0
+        # One dict per index from key to [deque, live count]
+        self.indexes = [{} for i in range(self.nindexes)]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        Iterate over the queued values in arrival order
+        """
+        for entry in list(self.order):
+            if entry.live:
+                yield entry.value
+
+    def append(self, value, *keys):
+        """
+        Add a value at the tail of the queue
+
+        @param value The object to queue
+        @param keys One key per index
+        @returns The new QueueEntry
+        """
+        assert len(keys) == self.nindexes
+        entry = QueueEntry(value, keys)
+        self.order.append(entry)
+        self.count += 1
+        for (index, key) in zip(self.indexes, keys):
+            bucket = index.get(key)
+            if bucket is None:
+                bucket = index[key] = [deque(), 0]
+            bucket[0].append(entry)
+            bucket[1] += 1
+        return entry
+
+    def remove(self, entry):
+        """
+        Remove an entry returned by append, oldest or find
+        """
+        if not entry.live:
+            return
+        entry.live = False
+        self.count -= 1
+        self._compact_order()
+        for (index, key) in zip(self.indexes, entry.keys):
+            bucket = index[key]
+            bucket[1] -= 1
+            if bucket[1] == 0:
+                del index[key]
+            else:
+                self._compact(bucket[0], bucket[1])
+
+    def oldest(self, index=None, key=None):
+        """
+        Return the oldest entry, or the oldest entry with the given key
+
+        @param index If not None, the index to look up key in
+        @returns A QueueEntry or None if there is no such entry
+        """
+        for entry in self.entries(index, key):
+            return entry
+        return None
+
+    def find(self, fn, index=None, key=None):
+        """
+        Return the oldest entry whose value satisfies fn
+
+        @param fn Predicate on the value; None matches everything
+        @param index If not None, only consider entries with this key
+        """
+        for entry in self.entries(index, key):
+            if fn is None or fn(entry.value):
+                return entry
+        return None
+
+    def entries(self, index=None, key=None):
+        """
+        Iterate over live entries in arrival order
+
+        The queue must not be modified during the iteration.
+        """
+        if index is None:
+            dq = self.order
+        else:
+            bucket = self.indexes[index].get(key)
+            if bucket is None:
+                return
+            dq = bucket[0]
+        # Dead entries at the head are never needed again
+        while dq and not dq[0].live:
+            dq.popleft()
+        for entry in dq:
+            if entry.live:
+                yield entry
+
+    def popleft(self, index=None, key=None):
+        """
+        Remove and return the oldest value, optionally for a given key
+
+        @returns The value, or None if there is no such entry
+        """
+        entry = self.oldest(index, key)
+        if entry is None:
+            return None
+        self.remove(entry)
+        return entry.value
+
+    def key_count(self, index, key):
+        """
+        Return the number of live entries with the given key
+        """
+        bucket = self.indexes[index].get(key)
+        return bucket[1] if bucket else 0
+
+    def _compact_order(self):
+        dq = self.order
+        while dq and not dq[0].live:
+            dq.popleft()
+        self._compact(dq, self.count)
+
+    @staticmethod
+    def _compact(dq, live):
+        if len(dq) > 2 * live + 16:
+            entries = [entry for entry in dq if entry.live]
+            dq.clear()
+            dq.extend(entries)
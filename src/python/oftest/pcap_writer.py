@@ -3,11 +3,22 @@ Pcap file writer
 """
 
 import struct
+import socket
+import logging
+from collections import deque
+from threading import Thread
+from threading import Condition
 
 PcapHeader = struct.Struct("<LHHLLLL")
 PcapPktHeader = struct.Struct("<LLLL")
 PPIPktHeader = struct.Struct("<BBHL")
 PPIAggregateField = struct.Struct("<HHL")
+EthHeader = struct.Struct("!6s6sH")
+IPv4Header = struct.Struct("!BBHHHBBH4s4s")
+TCPHeader = struct.Struct("!HHLLHHHH")
+
+SNAPLEN = 65535
+TCP_FRAME_OVERHEAD = EthHeader.size + IPv4Header.size + TCPHeader.size
 
 class PcapWriter(object):
     def __init__(self, filename):
@@ -17,7 +28,7 @@ class PcapWriter(object):
         self.stream = file(filename, 'w')
 
         self.stream.write(PcapHeader.pack(
-            0xa1b2c3d4, # magic
+            0xa1b23c4d, # magic, nanosecond timestamps
             2, # major
             4, # minor
             0, # timezone offset
@@ -35,9 +46,11 @@ class PcapWriter(object):
         'port' should be an integer port number.
         """
         ppi_len = PPIPktHeader.size + PPIAggregateField.size
+        # Kernel timestamps have better than microsecond resolution
+        (sec, nsec) = divmod(int(round(timestamp * 10**9)), 10**9)
         self.stream.write(PcapPktHeader.pack(
-            int(timestamp), # timestamp seconds
-            int((timestamp - int(timestamp)) * 10**6), # timestamp microseconds
+            sec, # timestamp seconds
+            nsec, # timestamp nanoseconds
             len(data) + ppi_len, # truncated length
             len(data) + ppi_len # un-truncated length
         ))
@@ -53,6 +66,151 @@ class PcapWriter(object):
     def close(self):
         self.stream.close()
 
+class TcpPcapWriter(object):
+    """
+    Write one side of a TCP connection as synthetic Ethernet/IPv4/TCP frames
+
+    Used for the control channel: each chunk of data written becomes a
+    TCP segment with consistent sequence numbers, so Wireshark can
+    reassemble and decode the OpenFlow stream.  Only the headers needed
+    for that are filled in; the TCP checksum is left zero.
+    """
+
+    def __init__(self, filename, local_addr, remote_addr):
+        """
+        Open a pcap file
+
+        'local_addr' and 'remote_addr' should be (IPv4 address, port)
+        tuples for the two ends of the connection.
+        """
+        self.stream = file(filename, 'w')
+        self.addrs = [self._addr(local_addr), self._addr(remote_addr)]
+        self.seq = [1, 1]
+        self.ip_id = 0
+
+        self.stream.write(PcapHeader.pack(
+            0xa1b2c3d4, # magic
+            2, # major
+            4, # minor
+            0, # timezone offset
+            0, # timezone accuracy
+            SNAPLEN, # snapshot length
+            1 # ethernet linktype
+        ))
+
+    @staticmethod
+    def _addr(addr):
+        try:
+            return (socket.inet_aton(addr[0]), addr[1])
+        except (socket.error, TypeError, IndexError):
+            return ('\x00' * 4, 0)
+
+    def write(self, data, timestamp, outgoing):
+        """
+        Write data sent on the connection to a pcap file
+
+        'data' should be a string containing the TCP payload.
+        'timestamp' should be a float.
+        'outgoing' should be True for data sent from the local end.
+        """
+        src = 0 if outgoing else 1
+        dst = 1 - src
+        maxseg = SNAPLEN - TCP_FRAME_OVERHEAD
+        for offset in range(0, len(data), maxseg):
+            self._write_segment(data[offset:offset+maxseg], timestamp,
+                                src, dst)
+
+    def _write_segment(self, data, timestamp, src, dst):
+        (src_ip, src_port), (dst_ip, dst_port) = self.addrs[src], self.addrs[dst]
+        ip_len = IPv4Header.size + TCPHeader.size + len(data)
+        self.ip_id = (self.ip_id + 1) & 0xffff
+
+        ip = IPv4Header.pack(0x45, 0, ip_len, self.ip_id, 0x4000, 64,
+                             socket.IPPROTO_TCP, 0, src_ip, dst_ip)
+        ip = ip[:10] + struct.pack("!H", ip_checksum(ip)) + ip[12:]
+        tcp = TCPHeader.pack(src_port, dst_port, self.seq[src], self.seq[dst],
+                             (5 << 12) | 0x18, # PSH ACK
+                             65535, 0, 0)
+        eth = EthHeader.pack('\x00\x00\x00\x00\x00' + chr(src + 1),
+                             '\x00\x00\x00\x00\x00' + chr(dst + 1),
+                             0x0800)
+        self.seq[src] = (self.seq[src] + len(data)) & 0xffffffff
+
+        frame_len = len(eth) + ip_len
+        self.stream.write(PcapPktHeader.pack(
+            int(timestamp), # timestamp seconds
+            int((timestamp - int(timestamp)) * 10**6), # timestamp microseconds
+            frame_len, # truncated length
+            frame_len # un-truncated length
+        ))
+        self.stream.write(eth)
+        self.stream.write(ip)
+        self.stream.write(tcp)
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.close()
+
+def ip_checksum(header):
+    total = sum(struct.unpack("!%dH" % (len(header) / 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+class AsyncPcapWriter(Thread):
+    """
+    Runs the writes of another pcap writer on a background thread
+
+    write() only queues its arguments, so capturing does not slow down
+    the caller.  When max_queue writes are pending, further ones are
+    dropped and counted in 'dropped'.  close() writes out what is queued
+    and closes the underlying writer.
+    """
+
+    def __init__(self, writer, max_queue=10000):
+        Thread.__init__(self)
+        self.daemon = True
+        self.writer = writer
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.cv = Condition()
+        self.active = True
+        self.written = 0
+        self.dropped = 0
+        self.logger = logging.getLogger("pcap")
+        self.start()
+
+    def write(self, *args):
+        with self.cv:
+            if len(self.queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self.queue.append(args)
+            self.cv.notify()
+
+    def run(self):
+        while True:
+            with self.cv:
+                while self.active and not self.queue:
+                    self.cv.wait()
+                if not self.queue:
+                    break
+                pending = list(self.queue)
+                self.queue.clear()
+            for args in pending:
+                self.writer.write(*args)
+            self.written += len(pending)
+        self.writer.close()
+
+    def close(self):
+        with self.cv:
+            self.active = False
+            self.cv.notify()
+        self.join()
+        if self.dropped:
+            self.logger.warning("Dropped %d of %d packets from capture",
+                                self.dropped, self.dropped + self.written)
+
 if __name__ == "__main__":
     import time
     print("Writing test pcap to test.pcap")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+import unittest
+import bpf
+
+def frame(dst="\x00\x01\x02\x03\x04\x05", src="\x00\x06\x07\x08\x09\x0a",
+          ethertype="\x08\x00", payload="\x00" * 46):
+    return dst + src + ethertype + payload
+
+class TestCompile(unittest.TestCase):
+    def test_drop(self):
+        insns = bpf.compile("drop lldp, drop ipv6 multicast")
+        self.assertEquals(bpf.run(insns, frame()), bpf.ACCEPT)
+        self.assertEquals(bpf.run(insns, frame(ethertype="\x88\xcc")), bpf.DROP)
+        self.assertEquals(bpf.run(insns, frame(dst="\x33\x33\xff\x00\x00\x01",
+                                               ethertype="\x86\xdd")), bpf.DROP)
+        self.assertEquals(bpf.run(insns, frame(ethertype="\x86\xdd")), bpf.ACCEPT)
+
+    def test_only(self):
+        insns = bpf.compile("drop broadcast, only src 00:06:07:08:09:0a ipv4")
+        self.assertEquals(bpf.run(insns, frame()), bpf.ACCEPT)
+        self.assertEquals(bpf.run(insns, frame(dst="\xff" * 6)), bpf.DROP)
+        self.assertEquals(bpf.run(insns, frame(ethertype="\x08\x06")), bpf.DROP)
+        self.assertEquals(bpf.run(insns, frame(src="\x00" * 6)), bpf.DROP)
+
+    def test_bytes(self):
+        insns = bpf.compile("accept multicast, only bytes 14 deadbeef01")
+        self.assertEquals(bpf.run(insns, frame(payload="\xde\xad\xbe\xef\x01")), bpf.ACCEPT)
+        self.assertEquals(bpf.run(insns, frame(payload="\xde\xad\xbe\xef\x02")), bpf.DROP)
+        self.assertEquals(bpf.run(insns, frame(dst="\x01" * 6)), bpf.ACCEPT)
+        self.assertEquals(bpf.run(insns, frame(payload="\xde")), bpf.DROP)
+
+    def test_errors(self):
+        for spec in ["keep lldp", "drop", "drop ethertype", "drop src 00:01",
+                     "drop bytes 0 xyz", "drop fish"]:
+            self.assertRaises(bpf.FilterError, bpf.compile, spec)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import sys
+import os
+import unittest
+import random
+import struct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import loxi
+import loxi.connection
+
+def message(type, xid, body=""):
+    return struct.pack("!BBHL", 4, type, 8 + len(body), xid) + body
+
+class ChunkSocket(object):
+    """
+    Fake socket returning data in chunks of the given sizes
+    """
+
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+
+    def recv_into(self, view, nbytes):
+        n = min(self.sizes.pop(0) if self.sizes else len(self.data),
+                nbytes, len(self.data))
+        view[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+def receive(rx_buffer, sock):
+    """
+    Read the socket to the end and return the framed messages as strings
+    """
+    msgs = []
+    while rx_buffer.recv_into(sock):
+        for (version, type, length, xid, data) in rx_buffer.messages():
+            msgs.append((type, length, xid, str(data)))
+    return msgs
+
+class TestMessageBuffer(unittest.TestCase):
+    def setUp(self):
+        self.msgs = [message(i % 30, i, chr(i) * (i * 7 % 300))
+                     for i in range(200)]
+        self.expected = [(i % 30, len(m), i, m) for (i, m) in enumerate(self.msgs)]
+
+    def test_one_read(self):
+        rx_buffer = loxi.connection.MessageBuffer()
+        sock = ChunkSocket("".join(self.msgs), [])
+        self.assertEquals(receive(rx_buffer, sock), self.expected)
+        self.assertEquals(len(rx_buffer), 0)
+
+    def test_split_headers(self):
+        # Every header is split across reads at some point
+        for size in (1, 3, 5, 7):
+            rx_buffer = loxi.connection.MessageBuffer(size=64, min_read=16)
+            sock = ChunkSocket("".join(self.msgs), [size] * 100000)
+            self.assertEquals(receive(rx_buffer, sock), self.expected)
+
+    def test_random_chunks(self):
+        rng = random.Random(1)
+        for i in range(20):
+            rx_buffer = loxi.connection.MessageBuffer(size=rng.choice([16, 256, 4096]),
+                                                      min_read=rng.choice([1, 64, 4096]))
+            sizes = [rng.randint(1, 2000) for j in range(1000)]
+            sock = ChunkSocket("".join(self.msgs), sizes)
+            self.assertEquals(receive(rx_buffer, sock), self.expected)
+
+    def test_growth(self):
+        big = message(10, 1, "x" * 10000)
+        rx_buffer = loxi.connection.MessageBuffer(size=64, min_read=16)
+        sock = ChunkSocket(big + message(2, 2), [8, 100])
+        self.assertEquals(receive(rx_buffer, sock),
+                          [(10, len(big), 1, big), (2, 8, 2, message(2, 2))])
+        self.assertTrue(len(rx_buffer.buf) >= len(big))
+
+    def test_compaction(self):
+        # A partial message at the end of the buffer is moved to the
+        # front rather than growing the buffer
+        rx_buffer = loxi.connection.MessageBuffer(size=64, min_read=16)
+        first = message(2, 1, "a" * 40)
+        second = message(3, 2, "b" * 8)
+        sock = ChunkSocket(first + second, [len(first) + 4, 100])
+        rx_buffer.recv_into(sock)
+        self.assertEquals([str(m[4]) for m in rx_buffer.messages()], [first])
+        self.assertEquals(len(rx_buffer), 4)
+        rx_buffer.recv_into(sock)
+        self.assertEquals(rx_buffer.start, 0)
+        self.assertEquals(len(rx_buffer.buf), 64)
+        self.assertEquals([str(m[4]) for m in rx_buffer.messages()], [second])
+
+    def test_write(self):
+        rx_buffer = loxi.connection.MessageBuffer(size=16)
+        data = "".join(self.msgs)
+        msgs = []
+        for i in range(0, len(data), 13):
+            rx_buffer.write(data[i:i+13])
+            for (version, type, length, xid, buf) in rx_buffer.messages():
+                msgs.append((type, length, xid, str(buf)))
+        self.assertEquals(msgs, self.expected)
+
+    def test_bad_length(self):
+        rx_buffer = loxi.connection.MessageBuffer()
+        rx_buffer.write(message(0, 1) + struct.pack("!BBHL", 4, 0, 4, 2))
+        msgs = rx_buffer.messages()
+        self.assertEquals(next(msgs)[3], 1)
+        self.assertRaises(loxi.ProtocolError, next, msgs)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
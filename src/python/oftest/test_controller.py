@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+import sys
+import os
+import unittest
+import socket
+import struct
+import threading
+import time
+import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import loxi
+import loxi.connection
+import loxi.of13 as ofp
+sys.modules["ofp"] = ofp
+import controller
+
+class FakeSwitch(threading.Thread):
+    """
+    Switch end of a TCP connection to a Controller
+
+    Answers echo, barrier and features requests unless told not to reply,
+    and records every message it receives.
+    """
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.reply = True
+        self.received = []
+
+    def run(self):
+        rx_buffer = loxi.connection.MessageBuffer()
+        while rx_buffer.recv_into(self.sock):
+            for (version, type, length, xid, data) in rx_buffer.messages():
+                msg = ofp.message.parse_message(str(data))
+                self.received.append(msg)
+                if self.reply:
+                    self.handle(msg)
+
+    def handle(self, msg):
+        if isinstance(msg, ofp.message.echo_request):
+            self.send(ofp.message.echo_reply(xid=msg.xid))
+        elif isinstance(msg, ofp.message.barrier_request):
+            self.send(ofp.message.barrier_reply(xid=msg.xid))
+        elif isinstance(msg, ofp.message.features_request):
+            self.send(ofp.message.features_reply(xid=msg.xid, datapath_id=1))
+
+    def send(self, msg):
+        self.sock.sendall(msg.pack())
+
+class ControllerTest(unittest.TestCase):
+    """
+    Runs a Controller connected to a FakeSwitch
+    """
+
+    controller_args = {}
+
+    def setUp(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        switch_sock = socket.create_connection(listener.getsockname())
+        (sock, addr) = listener.accept()
+        listener.close()
+        self.switch = FakeSwitch(switch_sock)
+        self.switch.start()
+        self.controller = controller.Controller(sock=sock,
+                                                **self.controller_args)
+        self.controller.start()
+
+    def tearDown(self):
+        self.controller.shutdown()
+        self.controller.join()
+        self.switch.sock.close()
+
+    def barrier(self):
+        """
+        Wait until the controller has received everything sent before
+        """
+        (reply, pkt) = self.controller.transact(
+            ofp.message.barrier_request(), timeout=2)
+        self.assertNotEquals(reply, None)
+
+class TestHandler(unittest.TestCase):
+    def test_concurrent_counts(self):
+        handler = controller.Handler("all", lambda ctl, msg, raw: True)
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(
+                target=lambda: [handler(None, None, None) for i in range(2000)])
+                for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEquals(handler.stats()["calls"], 16000)
+
+class TestHandlerWorkers(ControllerTest):
+    controller_args = dict(handler_workers=4)
+
+    def test_all_counts(self):
+        # "all" handlers run on the workers of every message type at once
+        msg_types = [ofp.message.echo_reply, ofp.message.packet_in,
+                     ofp.message.flow_removed, ofp.message.port_status]
+        self.controller.register("all", lambda ctl, msg, raw: True)
+        for i in range(500):
+            for klass in msg_types:
+                self.switch.send(klass(xid=i + 1))
+        self.barrier()
+        self.assertTrue(self.controller.wait_handlers(timeout=5))
+        [stats] = self.controller.handler_stats()
+        self.assertEquals(stats["calls"], 2000)
+        self.assertEquals(stats["errors"], 0)
+        self.assertEquals(len(self.controller.packets), 0)
+
+# A packet_in with no body, which loxi cannot parse
+CORRUPT = struct.pack("!BBHL", 4, ofp.OFPT_PACKET_IN, 8, 99)
+
+class TestReceiveQueue(ControllerTest):
+    def test_poll_type(self):
+        self.switch.send(ofp.message.echo_reply(xid=1))
+        self.switch.send(ofp.message.packet_in(xid=2))
+        self.switch.send(ofp.message.echo_reply(xid=3))
+        self.barrier()
+        (msg, pkt) = self.controller.poll(ofp.OFPT_PACKET_IN, timeout=0)
+        self.assertEquals(msg.xid, 2)
+        self.assertEquals(pkt, ofp.message.packet_in(xid=2).pack())
+        (msg, pkt) = self.controller.poll(ofp.message.echo_reply, timeout=0)
+        self.assertEquals(msg.xid, 1)
+        (msg, pkt) = self.controller.poll(ofp.OFPT_ECHO_REPLY, timeout=0)
+        self.assertEquals(msg.xid, 3)
+        self.assertEquals(self.controller.poll(ofp.OFPT_ECHO_REPLY, timeout=0),
+                          (None, None))
+
+    def test_poll_xid(self):
+        for xid in (5, 6, 7):
+            self.switch.send(ofp.message.echo_reply(xid=xid))
+        self.barrier()
+        (msg, pkt) = self.controller.poll(xid=6, timeout=0)
+        self.assertEquals(msg.xid, 6)
+        (msg, pkt) = self.controller.poll(ofp.OFPT_PACKET_IN, xid=7, timeout=0)
+        self.assertEquals(msg, None)
+        (msg, pkt) = self.controller.poll(ofp.OFPT_ECHO_REPLY, xid=7, timeout=0)
+        self.assertEquals(msg.xid, 7)
+        self.assertEquals(len(self.controller.packets), 1)
+
+    def test_poll_wait(self):
+        timer = threading.Timer(0.1, self.switch.send,
+                                [ofp.message.packet_in(xid=4)])
+        timer.start()
+        (msg, pkt) = self.controller.poll(ofp.OFPT_PACKET_IN, timeout=2)
+        self.assertEquals(msg.xid, 4)
+
+    def test_lazy_parse(self):
+        self.switch.send(ofp.message.packet_in(xid=1))
+        self.barrier()
+        [rmsg] = list(self.controller.packets)
+        self.assertEquals(rmsg._msg, None)
+        self.assertEquals(rmsg.parse().xid, 1)
+
+    def test_pop_order(self):
+        msgs = [ofp.message.echo_reply(xid=1), ofp.message.packet_in(xid=2),
+                ofp.message.echo_reply(xid=3)]
+        for msg in msgs:
+            self.switch.send(msg)
+        self.barrier()
+        packets = self.controller.packets
+        self.assertEquals([packets.pop(0)[0].xid for msg in msgs], [1, 2, 3])
+        self.assertRaises(IndexError, packets.pop, 0)
+
+    def test_max_pkts(self):
+        self.controller.max_pkts = 5
+        for xid in range(1, 9):
+            self.switch.send(ofp.message.echo_reply(xid=xid))
+        self.barrier()
+        self.assertEquals([rmsg.xid for rmsg in self.controller.packets],
+                          [4, 5, 6, 7, 8])
+        self.assertEquals(self.controller.packets_expired, 3)
+        self.assertEquals(self.controller.packets.key_count(
+            controller.MessageQueue.TYPE, ofp.OFPT_ECHO_REPLY), 5)
+
+    def test_corrupt_poll(self):
+        self.switch.sock.sendall(CORRUPT)
+        self.switch.send(ofp.message.packet_in(xid=2))
+        self.barrier()
+        (msg, pkt) = self.controller.poll(ofp.OFPT_PACKET_IN, timeout=0)
+        self.assertEquals(msg.xid, 2)
+        self.assertEquals(self.controller.parse_errors, 1)
+        self.assertEquals(len(self.controller.packets), 0)
+
+    def test_corrupt_pop(self):
+        self.switch.sock.sendall(CORRUPT)
+        self.switch.send(ofp.message.echo_reply(xid=2))
+        self.switch.sock.sendall(CORRUPT)
+        self.barrier()
+        packets = self.controller.packets
+        self.assertEquals(len(packets), 3)
+        self.assertEquals(packets.pop(0)[0].xid, 2)
+        self.assertRaises(IndexError, packets.pop, 0)
+        self.assertEquals(len(packets), 0)
+
+class TestTransactions(ControllerTest):
+    def test_transact_many(self):
+        msgs = [ofp.message.barrier_request() for i in range(50)]
+        transactions = self.controller.transact_many(msgs, timeout=2)
+        self.assertEquals([trans.reply()[0].xid for trans in transactions],
+                          [msg.xid for msg in msgs])
+        self.assertEquals(self.controller.transactions, {})
+
+    def test_transact_many_timeout(self):
+        self.switch.reply = False
+        transactions = self.controller.transact_many(
+            [ofp.message.barrier_request()], timeout=0.1)
+        self.assertTrue(transactions[0].cancelled())
+        self.assertEquals(self.controller.transactions, {})
+
+    def test_transact_many_error(self):
+        self.switch.reply = False
+        outstanding = self.controller.transact_begin(
+            ofp.message.barrier_request(xid=10))
+        msgs = [ofp.message.barrier_request(xid=11),
+                ofp.message.barrier_request(xid=12),
+                ofp.message.barrier_request(xid=10)]
+        self.assertRaises(ValueError, self.controller.transact_many, msgs,
+                          timeout=1)
+        # Only the transaction begun before is left
+        self.assertEquals(self.controller.transactions.keys(), [10])
+        self.assertFalse(outstanding.done())
+
+class TestReset(ControllerTest):
+    controller_args = dict(max_pkts=77)
+
+    def test_reset(self):
+        ctrl = self.controller
+        ctrl.keep_alive = True
+        ctrl.max_pkts = 5
+        ctrl.transact_to = 1
+        ctrl.filter_packet_in = True
+        ctrl.pkt_in_filter_limit = 3
+        ctrl.register(ofp.OFPT_ECHO_REPLY, lambda ctl, msg, raw: True)
+        self.switch.send(ofp.message.packet_in(xid=1))
+        self.barrier()
+        self.switch.reply = False
+        trans = ctrl.transact_begin(ofp.message.barrier_request())
+        exp = ctrl.expect(ofp.OFPT_FLOW_REMOVED)
+
+        ctrl.reset()
+        self.assertEquals((ctrl.keep_alive, ctrl.max_pkts, ctrl.transact_to,
+                           ctrl.filter_packet_in, ctrl.pkt_in_filter_limit),
+                          (False, 77, 15, False, 50))
+        self.assertTrue(trans.cancelled())
+        self.assertTrue(exp.cancelled())
+        self.assertEquals(ctrl.handlers, {})
+        self.assertEquals(len(ctrl.packets), 0)
+        self.assertEquals(ctrl.transactions, {})
+        self.assertEquals(ctrl.stats()["rx"], {})
+
+        self.switch.reply = True
+        self.barrier()
+
+class TestPacketInPort(unittest.TestCase):
+    def test_versions(self):
+        import loxi.of10, loxi.of11, loxi.of12
+        of12 = loxi.of12
+        cases = [
+            (1, loxi.of10.message.packet_in(xid=1, in_port=3), 3),
+            (2, loxi.of11.message.packet_in(xid=1, in_port=5), 5),
+            (3, of12.message.packet_in(
+                xid=1, match=of12.match([of12.oxm.in_port(7)])), 7),
+            (4, ofp.message.packet_in(
+                xid=1, match=ofp.match([ofp.oxm.in_port(8)])), 8),
+            # in_port after another field
+            (4, ofp.message.packet_in(
+                xid=1, match=ofp.match([ofp.oxm.eth_type(0x800),
+                                        ofp.oxm.in_port(9)])), 9),
+            (4, ofp.message.packet_in(xid=1), None),
+        ]
+        for (version, msg, port) in cases:
+            self.assertEquals(controller.packet_in_port(version, msg.pack()),
+                              port)
+
+    def test_truncated(self):
+        data = ofp.message.packet_in(
+            xid=1, match=ofp.match([ofp.oxm.in_port(8)])).pack()
+        self.assertEquals(controller.packet_in_port(4, data[:30]), None)
+        self.assertEquals(controller.packet_in_port(1, data[:12]), None)
+
+def packet_in(port=1):
+    return ofp.message.packet_in(
+        xid=1, match=ofp.match([ofp.oxm.in_port(port)])).pack()
+
+class TestPacketInFilter(unittest.TestCase):
+    def test_disabled(self):
+        pkt_in_filter = controller.PacketInFilter()
+        self.assertFalse(pkt_in_filter.enabled())
+        now = time.time()
+        self.assertEquals([pkt_in_filter.check(4, packet_in(), now)
+                           for i in range(100)], [None] * 100)
+
+    def test_sample(self):
+        pkt_in_filter = controller.PacketInFilter(sample=3)
+        self.assertTrue(pkt_in_filter.enabled())
+        now = time.time()
+        reasons = [pkt_in_filter.check(4, packet_in(), now) for i in range(9)]
+        self.assertEquals(reasons, [None, "sample", "sample"] * 3)
+        self.assertEquals(pkt_in_filter.passed, 3)
+        self.assertEquals(pkt_in_filter.dropped, {"sample": 6})
+
+    def test_rate(self):
+        pkt_in_filter = controller.PacketInFilter(rate=10, burst=2)
+        now = time.time()
+        reasons = [pkt_in_filter.check(4, packet_in(), now) for i in range(3)]
+        self.assertEquals(reasons, [None, None, "rate"])
+        # One token every 0.1s
+        self.assertEquals(pkt_in_filter.check(4, packet_in(), now + 0.05), "rate")
+        self.assertEquals(pkt_in_filter.check(4, packet_in(), now + 0.11), None)
+        self.assertEquals(pkt_in_filter.dropped, {"rate": 2})
+
+    def test_port_rate(self):
+        pkt_in_filter = controller.PacketInFilter(port_rate=1, port_burst=2)
+        now = time.time()
+        reasons = [pkt_in_filter.check(4, packet_in(port), now)
+                   for port in (1, 1, 1, 2, 2, 1, 3)]
+        self.assertEquals(reasons, [None, None, "port", None, None, "port", None])
+        self.assertEquals(pkt_in_filter.port_dropped, {1: 2})
+        self.assertEquals(pkt_in_filter.dropped, {"port": 2})
+        self.assertEquals(pkt_in_filter.check(4, packet_in(1), now + 1.01), None)
+
+    def test_combined(self):
+        # Sampled packet-ins do not use up rate tokens
+        pkt_in_filter = controller.PacketInFilter(sample=2, rate=1, burst=2)
+        now = time.time()
+        reasons = [pkt_in_filter.check(4, packet_in(), now) for i in range(6)]
+        self.assertEquals(reasons, [None, "sample", None, "sample",
+                                    "rate", "sample"])
+
+class TestFilterPacketIn(ControllerTest):
+    def send_packet_ins(self, count):
+        for i in range(count):
+            self.switch.send(ofp.message.packet_in(xid=i))
+
+    def test_run_limit(self):
+        ctrl = self.controller
+        ctrl.filter_packet_in = True
+        ctrl.pkt_in_filter_limit = 3
+        self.send_packet_ins(5)
+        self.switch.send(ofp.message.echo_reply(xid=100))
+        self.send_packet_ins(2)
+        self.barrier()
+        self.assertEquals(ctrl.packets.key_count(controller.MessageQueue.TYPE,
+                                                 ofp.OFPT_PACKET_IN), 5)
+        self.assertEquals(ctrl.pkt_in_run_dropped, 2)
+        self.assertEquals(ctrl.stats()["pkt_in_dropped"], {"run": 2})
+
+    def test_pkt_in_filter(self):
+        ctrl = self.controller
+        ctrl.pkt_in_filter = controller.PacketInFilter(sample=2)
+        self.send_packet_ins(6)
+        self.barrier()
+        self.assertEquals(len(ctrl.packets), 3)
+        self.assertEquals(ctrl.pkt_in_dropped, 3)
+        self.assertEquals(ctrl.stats()["pkt_in_dropped"], {"sample": 3})
+
+    def test_expect(self):
+        # Packet-ins are kept while a test is waiting for one
+        ctrl = self.controller
+        ctrl.pkt_in_filter = controller.PacketInFilter(rate=1, burst=1)
+        self.send_packet_ins(1)
+        self.barrier()
+        exp = ctrl.expect(ofp.OFPT_PACKET_IN)
+        self.send_packet_ins(1)
+        (msg, pkt) = exp.result(timeout=2)
+        self.assertNotEquals(msg, None)
+
+    def test_reset_run(self):
+        ctrl = self.controller
+        ctrl.filter_packet_in = True
+        ctrl.pkt_in_filter_limit = 2
+        self.send_packet_ins(3)
+        deadline = time.time() + 2
+        while ctrl.pkt_in_run < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(ctrl.pkt_in_run_dropped, 1)
+        ctrl.reset()
+        self.assertEquals(ctrl.pkt_in_run, 0)
+        self.assertEquals(ctrl.pkt_in_run_dropped, 0)
+        self.assertEquals(ctrl.stats()["pkt_in_dropped"], {})
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    unittest.main(verbosity=2)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import errno
+import time
+import threading
+import types
+import logging
+import random
+import dataplane
+
+class UdpPort(object):
+    """
+    Dataplane port receiving each packet as a UDP datagram on localhost
+    """
+
+    def __init__(self, interface_name, port_number):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.setblocking(False)
+        self.recv_errors = 0
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def recv_batch(self):
+        if self.recv_errors:
+            self.recv_errors -= 1
+            raise socket.error(errno.ENETDOWN, "Network is down")
+        pkts = []
+        while True:
+            try:
+                pkts.append((self.socket.recv(65536), time.time()))
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                return pkts
+
+    def clear_error(self):
+        return self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+    def send(self, packet):
+        return len(packet)
+
+class DataPlaneTest(unittest.TestCase):
+    """
+    Runs a DataPlane with UdpPort ports 1 to 3
+    """
+
+    def setUp(self):
+        self.dp = dataplane.DataPlane({"dataplane": {"portclass": UdpPort}})
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for port_number in (1, 2, 3):
+            self.dp.port_add("udp%d" % port_number, port_number)
+
+    def tearDown(self):
+        self.dp.kill()
+        self.sender.close()
+
+    def inject(self, port_number, pkt):
+        addr = self.dp.ports[port_number].socket.getsockname()
+        self.sender.sendto(pkt, addr)
+
+def packet(n, length=100):
+    return ("%04d" % n) * (length / 4) + "x" * (length % 4)
+
+class TestRun(DataPlaneTest):
+    def test_socket_error(self):
+        # Leave ECONNREFUSED pending on port 1, then receive from the
+        # address the port is connected to
+        port = self.dp.ports[1]
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        addr = peer.getsockname()
+        peer.close()
+        port.socket.connect(addr)
+        port.socket.send("x")
+        time.sleep(0.1)
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(addr)
+        peer.sendto(packet(1), port.socket.getsockname())
+        (port_number, pkt, _) = self.dp.poll(port_number=1, timeout=2)
+        self.assertEquals(pkt, packet(1))
+        self.assertEquals(port.clear_error(), 0)
+        peer.close()
+
+    def test_recv_error(self):
+        self.dp.ports[2].recv_errors = 1
+        self.inject(2, packet(1))
+        self.inject(2, packet(2))
+        (port_number, pkt, _) = self.dp.poll(port_number=2, timeout=2)
+        self.assertEquals(pkt, packet(1))
+        self.assertTrue(self.dp.is_alive())
+
+class TestPacketQueue(unittest.TestCase):
+    def test_long(self):
+        q = dataplane.PacketQueue()
+        head = "h" * 60
+        q.add(1, head + "a", 1.0)
+        q.add(2, head + "b", 2.0)
+        q.add(1, head + "b", 3.0)
+        # Same 60 byte prefix, must still compare the whole packet
+        self.assertEquals(q.find_packet(head + "b").value, (2, head + "b", 2.0))
+        self.assertEquals(q.find_packet(head + "b", 1).value, (1, head + "b", 3.0))
+        self.assertEquals(q.find_packet(head + "c"), None)
+        self.assertEquals(q.find_packet(head), None)
+
+    def test_min_len(self):
+        q = dataplane.PacketQueue()
+        pkt = "m" * 60
+        q.add(1, pkt + "pad", 1.0)
+        self.assertEquals(q.find_packet(pkt), None)
+        q.add(1, pkt, 2.0)
+        self.assertEquals(q.find_packet(pkt).value, (1, pkt, 2.0))
+
+    def test_short(self):
+        # Short expected packets ignore the padding of received packets
+        q = dataplane.PacketQueue()
+        q.add(1, "abcd" + "\0" * 56, 1.0)
+        q.add(2, "abce" + "\0" * 56, 2.0)
+        self.assertEquals(q.find_packet("abce").value[0], 2)
+        self.assertEquals(q.short_indexes.keys(), [4])
+        # Packets added later are indexed too
+        q.add(3, "abcdef", 3.0)
+        self.assertEquals(q.find_packet("abcd", 3).value[0], 3)
+        self.assertEquals(q.find_packet("abc").value[0], 1)
+        self.assertEquals(q.find_packet("abcf"), None)
+
+    def test_remove(self):
+        q = dataplane.PacketQueue()
+        head = "r" * 60
+        for i in range(4):
+            q.add(i % 2, head + str(i), float(i))
+        self.assertEquals(q.find_packet("rr").value[2], 0.0)
+        self.assertEquals(q.port_popleft(0), (0, head + "0", 0.0))
+        self.assertEquals(q.find_packet("rr").value[2], 1.0)
+        q.remove(q.find_packet(head + "3"))
+        self.assertEquals(q.find_packet(head + "3"), None)
+        self.assertEquals(q.port_popleft(), (1, head + "1", 1.0))
+        self.assertEquals(q.find_packet("rr").value[2], 2.0)
+        self.assertEquals(q.find_packet("rr", 1), None)
+        q.remove(q.find_packet("rr"))
+        self.assertEquals(q.find_packet("rr"), None)
+        self.assertEquals(len(q), 0)
+        self.assertEquals(q.short_indexes, {2: {}})
+
+    def test_random(self):
+        # Compare lookups with a linear scan of a plain list
+        rng = random.Random(1)
+        q = dataplane.PacketQueue()
+        model = []
+        heads = ["x" * 58 + c for c in "ab"]
+        for i in range(3000):
+            op = rng.random()
+            if op < 0.5:
+                pkt = rng.choice(heads) + rng.choice(["", "1", "2", "12"])
+                pkt = pkt[:rng.choice([10, 59, 60, 61, 100])]
+                item = (rng.randint(1, 3), pkt, float(i))
+                q.add(*item)
+                model.append(item)
+            elif op < 0.7:
+                port_number = rng.choice([None, 1, 2, 3])
+                expected = [x for x in model
+                            if port_number is None or x[0] == port_number][:1]
+                item = q.port_popleft(port_number)
+                self.assertEquals([item] if item else [], expected)
+                if item:
+                    model.remove(item)
+            else:
+                port_number = rng.choice([None, 1, 2, 3])
+                exp_pkt = rng.choice(heads) + rng.choice(["", "1", "12"])
+                exp_pkt = exp_pkt[:rng.choice([1, 10, 59, 60, 61])]
+                expected = [x for x in model
+                            if (port_number is None or x[0] == port_number) and
+                            dataplane.match_exp_pkt(exp_pkt, x[1])][:1]
+                entry = q.find_packet(exp_pkt, port_number)
+                self.assertEquals([entry.value] if entry else [], expected)
+                if entry and rng.random() < 0.5:
+                    q.remove(entry)
+                    model.remove(entry.value)
+            self.assertEquals(len(q), len(model))
+        self.assertEquals(list(q), model)
+
+class TestPoll(DataPlaneTest):
+    def test_exp_pkt(self):
+        short = "s" * 20
+        exact = "e" * 60
+        long = "l" * 100
+        for pkt in (packet(1), short + "\0" * 40, packet(2), exact, long,
+                    packet(3)):
+            self.inject(1, pkt)
+        self.inject(2, packet(4))
+        (port_number, pkt, _) = self.dp.poll(2, timeout=2)
+        self.assertEquals(pkt, packet(4))
+        # Packets before the match are discarded
+        (port_number, pkt, _) = self.dp.poll(1, timeout=2, exp_pkt=short)
+        self.assertEquals(pkt, short + "\0" * 40)
+        (port_number, pkt, _) = self.dp.poll(1, timeout=2, exp_pkt=exact)
+        self.assertEquals(pkt, exact)
+        (port_number, pkt, _) = self.dp.poll(1, timeout=2)
+        self.assertEquals(pkt, long)
+        # A packet already consumed is not found again, and the search
+        # discards the rest of the port's queue
+        self.assertEquals(self.dp.poll(1, timeout=0, exp_pkt=long),
+                          (None, None, None))
+        self.assertEquals(self.dp.poll(timeout=0), (None, None, None))
+
+    def test_exp_pkt_wait(self):
+        self.inject(3, packet(1))
+        (port_number, pkt, _) = self.dp.poll(3, timeout=2)
+        self.inject(3, packet(2))
+        (port_number, pkt, _) = self.dp.poll(3, timeout=2, exp_pkt=packet(2)[:10])
+        self.assertEquals(pkt, packet(2))
+        self.assertEquals(self.dp.poll(3, timeout=0, exp_pkt=packet(2)[:10]),
+                          (None, None, None))
+
+    def test_queue_full(self):
+        self.dp.MAX_QUEUE_LEN = 4
+        for i in range(6):
+            self.inject(1, packet(i, 10 + i * 20))
+        self.inject(2, packet(10))
+        self.assertNotEquals(self.dp.poll(2, timeout=2)[1], None)
+        # The two oldest packets were evicted
+        self.assertEquals([pkt for (pkt, time) in self.dp.packet_queues[1]],
+                          [packet(i, 10 + i * 20) for i in range(2, 6)])
+        (port_number, pkt, _) = self.dp.poll(1, timeout=0, exp_pkt=packet(3, 70))
+        self.assertEquals(pkt, packet(3, 70))
+        self.assertEquals([self.dp.poll(1, timeout=0)[1] for i in range(3)],
+                          [packet(4, 90), packet(5, 110), None])
+        self.assertEquals(self.dp.poll(1, timeout=0, exp_pkt=packet(0, 10)),
+                          (None, None, None))
+
+class TestVerify(DataPlaneTest):
+    def inject_later(self, delay, port_number, pkt):
+        timer = threading.Timer(delay, self.inject, [port_number, pkt])
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_out_of_order(self):
+        self.inject(3, packet(3))
+        self.inject_later(0.05, 2, packet(2))
+        self.inject_later(0.1, 1, packet(1))
+        start = time.time()
+        v = self.dp.verify(positive=[(1, packet(1)), (2, packet(2)),
+                                     (3, packet(3))],
+                           timeout=2, negative_timeout=0.1)
+        self.assertTrue(v.ok())
+        self.assertEquals([port_number for (port_number, pkt, t) in v.received],
+                          [1, 2, 3])
+        self.assertEquals([pkt for (port_number, pkt, t) in v.received],
+                          [packet(1), packet(2), packet(3)])
+        self.assertTrue(time.time() - start < 1)
+
+    def test_discard_before_match(self):
+        self.inject(1, packet(9))
+        self.inject(1, packet(1))
+        self.inject(1, packet(8))
+        v = self.dp.verify(positive=[(1, packet(1))], timeout=2)
+        self.assertTrue(v.ok())
+        self.assertEquals(self.dp.poll(1, timeout=0)[1], packet(8))
+
+    def test_negative(self):
+        self.inject(1, packet(1))
+        self.inject_later(0.1, 2, packet(2))
+        start = time.time()
+        v = self.dp.verify(positive=[(1, packet(1))],
+                           negative=[(2, packet(2)), (3, packet(3))],
+                           timeout=2, negative_timeout=2)
+        # Returns as soon as the negative packet arrives
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse(v.ok())
+        self.assertEquals(v.missing(), [])
+        self.assertEquals([(port_number, pkt) for (port_number, pkt, t) in v.unexpected],
+                          [(2, packet(2))])
+
+    def test_negative_other_packet(self):
+        # Other packets on a negative port are discarded, not unexpected
+        self.inject(2, packet(5))
+        v = self.dp.verify(negative=[(2, packet(2))], negative_timeout=0.1)
+        self.assertTrue(v.ok())
+        self.assertEquals(self.dp.poll(2, timeout=0), (None, None, None))
+
+    def test_no_other(self):
+        self.inject(1, packet(1))
+        self.inject_later(0.05, 3, packet(7))
+        v = self.dp.verify(positive=[(1, packet(1))], no_other=True,
+                           timeout=2, negative_timeout=0.3)
+        self.assertFalse(v.ok())
+        self.assertEquals([(port_number, pkt) for (port_number, pkt, t) in v.other],
+                          [(3, packet(7))])
+        # Reported once, then gone
+        self.assertEquals(self.dp.poll(timeout=0), (None, None, None))
+
+        self.inject(1, packet(1))
+        start = time.time()
+        v = self.dp.verify(positive=[(1, packet(1))], no_other=True,
+                           timeout=2, negative_timeout=0.2)
+        self.assertTrue(v.ok())
+        # Waited out the negative window
+        self.assertTrue(time.time() - start >= 0.2)
+
+    def test_shared_deadline(self):
+        # One window for all ports rather than one per port
+        start = time.time()
+        v = self.dp.verify(positive=[(1, packet(1)), (2, packet(2)),
+                                     (3, packet(3))],
+                           negative=[(1, packet(4)), (2, packet(5)),
+                                     (3, packet(6))],
+                           timeout=0.3, negative_timeout=0.2)
+        elapsed = time.time() - start
+        self.assertTrue(0.3 <= elapsed < 0.6, elapsed)
+        self.assertEquals(len(v.missing()), 3)
+        self.assertFalse(v.ok())
+
+        start = time.time()
+        v = self.dp.verify(negative=[(1, packet(4)), (2, packet(5)),
+                                     (3, packet(6))],
+                           negative_timeout=0.2)
+        elapsed = time.time() - start
+        self.assertTrue(0.2 <= elapsed < 0.5, elapsed)
+        self.assertTrue(v.ok())
+
+class TestPortMmap(unittest.TestCase):
+    def test_ring_error(self):
+        # Setting up the ring fails on anything but an AF_PACKET socket
+        port = types.InstanceType(dataplane.DataPlanePortLinuxMmap)
+        port.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.assertRaises(socket.error, port.setup_socket)
+        port.__del__()
+        self.assertRaises(socket.error, port.socket.fileno)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    unittest.main(verbosity=2)
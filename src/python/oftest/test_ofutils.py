@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import unittest
+import signal
+import socket
+import threading
+import time
+import ofutils
+
+class TestIndexedQueue(unittest.TestCase):
+    def test_order(self):
+        q = ofutils.IndexedQueue(nindexes=1)
+        for i in range(10):
+            q.append(i, i % 3)
+        self.assertEquals(len(q), 10)
+        self.assertEquals(q.popleft(0, 1), 1)
+        self.assertEquals(q.popleft(0, 1), 4)
+        self.assertEquals(q.popleft(), 0)
+        self.assertEquals(list(q), [2, 3, 5, 6, 7, 8, 9])
+        self.assertEquals(q.key_count(0, 1), 1)
+
+    def test_find(self):
+        q = ofutils.IndexedQueue(nindexes=2)
+        for i in range(10):
+            q.append(i, i % 2, i % 5)
+        entry = q.find(lambda x: x > 4, 0, 0)
+        self.assertEquals(entry.value, 6)
+        q.remove(entry)
+        self.assertEquals(q.popleft(1, 1), 1)
+        self.assertEquals(q.popleft(1, 1), None)
+        self.assertEquals(q.oldest(1, 0).value, 0)
+        self.assertEquals(len(q), 8)
+
+    def test_compaction(self):
+        q = ofutils.IndexedQueue(nindexes=1)
+        q.append("old", "a")
+        for i in range(1000):
+            q.append(i, "b")
+            self.assertEquals(q.popleft(0, "b"), i)
+        self.assertTrue(len(q.order) < 100)
+        self.assertEquals(q.popleft(), "old")
+        self.assertEquals(len(q), 0)
+
+class TestFuture(unittest.TestCase):
+    def test_wait_all(self):
+        futures = [ofutils.Future() for i in range(3)]
+        timer = threading.Timer(0.05, lambda: [f.set_result(1) for f in futures])
+        timer.start()
+        self.assertEquals(ofutils.wait_all(futures, timeout=2), [])
+        self.assertEquals([f.result(timeout=0) for f in futures], [1, 1, 1])
+
+    def test_timeout(self):
+        futures = [ofutils.Future(), ofutils.Future()]
+        futures[0].set_result("x")
+        start = time.time()
+        self.assertEquals(ofutils.wait_all(futures, timeout=0.1), [futures[1]])
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(ofutils.wait_any(futures, timeout=0.1), [futures[0]])
+
+    def test_cancel(self):
+        future = ofutils.Future()
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertFalse(future.set_result(1))
+        self.assertEquals(future.result(timeout=0), None)
+
+    def test_cancel_callback(self):
+        future = ofutils.Future()
+        seen = []
+        future.add_done_callback(lambda f: seen.append((f.done(), f.cancelled())))
+        future.cancel()
+        self.assertEquals(seen, [(True, True)])
+
+    def test_wait_removes_callbacks(self):
+        future = ofutils.Future()
+        for i in range(3):
+            ofutils.wait_all([future], timeout=0.01)
+        self.assertEquals(future._callbacks, [])
+
+class TestHistogram(unittest.TestCase):
+    def test_percentile(self):
+        h = ofutils.Histogram()
+        self.assertEquals(h.percentile(50), None)
+        for i in range(90):
+            h.add(0.0001)
+        for i in range(10):
+            h.add(0.05)
+        snap = h.snapshot()
+        self.assertEquals(snap["count"], 100)
+        self.assertEquals(snap["max"], 0.05)
+        self.assertTrue(0.0001 <= snap["p50"] < 0.0002)
+        self.assertTrue(0.0001 <= snap["p90"] < 0.0002)
+        self.assertEquals(snap["p99"], 0.05)
+
+class TestPoller(unittest.TestCase):
+    def test_error(self):
+        # A UDP socket connected to a closed port gets ECONNREFUSED as a
+        # pending socket error, which epoll reports as EPOLLERR
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(("127.0.0.1", 0))
+        addr = closed.getsockname()
+        closed.close()
+        sk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sk.connect(addr)
+        sk.send("x")
+        poller = ofutils.Poller()
+        poller.register(sk)
+        (sel_in, sel_err) = poller.poll(1)
+        self.assertEquals(sel_err, [sk])
+        # Reading the error clears it
+        self.assertNotEquals(sk.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR), 0)
+        self.assertEquals(poller.poll(0), ([], []))
+        poller.close()
+        sk.close()
+
+    def test_signal(self):
+        poller = ofutils.Poller()
+        old = signal.signal(signal.SIGALRM, lambda signum, frame: None)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            start = time.time()
+            self.assertEquals(poller.poll(2), ([], []))
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            signal.signal(signal.SIGALRM, old)
+        poller.close()
+
+class TestOrderedExecutor(unittest.TestCase):
+    def test_order(self):
+        executor = ofutils.OrderedExecutor(workers=3, max_pending=4)
+        results = {}
+        def call(key, i):
+            time.sleep(0.001 * (i % 3))
+            results.setdefault(key, []).append(i)
+        for i in range(30):
+            executor.submit(i % 2, call, i % 2, i)
+        self.assertTrue(executor.drain(timeout=5))
+        self.assertEquals(results[0], range(0, 30, 2))
+        self.assertEquals(results[1], range(1, 30, 2))
+        executor.shutdown(wait=True)
+        self.assertFalse(executor.submit(0, call, 0, 0))
+
+    def test_nonblocking(self):
+        executor = ofutils.OrderedExecutor(workers=1, max_pending=2)
+        gate = threading.Event()
+        results = []
+        executor.submit(0, gate.wait)
+        time.sleep(0.05) # Let the worker take the first call
+        self.assertTrue(executor.submit(0, results.append, 1, block=False))
+        self.assertTrue(executor.submit(0, results.append, 2, block=False))
+        self.assertFalse(executor.submit(0, results.append, 3, block=False))
+        self.assertEquals(executor.dropped, 1)
+        gate.set()
+        self.assertTrue(executor.drain(timeout=5))
+        self.assertEquals(results, [1, 2])
+        executor.shutdown(wait=True)
+
+    def test_error(self):
+        executor = ofutils.OrderedExecutor(workers=1)
+        results = []
+        executor.submit(None, lambda: 1 / 0)
+        executor.submit(None, results.append, 1)
+        self.assertTrue(executor.drain(timeout=5))
+        self.assertEquals(results, [1])
+        executor.shutdown(wait=True)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
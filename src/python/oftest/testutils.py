@@ -43,9 +43,10 @@ def delete_all_flows(ctrl, send_barrier=True):
         msg.buffer_id = ofp.OFP_NO_BUFFER
         msg.out_port = ofp.OFPP_ANY
         msg.out_group = ofp.OFPG_ANY
-    ctrl.message_send(msg)
     if send_barrier:
-        do_barrier(ctrl)
+        send_with_barrier(ctrl, [msg])
+    else:
+        ctrl.message_send(msg)
     return 0 # for backwards compatibility
 
 def delete_all_groups(ctrl):
@@ -56,8 +57,7 @@ def delete_all_groups(ctrl):
 
     logging.info("Deleting all groups")
     msg = ofp.message.group_delete(group_id=ofp.OFPG_ALL)
-    ctrl.message_send(msg)
-    do_barrier(ctrl)
+    send_with_barrier(ctrl, [msg])
 
 def required_wildcards(parent):
     w = test_param_get('required_wildcards', default='default')
@@ -511,6 +511,26 @@ def do_barrier(ctrl, timeout=-1):
     # We'll trust the transaction processing in the controller that xid matched
     return 0 # for backwards compatibility
 
+def send_with_barrier(ctrl, msgs, timeout=-1):
+    """
+    Send a list of messages followed by a barrier and wait for the reply
+
+    The messages and the barrier request are written to the switch with a
+    single send, so installing many flows costs one system call rather
+    than one per flow-mod.
+
+    @param ctrl The controller object for the test
+    @param msgs List of messages to send before the barrier
+    @param timeout Timeout for the barrier reply; -1 for the default
+    """
+    with ctrl.corked():
+        ctrl.message_send_many(msgs)
+        trans = ctrl.transact_begin(ofp.message.barrier_request())
+    (resp, pkt) = ctrl.transact_end(trans, timeout=timeout)
+    if resp is None:
+        raise AssertionError("barrier failed")
+    return 0 # for backwards compatibility
+
 def port_config_get(controller, port_no):
     """
     Get a port's configuration
@@ -1316,22 +1336,67 @@ assert(parse_version("1.0") == set(["1.0"]))
 assert(parse_version("1.0,1.2,1.3") == set(["1.0", "1.2", "1.3"]))
 assert(parse_version("1.0+") == set(["1.0", "1.1", "1.2", "1.3"]))
 
+def iter_stats(test, req, timeout=-1):
+    """
+    Yield stats entries as each part of a multipart reply arrives
+
+    Parts are matched to the request by xid, so other stats requests may
+    be outstanding at the same time.  Each part is dropped once its entries
+    have been yielded.  Stopping the iteration early abandons the request.
+
+    @param timeout The timeout in seconds for the whole reply; if -1 use
+    default.
+    """
+    msgtype = ofp.OFPT_STATS_REPLY
+    trans = test.controller.transact_begin(req, multipart=True)
+    test.controller.flush()
+    try:
+        for reply, _ in trans.parts(timeout=timeout):
+            test.assertTrue(reply is not None, "Could not parse stats reply")
+            test.assertEquals(reply.type, msgtype, "Response had unexpected message type")
+            for entry in reply.entries:
+                yield entry
+    finally:
+        if not trans.done():
+            test.controller.transact_cancel(trans)
+    test.assertTrue(trans.done() and not trans.cancelled(),
+                    "No complete response to stats request")
+
 def get_stats(test, req):
     """
     Retrieve a list of stats entries. Handles OFPSF_REPLY_MORE.
     """
+    return list(iter_stats(test, req))
+
+def get_stats_many(test, reqs, timeout=-1):
+    """
+    Retrieve the stats entries for several requests at once
+
+    All requests are sent in one write and the replies are collected
+    with a single timeout, e.g.
+
+        flows, ports = get_stats_many(test, [
+            ofp.message.flow_stats_request(...),
+            ofp.message.port_stats_request(port_no=ofp.OFPP_ANY)])
+
+    @param reqs List of stats request messages
+    @param timeout The timeout in seconds for all replies; if -1 use
+    default.
+    @returns List of lists of entries, in the order of reqs
+    """
     msgtype = ofp.OFPT_STATS_REPLY
-    more_flag = ofp.OFPSF_REPLY_MORE
-    stats = []
-    reply, _ = test.controller.transact(req)
-    test.assertTrue(reply is not None, "No response to stats request")
-    test.assertEquals(reply.type, msgtype, "Response had unexpected message type")
-    stats.extend(reply.entries)
-    while reply.flags & more_flag != 0:
-        reply, pkt = test.controller.poll(exp_msg=msgtype)
-        test.assertTrue(reply is not None, "No response to stats request")
-        stats.extend(reply.entries)
-    return stats
+    results = []
+    for trans in test.controller.transact_many(reqs, timeout=timeout,
+                                               multipart=True):
+        test.assertTrue(trans.done() and not trans.cancelled(),
+                        "No complete response to stats request")
+        stats = []
+        for reply, _ in trans.replies:
+            test.assertTrue(reply is not None, "Could not parse stats reply")
+            test.assertEquals(reply.type, msgtype, "Response had unexpected message type")
+            stats.extend(reply.entries)
+        results.append(stats)
+    return results
 
 def get_flow_stats(test, match, table_id=None,
                    out_port=None, out_group=None,
@@ -1677,14 +1742,29 @@ def verify_packets(test, pkt, ofports):
     For more complex usage, like multiple different packets being output, or
     multiple packets on the same port, use the primitive verify_packet,
     verify_no_packet, and verify_no_other_packets functions directly.
+
+    All ports are checked in one shared window, see DataPlane.verify.
     """
     pkt = str(pkt)
-    for ofport in openflow_ports():
+    ports = openflow_ports()
+    logging.debug("Checking for pkt on ports %r", ofports)
+    v = test.dataplane.verify(
+        positive=[(ofport, pkt) for ofport in ports if ofport in ofports],
+        negative=[(ofport, pkt) for ofport in ports if ofport not in ofports],
+        no_other=not oftest.config["relax"])
+    missing = [ofport for (ofport, _) in v.missing()]
+    unexpected = [rcv_port for (rcv_port, _, _) in v.unexpected]
+    for ofport in ports:
         if ofport in ofports:
-            verify_packet(test, pkt, ofport)
+            test.assertTrue(ofport not in missing,
+                            "Did not receive pkt on %r" % ofport)
         else:
-            verify_no_packet(test, pkt, ofport)
-    verify_no_other_packets(test)
+            test.assertTrue(ofport not in unexpected,
+                            "Received packet on %r" % ofport)
+    if v.other:
+        (rcv_port, rcv_pkt, pkt_time) = v.other[0]
+        logging.debug("Received unexpected packet on port %r: %s", rcv_port, format_packet(rcv_pkt))
+        test.fail("Unexpected packet on port %r" % rcv_port)
 
 def verify_no_errors(ctrl):
     error, _ = ctrl.poll(ofp.OFPT_ERROR, 0)